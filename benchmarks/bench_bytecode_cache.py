@@ -0,0 +1,58 @@
+"""Cold versus warm start of plugin imports with the bytecode cache.
+
+Generates a set of synthetic plugins and imports all of their modules three
+times: without a bytecode cache, with an empty cache (cold start) and with the
+cache filled by the previous run (warm start).
+
+Usage: python benchmarks/bench_bytecode_cache.py [plugins] [modules]
+"""
+
+import importlib
+import shutil
+import sys
+import tempfile
+import time
+import os
+
+from support import BenchPluginContainer, generate_plugins, unload_modules
+from termite.bytecode import BytecodeCache
+from termite.loader import PlatformPluginsFinder
+
+
+def import_all(generated, bytecode_cache):
+    finder = PlatformPluginsFinder([], bytecode_cache=bytecode_cache)
+    sys.meta_path.insert(0, finder)
+    try:
+        start = time.perf_counter()
+        for path, modules in generated:
+            finder.add_plugin(BenchPluginContainer(path))
+        for path, modules in generated:
+            for module in modules:
+                importlib.import_module(module)
+        return time.perf_counter() - start
+    finally:
+        sys.meta_path.remove(finder)
+        unload_modules()
+
+
+def main(argv):
+    plugins = int(argv[1]) if len(argv) > 1 else 20
+    modules = int(argv[2]) if len(argv) > 2 else 20
+    sys.dont_write_bytecode = False
+    root = tempfile.mkdtemp()
+    try:
+        generated = generate_plugins(os.path.join(root, 'plugins'), plugins, modules)
+        cache = BytecodeCache(os.path.join(root, 'cache'))
+        no_cache = import_all(generated, None)
+        cold = import_all(generated, cache)
+        warm = import_all(generated, cache)
+        print('%d plugins x %d modules' % (plugins, modules))
+        print('no cache:   %8.3f s' % no_cache)
+        print('cold start: %8.3f s' % cold)
+        print('warm start: %8.3f s  (%.1fx faster than cold)' % (warm, cold / warm))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,95 @@
+"""Concurrent imports of plugin modules from many threads.
+
+Generates a set of synthetic plugins and imports all of their modules from N
+threads, for a few values of N. Two workloads are run for each N:
+
+    * partitioned - each thread imports the modules of its own plugins, as when
+    the plugins are activated from a thread pool.
+    * contended - every thread imports every module, in a different order, so
+    the threads race to load the same modules.
+
+After each run the benchmark checks that every thread got the same module
+object for each name and that no import failed.
+
+Usage: python benchmarks/bench_concurrent_imports.py [plugins] [modules] [max threads]
+"""
+
+import importlib
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+from support import BenchPluginContainer, generate_plugins, unload_modules
+from termite.loader import PlatformPluginsFinder
+
+
+def run(generated, threads, contended):
+    finder = PlatformPluginsFinder([])
+    for path, modules in generated:
+        finder.add_plugin(BenchPluginContainer(path))
+    sys.meta_path.insert(0, finder)
+    if contended:
+        all_modules = [m for path, modules in generated for m in modules]
+        work = [random.Random(t).sample(all_modules, len(all_modules)) for t in range(threads)]
+    else:
+        work = [[m for path, modules in generated[t::threads] for m in modules] for t in range(threads)]
+    results = [None] * threads
+    errors = []
+    barrier = threading.Barrier(threads)
+
+    def worker(index):
+        loaded = {}
+        barrier.wait()
+        try:
+            for name in work[index]:
+                loaded[name] = importlib.import_module(name)
+        except Exception as e:
+            errors.append(e)
+        results[index] = loaded
+
+    workers = [threading.Thread(target=worker, args=(t,)) for t in range(threads)]
+    try:
+        start = time.perf_counter()
+        for w in workers:
+            w.start()
+        for w in workers:
+            w.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        sys.meta_path.remove(finder)
+        unload_modules()
+    if errors:
+        raise errors[0]
+    seen = {}
+    for loaded in results:
+        for name, module in loaded.items():
+            if seen.setdefault(name, module) is not module:
+                raise AssertionError('Module %s loaded more than once' % name)
+    return elapsed
+
+
+def main(argv):
+    plugins = int(argv[1]) if len(argv) > 1 else 32
+    modules = int(argv[2]) if len(argv) > 2 else 10
+    max_threads = int(argv[3]) if len(argv) > 3 else 8
+    root = tempfile.mkdtemp()
+    try:
+        generated = generate_plugins(os.path.join(root, 'plugins'), plugins, modules)
+        print('%d plugins x %d modules' % (plugins, modules))
+        print('threads | partitioned [s] | contended [s]')
+        threads = 1
+        while threads <= max_threads:
+            partitioned = run(generated, threads, False)
+            contended = run(generated, threads, True)
+            print('%7d | %15.3f | %13.3f' % (threads, partitioned, contended))
+            threads *= 2
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(sys.argv)
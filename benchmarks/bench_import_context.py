@@ -0,0 +1,56 @@
+"""Per-import overhead of the context sensitive import function.
+
+Compares the previous implementation (thread-local dictionary written on every
+call, one function per module) with the context variable based one (written
+only when the importing plugin changes, one function per plugin). Each call
+imports an already loaded module, so the measured time is dominated by the
+overhead of the wrapper itself.
+
+Usage: python benchmarks/bench_import_context.py [calls]
+"""
+
+import sys
+import threading
+import timeit
+
+import support  # noqa - sets up the path
+from termite.loader import create_context_sensitive_import
+
+_original_import = __import__
+_local = threading.local()
+
+
+def thread_local_import(context):
+    def context_sensitive_import(*args, **kwargs):
+        try:
+            values = _local.values
+        except AttributeError:
+            values = _local.values = {}
+        values['termite.IMPORT_CONTEXT'] = context
+        return _original_import(*args, **kwargs)
+    return context_sensitive_import
+
+
+def main(argv):
+    calls = int(argv[1]) if len(argv) > 1 else 1000000
+    old = thread_local_import('bench.plugin')
+    new = create_context_sensitive_import('bench.plugin')
+    other = create_context_sensitive_import('bench.other')
+
+    baseline = timeit.timeit(lambda: _original_import('os'), number=calls)
+    old_time = timeit.timeit(lambda: old('os'), number=calls)
+    new_time = timeit.timeit(lambda: new('os'), number=calls)
+    # worst case - every call switches the importing plugin
+    switching = timeit.timeit(lambda: (new('os'), other('os')), number=calls // 2)
+
+    def per_call(total):
+        return (total - baseline) / calls * 1e9
+
+    print('%d calls, overhead over builtin __import__:' % calls)
+    print('thread-local:              %6.1f ns/import' % per_call(old_time))
+    print('context variable:          %6.1f ns/import' % per_call(new_time))
+    print('context variable (switch): %6.1f ns/import' % per_call(switching))
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,97 @@
+"""Helpers shared by the benchmarks: generation of synthetic plugins and a
+minimal plugin container to load them without a full platform.
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from termite.plugins.support import ExplodedPlugin, PluginManifestParser
+
+__author__ = 'pavle'
+
+
+MODULE_TEMPLATE = '''
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+CONSTANT_%(n)d = %(n)d
+
+
+class Handler%(n)d:
+    """Generated handler."""
+
+    def __init__(self, name='handler-%(n)d'):
+        self.name = name
+        self.items = {}
+
+    def handle(self, key, value):
+        if key in self.items:
+            self.items[key].append(value)
+        else:
+            self.items[key] = [value]
+        return len(self.items[key])
+
+    def summary(self):
+        return dict((k, len(v)) for k, v in self.items.items())
+
+'''
+
+FUNCTION_TEMPLATE = '''
+def function_%(n)d_%(i)d(a, b=%(i)d, *args, **kwargs):
+    total = a + b
+    for arg in args:
+        total += arg
+    for key, value in sorted(kwargs.items()):
+        if isinstance(value, int):
+            total += value
+        else:
+            log.debug('skipping %%s', key)
+    return [total * x for x in range(%(i)d)]
+'''
+
+
+class BenchPluginContainer:
+
+    def __init__(self, path):
+        self.plugin = ExplodedPlugin(path, PluginManifestParser())
+        self.manifest = self.plugin.get_manifest()
+        self.plugin_id = self.manifest.id
+        self.version = self.manifest.version
+
+    def get_environ(self):
+        return {'__platform__': 'termite'}
+
+
+def generate_plugins(root, plugins=20, modules=20, functions=30):
+    """Generates synthetic plugins in the root directory.
+
+    Returns a list of (plugin_path, [module names]).
+    """
+    generated = []
+    for p in range(plugins):
+        package = 'benchpkg%d' % p
+        path = os.path.join(root, 'bench.plugin%d' % p)
+        os.makedirs(os.path.join(path, package))
+        with open(os.path.join(path, 'PLUGIN.MF'), 'w') as mf:
+            mf.write('Plugin-Id: bench.plugin%d\nVersion: 1.0\nExports: %s [1.0]\n' % (p, package))
+        with open(os.path.join(path, package, '__init__.py'), 'w') as fh:
+            fh.write('')
+        names = []
+        for m in range(modules):
+            source = MODULE_TEMPLATE % {'n': m}
+            source += ''.join(FUNCTION_TEMPLATE % {'n': m, 'i': i} for i in range(functions))
+            with open(os.path.join(path, package, 'mod%d.py' % m), 'w') as fh:
+                fh.write(source)
+            names.append('%s.mod%d' % (package, m))
+        generated.append((path, names))
+    return generated
+
+
+def unload_modules(prefix='benchpkg'):
+    for name in list(sys.modules):
+        if name.startswith(prefix):
+            del sys.modules[name]
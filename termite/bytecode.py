@@ -0,0 +1,261 @@
+#    This file is part of Termite Plugins Platform
+#    Copyright (C) 2014 Pavle Jonoski
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""On-disk cache of the compiled plugin modules.
+
+The plugin modules are compiled once and the compiled code is kept in a cache
+directory, outside of the plugins themselves, so the plugins may live on a
+read-only location. Each version of a plugin has its own directory in the cache:
+
+    <cache_dir>/<plugin_id>-<version>/<module path>.<cache tag>.pyc
+
+The files use the standard pyc format (see PEP-552). The cached code is
+validated against the module source either by the source modification time and
+size (the default), or by a hash of the source.
+
+The cache may be filled ahead of time, with all the plugin sources compiled in
+parallel (see precompile_plugins).
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import logging
+import marshal
+import os
+import sys
+import threading
+from importlib.util import MAGIC_NUMBER, source_hash
+
+__author__ = 'pavle'
+
+
+VALIDATE_TIMESTAMP = 'timestamp'
+VALIDATE_HASH = 'hash'
+
+_FLAG_HASH_BASED = 0x1
+_FLAG_CHECK_SOURCE = 0x2
+
+
+def _pack_uint32(value):
+    return (int(value) & 0xFFFFFFFF).to_bytes(4, 'little')
+
+
+class BytecodeCache:
+    """Cache of the compiled plugin modules stored in a directory.
+
+    cache_dir is the directory where the compiled modules are stored. It is
+    created if it does not exist.
+
+    validation is the way the cached code is validated against the source:
+    VALIDATE_TIMESTAMP (by the source modification time and size) or
+    VALIDATE_HASH (by hash of the source).
+    """
+
+    def __init__(self, cache_dir, validation=VALIDATE_TIMESTAMP):
+        if validation not in (VALIDATE_TIMESTAMP, VALIDATE_HASH):
+            raise ValueError('Unknown bytecode validation: %s' % validation)
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.validation = validation
+        self.log = logging.getLogger('termite.bytecode.BytecodeCache')
+
+    def cache_path(self, plugin_id, version, resource_path):
+        """Returns the path of the compiled module in the cache.
+
+        resource_path is the path of the module source within the plugin.
+        """
+        if sys.implementation.cache_tag is None:
+            return None
+        return os.path.join(self.cache_dir, '%s-%s' % (plugin_id, version),
+                            '%s.%s.pyc' % (os.path.splitext(resource_path)[0], sys.implementation.cache_tag))
+
+    def owns(self, path):
+        return path is not None and path.startswith(self.cache_dir + os.path.sep)
+
+    def load(self, cache_path, source_stats, get_source):
+        """Loads the compiled code from the cache.
+
+        source_stats is a dictionary with the 'mtime' and 'size' of the module
+        source.
+
+        get_source is a callable returning the source of the module. It is
+        called only if the source is needed to validate the cached code.
+
+        Returns the code object, or None if there is no valid compiled code in
+        the cache.
+        """
+        try:
+            with open(cache_path, 'rb') as fh:
+                data = fh.read()
+        except OSError:
+            return None
+        if not self.__valid_header__(data, source_stats, get_source):
+            return None
+        try:
+            return marshal.loads(memoryview(data)[16:])
+        except (EOFError, ValueError, TypeError):
+            self.log.debug('Invalid compiled code in %s', cache_path)
+            return None
+
+    def is_valid(self, cache_path, source_stats, get_source):
+        """Checks whether the cache holds valid compiled code for the module
+        source, without loading the code.
+        """
+        try:
+            with open(cache_path, 'rb') as fh:
+                header = fh.read(16)
+        except OSError:
+            return False
+        return self.__valid_header__(header, source_stats, get_source)
+
+    def __valid_header__(self, data, source_stats, get_source):
+        if len(data) < 16 or data[:4] != MAGIC_NUMBER:
+            return False
+        flags = int.from_bytes(data[4:8], 'little')
+        if flags & _FLAG_HASH_BASED:
+            return data[8:16] == self.__source_hash__(get_source())
+        return data[8:12] == _pack_uint32(source_stats['mtime']) and \
+            data[12:16] == _pack_uint32(source_stats['size'])
+
+    def store(self, cache_path, code, source_stats, get_source):
+        """Stores the compiled code in the cache.
+
+        Errors while writing to the cache (such as a read-only cache directory)
+        are logged and otherwise ignored.
+        """
+        if sys.dont_write_bytecode or cache_path is None:
+            return
+        if self.validation == VALIDATE_HASH:
+            header = MAGIC_NUMBER + _pack_uint32(_FLAG_HASH_BASED | _FLAG_CHECK_SOURCE) + \
+                self.__source_hash__(get_source())
+        else:
+            header = MAGIC_NUMBER + _pack_uint32(0) + _pack_uint32(source_stats['mtime']) + \
+                _pack_uint32(source_stats['size'])
+        self.write(cache_path, header + marshal.dumps(code))
+
+    def write(self, cache_path, data):
+        """Writes the data into the cache file atomically."""
+        tmp_path = '%s.%d.%d.tmp' % (cache_path, os.getpid(), threading.get_ident())
+        try:
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+            with open(tmp_path, 'wb') as fh:
+                fh.write(data)
+            os.replace(tmp_path, cache_path)
+        except OSError as e:
+            self.log.debug('Could not write compiled code %s: %s', cache_path, e)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+    @staticmethod
+    def __source_hash__(source):
+        if isinstance(source, str):
+            source = source.encode('utf-8')
+        return source_hash(source)
+
+    def __str__(self):
+        return 'BytecodeCache[%s, %s]' % (self.cache_dir, self.validation)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+def _compile_into_cache(cache_dir, validation, cache_path, source, origin, source_stats):
+    """Compiles one module source and stores the code in the cache. Runs in the
+    worker processes of precompile_plugins.
+
+    Returns None on success, or the error message if the source could not be
+    compiled.
+    """
+    try:
+        code = compile(source, origin, 'exec', dont_inherit=True)
+    except (SyntaxError, ValueError) as e:
+        return str(e)
+    BytecodeCache(cache_dir, validation).store(cache_path, code, source_stats, lambda: source)
+    return None
+
+
+def _source_reader(plugin, resource_path):
+    """Returns a function that reads the module source from the plugin once,
+    on the first call.
+    """
+    source = []
+
+    def get_source():
+        if not source:
+            source.append(plugin.read_code(resource_path))
+        return source[0]
+    return get_source
+
+
+def precompile_plugins(cache, plugin_containers, max_workers=None, executor=None):
+    """Compiles the python sources of the plugins into the bytecode cache ahead
+    of time, so the first import of each module finds the compiled code in the
+    cache.
+
+    The sources are read through the plugin resources (see
+    termite.plugins.support.PluginResource.walk_resources) in this process and
+    compiled in parallel on a pool of max_workers processes. The sources that
+    already have valid compiled code in the cache are skipped, and are not read
+    at all when the code is validated by the source timestamp. An executor may
+    be given instead of the pool, in which case it is not shut down.
+
+    Returns a dictionary with the number of 'compiled', 'fresh' (skipped) and
+    'failed' sources.
+    """
+    result = {'compiled': 0, 'fresh': 0, 'failed': 0}
+    if sys.dont_write_bytecode:
+        return result
+    jobs = []
+    for container in plugin_containers:
+        plugin = container.plugin
+        for resource_path in plugin.walk_resources():
+            if not resource_path.endswith('.py'):
+                continue
+            cache_path = cache.cache_path(container.plugin_id, container.version, resource_path)
+            if cache_path is None:
+                return result
+            # the source is read only if the cached code is validated by the
+            # source hash, or has to be compiled again
+            get_source = _source_reader(plugin, resource_path)
+            try:
+                stats = plugin.resource_stats(resource_path)
+                if cache.is_valid(cache_path, stats, get_source):
+                    result['fresh'] += 1
+                    continue
+                source = get_source()
+            except Exception as e:
+                cache.log.debug('Cannot read %s from %s: %s', resource_path, container.plugin_id, e)
+                result['failed'] += 1
+                continue
+            jobs.append((cache_path, source, plugin.get_path(resource_path), stats))
+    if not jobs:
+        return result
+    own_executor = executor is None
+    if own_executor:
+        executor = ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        futures = [executor.submit(_compile_into_cache, cache.cache_dir, cache.validation, *job) for job in jobs]
+        for job, future in zip(jobs, futures):
+            error = future.result()
+            if error is None:
+                result['compiled'] += 1
+            else:
+                cache.log.warning('Cannot compile %s: %s', job[2], error)
+                result['failed'] += 1
+    finally:
+        if own_executor:
+            executor.shutdown()
+    return result
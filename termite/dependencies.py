@@ -17,7 +17,11 @@
 __author__ = 'pavle'
 
 
+from contextlib import contextmanager
+import inspect
 import logging
+from weakref import WeakSet
+from termite.instrumentation import DEFAULT_BUCKETS, ServiceInstrumentation
 
 
 class Markable:
@@ -413,16 +417,70 @@ class PluginDependenciesManager:
     def remove_dependency(self, dep_name):
         pass
     
+class ServiceUnavailableException(Exception):
+    pass
+
+
 class ServiceDependency():
 
-    def __init__(self, service_name, depends_on, factory=None):
-        pass
+    def __init__(self, service_name, depends_on, factory=None, owner=None):
+        self.name = service_name
+        self.dependencies = depends_on
+        self.dependants = WeakSet()
+        self.factory = factory
+        self.owner = owner
+        self.interfaces = ()
+        self.tags = frozenset()
+        self.properties = {}
+        self.ref = None
+        self.available = False
+        self.references = WeakSet()
+        self.instrumentation = None
+        self.proxy = None
+
+    def instance(self):
+        """Returns the service instance as handed out to the consumers - to the
+        factories of the dependants, the locators, the queries and
+        find_services.
+
+        With instrumentation, the consumers get a ServiceReference bound to the
+        instance (the same one for all of them), so their calls are recorded. A
+        service that is a plain function is wrapped instead, and the values of
+        the builtin types are handed out as they are.
+        """
+        if self.proxy is None:
+            ref = self.ref
+            if self.instrumentation is None or ref is None:
+                return ref
+            if inspect.isroutine(ref):
+                self.proxy = self.instrumentation.wrap(self.name, '__call__', ref)
+            elif type(ref).__module__ == 'builtins':
+                return ref
+            else:
+                self.proxy = ServiceReference(self.name, ref, self.instrumentation)
+        return self.proxy
+
+    def instrument(self, instrumentation):
+        """Sets the instrumentation for this service and all references to it."""
+        self.instrumentation = instrumentation
+        if isinstance(self.proxy, ServiceReference):
+            self.proxy.__instrument__(instrumentation)
+        else:
+            self.proxy = None
+        for reference in self.references:
+            reference.__instrument__(instrumentation)
 
     def make_available(self):
         if not (self.ref or self.factory):
             raise Exception('Service instance nor the factory method defined')
         if not self.ref:
             self.ref = self.make_service_instance()
+        self.available = True
+
+    def make_unavailable(self):
+        self.ref = None
+        self.proxy = None
+        self.available = False
 
     def make_service_instance(self):
         if not self.factory:
@@ -431,80 +489,727 @@ class ServiceDependency():
         return self.factory(*args)
 
     def get_dependencies(self):
-        return [d.ref for d in self.dependencies]
+        return [d.instance() for d in self.dependencies]
+
+    def bind_references(self):
+        """Binds all references held for this service to the current service
+        instance. The cost is proportional to the number of reference holders.
+        """
+        for reference in list(self.references):
+            reference.__bind__(self.ref)
+
+    def invalidate_references(self):
+        for reference in list(self.references):
+            reference.__invalidate__()
+
+    def in_use(self):
+        """Whether this service is still needed by someone - a registered
+        factory, an available instance, a live dependant or a live reference.
+        """
+        return bool(self.factory or self.available or len(self.dependants) or len(self.references))
+
+
+class ServiceReference:
+    """Reference to a service bound directly to the service instance.
+
+    The reference is obtained from the ServiceContext (see
+    ServiceContext.bind) and is held by the consumer of the service for as long
+    as it needs it. Unlike looking up the service by name in the context on every
+    call, the reference resolves an attribute of the service instance only once
+    - the first time it is requested. The resolved attribute (usually a bound
+    method of the service instance) is then kept in the reference itself so any
+    subsequent call goes straight to the provider.
+
+    The consumer never re-resolves the service. When the service is replaced,
+    the ServiceContext rebinds the reference to the new instance; when the
+    service is removed, the reference is invalidated and any attempt to use it
+    raises a ServiceUnavailableException until the service becomes available
+    again.
+
+    If the reference carries a ServiceInstrumentation, the resolved methods are
+    wrapped once, at resolution time, to record the calls made through the
+    reference. Without instrumentation the reference keeps the bare bound
+    methods of the service instance.
+
+    Only the names listed in NATIVE_METHODS belong to the reference itself, all
+    other attributes are resolved on the service instance.
+    """
+
+    NATIVE_METHODS = ['__service_name__', '__target__', '__instrumentation__', '__bind__', '__invalidate__',
+                      '__instrument__', '__available__']
+
+    def __init__(self, name, target=None, instrumentation=None):
+        """Creates new reference to the service with the given name.
+
+        target is the service instance, if one is already available.
+
+        instrumentation is the ServiceInstrumentation used to record the calls
+        made through this reference, or None if the calls are not recorded.
+        """
+        self.__service_name__ = name
+        self.__target__ = target
+        self.__instrumentation__ = instrumentation
+
+    def __getattr__(self, name):
+        # called only for attributes not yet resolved in this reference
+        if name in ServiceReference.NATIVE_METHODS:
+            raise AttributeError(name)
+        target = self.__target__
+        if target is None:
+            raise ServiceUnavailableException('Service %s is not available' % self.__service_name__)
+        attr = getattr(target, name)
+        if callable(attr):
+            instrumentation = self.__instrumentation__
+            if instrumentation is not None:
+                attr = instrumentation.wrap(self.__service_name__, name, attr)
+            self.__dict__[name] = attr
+        return attr
+
+    def __bind__(self, target):
+        """Binds this reference to a new service instance.
+
+        Any attributes resolved from the previous instance are dropped.
+        """
+        name = self.__service_name__
+        instrumentation = self.__instrumentation__
+        self.__dict__.clear()
+        self.__service_name__ = name
+        self.__target__ = target
+        self.__instrumentation__ = instrumentation
+
+    def __invalidate__(self):
+        """Invalidates this reference. The reference will not be usable until
+        bound to a service instance again.
+        """
+        self.__bind__(None)
+
+    def __instrument__(self, instrumentation):
+        """Sets the instrumentation for this reference (None to turn it off).
+
+        The methods already resolved through this reference are dropped, so
+        they will be resolved and wrapped again on the next call.
+        """
+        self.__instrumentation__ = instrumentation
+        self.__bind__(self.__target__)
+
+    def __available__(self):
+        return self.__target__ is not None
+
+    def __call__(self, *args, **kwargs):
+        # a callable service; resolved (and instrumented) like any other method
+        call = self.__dict__.get('__call__')
+        if call is None:
+            call = self.__getattr__('__call__')
+        return call(*args, **kwargs)
+
+    def __str__(self):
+        return 'ServiceReference[%s -> %s]' % (self.__service_name__, self.__target__)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class ServiceLocator:
+    """Tracks the availability of a set of services on behalf of a consumer.
+
+    Created by ServiceContext.locate_service and ServiceContext.locate_services.
+    The locator is notified by the context once per transaction with the net
+    result of all availability and removal events of that transaction, so the
+    consumer callbacks are invoked at most once per transaction regardless of
+    how many of the located services came and went during it.
+    """
+
+    def __init__(self, names, on_all_available=None, on_removed=None, on_all_removed=None, owner=None):
+        self.names = names
+        self.owner = owner
+        self.on_all_available = on_all_available
+        self.on_removed = on_removed
+        self.on_all_removed = on_all_removed
+        self.all_available = False
+        self.active = False
+        self.log = logging.getLogger('dependencies.ServiceLocator')
+
+    def deliver(self, services, removed):
+        """Delivers the outcome of a transaction to the consumer.
+
+        services is the map of services (name => ServiceDependency) of the
+        context.
+
+        removed is a map name => instance of the services removed during the
+        transaction. If a service was removed and made available again in the
+        same transaction, the instance is the one that was removed.
+        """
+        deps = [services.get(name) for name in self.names]
+        now_available = [dep is not None and dep.available for dep in deps]
+        was_available = self.all_available
+        if was_available:
+            for name in self.names:
+                if name in removed:
+                    self.__call__(self.on_removed, name, removed[name])
+        self.all_available = all(now_available)
+        # on every transition back to all available, not only the first one: a
+        # consumer that lost some of the services waits for them to come back
+        if self.all_available and (not was_available or self.__any_removed__(removed)):
+            self.active = True
+            self.__call__(self.on_all_available, *[dep.instance() for dep in deps])
+        elif self.active and not any(now_available):
+            self.active = False
+            self.__call__(self.on_all_removed)
+
+    def __any_removed__(self, removed):
+        for name in self.names:
+            if name in removed:
+                return True
+        return False
+
+    def __call__(self, callback, *args):
+        if not callback:
+            return
+        try:
+            callback(*args)
+        except Exception as e:
+            self.log.exception('Error in service callback %s: %s', callback, e)
+
+    def __str__(self):
+        return 'ServiceLocator%s' % str(self.names)
+
+    def __repr__(self):
+        return self.__str__()
+
+
+class ServiceQuery:
+    """Live query over the available services in a ServiceContext.
+
+    The query selects the services that implement an interface, carry all of
+    the given tags and have the given properties. An additional filter callable
+    may be given; it is called with the properties of the service and should
+    return True if the service is to be selected.
+
+    Once created (see ServiceContext.query) the query is kept up to date by the
+    context - the services that become available and match the query are added
+    to it, and removed services are removed from it. Only the queries that
+    could possibly match a service (by its interfaces and tags) are checked
+    when the service comes or goes.
+
+    The context does not keep the query alive - once the query is no longer
+    referenced it stops being updated.
+    """
+
+    def __init__(self, interface=None, tags=None, properties=None, filter=None, on_added=None, on_removed=None):
+        self.interface = interface
+        self.tags = frozenset(tags or ())
+        self.properties = properties or {}
+        self.filter = filter
+        self.on_added = on_added
+        self.on_removed = on_removed
+        self.matches = {}
+        self.log = logging.getLogger('dependencies.ServiceQuery')
+
+    def index_keys(self):
+        """Returns the index keys under which this query is registered in the
+        context.
+
+        The most selective criteria are used: a query by interface is registered
+        only under the interface, otherwise under one of the tags. A query
+        without interface or tags must be checked against every service.
+        """
+        if self.interface is not None:
+            return [('interface', self.interface)]
+        for tag in self.tags:
+            return [('tag', tag)]
+        return [None]
+
+    def matches_service(self, srv_dep):
+        if self.interface is not None and self.interface not in srv_dep.interfaces:
+            return False
+        if not self.tags <= srv_dep.tags:
+            return False
+        for key, value in self.properties.items():
+            if srv_dep.properties.get(key) != value:
+                return False
+        if self.filter is not None and not self.filter(srv_dep.properties):
+            return False
+        return True
+
+    def service_available(self, srv_dep):
+        if self.matches_service(srv_dep):
+            instance = srv_dep.instance()
+            self.matches[srv_dep.name] = instance
+            self.__notify__(self.on_added, srv_dep.name, instance)
+
+    def service_removed(self, name):
+        instance = self.matches.pop(name, None)
+        if instance is not None:
+            self.__notify__(self.on_removed, name, instance)
+
+    def __notify__(self, callback, name, instance):
+        if not callback:
+            return
+        try:
+            callback(name, instance)
+        except Exception as e:
+            self.log.exception('Error in query callback %s: %s', callback, e)
+
+    def services(self):
+        """Returns the matching services as dictionary name => instance."""
+        return dict(self.matches)
+
+    def __len__(self):
+        return len(self.matches)
+
+    def __iter__(self):
+        return iter(list(self.matches.values()))
+
+    def __contains__(self, name):
+        return name in self.matches
+
+    def __str__(self):
+        return 'ServiceQuery[interface=%s, tags=%s, properties=%s]' % (self.interface, list(self.tags),
+                                                                      self.properties)
+
+    def __repr__(self):
+        return self.__str__()
 
 
 class ServiceContext:
     
-    def __init__(self):
+    def __init__(self, instrumentation=None):
         self.services = {}
-        self.avail_listeners = {}
-        self.remove_listeners = {}
+        self.owners = {}
+        self.by_interface = {}
+        self.by_tag = {}
+        self.queries = {}
+        self.instrumentation = instrumentation
+        self.locators = {}
+        self.owned_locators = {}
+        self.transaction_depth = 0
+        self.pending_available = {}
+        self.pending_removed = {}
+        self.pending_locators = []
     
-    def __create_service_dependency__(self, srvc_name, dependencies, factory):
+    def __create_service_dependency__(self, srvc_name, dependencies, factory, owner=None):
         deps = []
         srvc_dependency = self.__get_service_dep__(srvc_name, factory)
+        self.__set_owner__(srvc_dependency, owner)
 
         for dep in dependencies:
             sd = self.__get_service_dep__(dep)
             deps.append(sd)
-            if srvc_dependency not in sd.dependants:
-                sd.dependants.append(srvc_dependency)
-        srvc_dependency.dependencies = dependencies
+            sd.dependants.add(srvc_dependency)
+        for old_dep in srvc_dependency.dependencies:
+            if old_dep not in deps:
+                old_dep.dependants.discard(srvc_dependency)
+        srvc_dependency.dependencies = deps
         return srvc_dependency
 
+    def __set_owner__(self, srv_dep, owner):
+        if srv_dep.owner is not None:
+            owned = self.owners.get(srv_dep.owner)
+            if owned is not None:
+                owned.discard(srv_dep.name)
+                if not owned:
+                    del self.owners[srv_dep.owner]
+        srv_dep.owner = owner
+        if owner is not None:
+            self.owners.setdefault(owner, set()).add(srv_dep.name)
+
     def __get_service_dep__(self, name, factory=None):
         dep = self.services.get(name)
         if not dep:
             dep = ServiceDependency(service_name=name, depends_on=[], factory=factory)
+            dep.instrumentation = self.instrumentation
             self.services[name] = dep
-        if not dep.factory:
+        if factory:
             dep.factory = factory
         return dep
 
-    def service(self, name, dependencies, factory):
-        srv_dep = self.__create_service_dependency__(name, dependencies, factory)
-        if not self.services.get(name):
-            self.services[name] = srv_dep
-        self.__check_available__(srv_dep)
+    def service(self, name, dependencies, factory, owner=None, interfaces=None, tags=None, properties=None):
+        """Registers a service with this context.
+
+        name is the name of the service.
+
+        dependencies is a list of names of the services this service depends
+        on. The service will be created once all of them become available.
+
+        factory is a callable that creates the service instance. It is called
+        with the instances of the dependencies as arguments.
+
+        owner identifies who registered the service (usually the ID of the
+        plugin). All services of an owner can be removed at once with
+        remove_services.
+
+        interfaces is a list of the interfaces (types or names) the service
+        implements, tags is a list of tags for the service and properties is a
+        dictionary of additional service properties. The available services
+        can be looked up by these (see find_services and query).
+
+        If a service with the same name is already available, it is replaced
+        by the new one and all references bound to it are rebound to the new
+        service instance. The services depending on it are recreated as well.
+        """
+        with self.transaction():
+            srv_dep = self.services.get(name)
+            if srv_dep is not None and srv_dep.available:
+                self.__make_unavailable__(srv_dep)
+            srv_dep = self.__create_service_dependency__(name, dependencies, factory, owner)
+            srv_dep.interfaces = tuple(interfaces or ())
+            srv_dep.tags = frozenset(tags or ())
+            srv_dep.properties = dict(properties or {})
+            self.__check_available__(srv_dep)
+
+    def bind(self, name):
+        """Returns a ServiceReference bound directly to the service with the
+        given name.
+
+        The service does not have to be available at the time of the call. The
+        reference is bound once the service becomes available and is rebound or
+        invalidated by this context whenever the service is replaced or removed.
+        """
+        srv_dep = self.__get_service_dep__(name)
+        reference = ServiceReference(name, srv_dep.ref if srv_dep.available else None, self.instrumentation)
+        srv_dep.references.add(reference)
+        return reference
+
+    def enable_instrumentation(self, bounds=DEFAULT_BUCKETS):
+        """Turns on the recording of the calls made to the services of this
+        context - through the references bound by the context and the instances
+        handed out to the consumers (see ServiceDependency.instance).
+
+        bounds are the upper bounds (in nanoseconds) of the latency histogram
+        buckets.
+
+        Returns the ServiceInstrumentation holding the recorded statistics.
+        """
+        if self.instrumentation is None:
+            self.__set_instrumentation__(ServiceInstrumentation(bounds))
+        return self.instrumentation
+
+    def disable_instrumentation(self):
+        """Turns off the recording of the calls. The references drop the
+        instrumented methods, so the calls go straight to the service instances
+        again. The consumers that got a recording reference keep it, but it
+        no longer records.
+        """
+        self.__set_instrumentation__(None)
+
+    def __set_instrumentation__(self, instrumentation):
+        self.instrumentation = instrumentation
+        for srv_dep in self.services.values():
+            srv_dep.instrument(instrumentation)
+
+    def service_stats(self):
+        """Returns a snapshot of the call statistics of the services (see
+        termite.instrumentation.ServiceInstrumentation.snapshot).
+
+        If the instrumentation is not enabled, an empty dictionary is returned.
+        """
+        if self.instrumentation is None:
+            return {}
+        return self.instrumentation.snapshot()
+
+    def begin(self):
+        """Begins a transaction on this context.
+
+        While a transaction is open, the availability and removal events are
+        collected instead of being delivered to the service locators. The
+        events are delivered, coalesced, once the outermost transaction is
+        committed. Transactions may be nested.
+        """
+        self.transaction_depth += 1
+
+    def commit(self):
+        """Commits the current transaction.
+
+        If this is the outermost transaction, every locator interested in any
+        of the services that came or went during the transaction is notified
+        exactly once.
+        """
+        if self.transaction_depth <= 0:
+            raise Exception('No transaction to commit')
+        self.transaction_depth -= 1
+        if self.transaction_depth:
+            return
+        removed = self.pending_removed
+        touched = list(self.pending_available) + [n for n in removed if n not in self.pending_available]
+        candidates = self.pending_locators
+        for name in touched:
+            candidates = candidates + self.locators.get(name, [])
+        self.pending_available = {}
+        self.pending_removed = {}
+        self.pending_locators = []
+
+        notified = set()
+        for locator in candidates:
+            if id(locator) not in notified:
+                notified.add(id(locator))
+                locator.deliver(self.services, removed)
+
+    @contextmanager
+    def transaction(self):
+        """Context manager for a transaction on this context (see begin and
+        commit). The transaction is committed even if an error is raised, so
+        the events that did happen are not lost.
+        """
+        self.begin()
+        try:
+            yield self
+        finally:
+            self.commit()
 
     def __triger_available__(self, name, instance):
-        pass
+        self.begin()
+        self.pending_available[name] = instance
+        self.commit()
 
     def __triger_removed__(self, name, instance):
-        pass
+        self.begin()
+        if name not in self.pending_removed:
+            self.pending_removed[name] = instance
+        self.commit()
 
     def __check_available__(self, srv_dep):
+        if srv_dep.available or not srv_dep.factory:
+            return
         all_available = True
         for dep in srv_dep.dependencies:
             if not dep.available:
                 all_available = False
                 break
         if all_available:
-            # notify the listeners
             # create the service itself
-            srv_dep.make_service_instance()
-            self.__triger_available__(srv_dep.name, srv_dep.ref)
+            srv_dep.make_available()
+            srv_dep.bind_references()
+            self.__index_service__(srv_dep)
+            # notify the listeners
+            self.__triger_available__(srv_dep.name, srv_dep.instance())
 
             # notify dependants
-            for dpd in srv_dep.dependants:
+            for dpd in list(srv_dep.dependants):
                 self.__check_available__(dpd)
     
-    def locate_service(self, name, on_available, on_removed):
-        svc_dep = self.services.get(name)
-        if svc_dep:
-            if svc_dep.available:
-                # call immediate
-                pass
-            else:
-                # register for later
-                pass
-            # register on_remove
+    def locate_service(self, name, on_available, on_removed, owner=None):
+        """Locates a single service.
+
+        on_available is called with the service instance once the service is
+        available (immediately, if it is already available).
+
+        on_removed is called with the removed instance once the service is
+        removed.
+
+        Returns the ServiceLocator which can be passed to unlocate to stop
+        receiving notifications.
+        """
+        removed = (lambda name, instance: on_removed(instance)) if on_removed else None
+        return self.locate_services([name], on_available, removed, None, owner)
+
+    def locate_services(self, services, on_all_available, on_removed, on_all_removed, owner=None):
+        """Locates a set of services.
+
+        services is a list of names of the services to locate.
+
+        on_all_available is called once all of the services are available, with
+        the service instances as arguments in the order of the names in
+        services. It is called once per transaction (see begin), no matter how
+        many of the services became available during that transaction.
+
+        on_removed is called with the name and the instance of a service that
+        was removed after all of the services had been available.
+
+        on_all_removed is called once none of the services is available any
+        more.
+
+        owner identifies who located the services (usually the ID of the
+        plugin). The locators of an owner are dropped by remove_services.
+
+        Returns the ServiceLocator which can be passed to unlocate to stop
+        receiving notifications.
+        """
+        locator = ServiceLocator(list(services), on_all_available, on_removed, on_all_removed, owner)
+        for name in locator.names:
+            self.locators.setdefault(name, []).append(locator)
+        if owner is not None:
+            self.owned_locators.setdefault(owner, []).append(locator)
+        self.begin()
+        self.pending_locators.append(locator)
+        self.commit()
+        return locator
+
+    def unlocate(self, locator):
+        for name in locator.names:
+            locators = self.locators.get(name)
+            if locators and locator in locators:
+                locators.remove(locator)
+                if not locators:
+                    del self.locators[name]
+        if locator in self.pending_locators:
+            self.pending_locators.remove(locator)
+        owned = self.owned_locators.get(locator.owner)
+        if owned and locator in owned:
+            owned.remove(locator)
+            if not owned:
+                del self.owned_locators[locator.owner]
+
+    def remove_service(self, name):
+        """Removes the service with the given name from this context.
+
+        All references bound to the service are invalidated. The services that
+        depend on it (directly or transitively) become unavailable as well; they
+        remain registered and will be recreated once the removed service is
+        registered again.
+
+        If the service is no longer needed by anyone, it is released from this
+        context.
+        """
+        srv_dep = self.services.get(name)
+        if not srv_dep:
+            return
+        with self.transaction():
+            self.__make_unavailable__(srv_dep)
+        srv_dep.factory = None
+        self.__set_owner__(srv_dep, None)
+        self.__release__(srv_dep)
+
+    def remove_services(self, owner):
+        """Removes all services registered by the given owner (see
+        remove_service) and drops the locators of the owner (see unlocate), so
+        the owner callbacks are not called any more.
+        """
+        for locator in list(self.owned_locators.get(owner, ())):
+            self.unlocate(locator)
+            for name in locator.names:
+                srv_dep = self.services.get(name)
+                if srv_dep is not None and srv_dep.factory is None:
+                    self.__release__(srv_dep)
+        names = self.owners.get(owner)
+        if not names:
+            return
+        with self.transaction():
+            for name in list(names):
+                self.remove_service(name)
+
+    def __make_unavailable__(self, srv_dep):
+        if not srv_dep.available:
+            return
+        instance = srv_dep.instance()
+        self.__unindex_service__(srv_dep)
+        srv_dep.make_unavailable()
+        srv_dep.invalidate_references()
+        self.__triger_removed__(srv_dep.name, instance)
+        for dpd in list(srv_dep.dependants):
+            self.__make_unavailable__(dpd)
+
+    def __release__(self, srv_dep):
+        if srv_dep.in_use() or self.locators.get(srv_dep.name):
+            return
+        if self.services.get(srv_dep.name) is srv_dep:
+            del self.services[srv_dep.name]
+        dependencies = srv_dep.dependencies
+        srv_dep.dependencies = []
+        for dep in dependencies:
+            dep.dependants.discard(srv_dep)
+            self.__release__(dep)
+
+    def find_services(self, interface=None, tag=None):
+        """Finds the available services implementing the given interface and/or
+        tagged with the given tag.
+
+        The lookup is done in the inverted indexes of the context, so the cost
+        is proportional to the number of matching services.
+
+        Returns a dictionary name => service instance.
+        """
+        if interface is None and tag is None:
+            names = [name for name, srv_dep in self.services.items() if srv_dep.available]
+        elif interface is None:
+            names = self.by_tag.get(tag, ())
+        elif tag is None:
+            names = self.by_interface.get(interface, ())
         else:
-            pass
-    
+            by_interface = self.by_interface.get(interface, set())
+            by_tag = self.by_tag.get(tag, set())
+            names = by_interface & by_tag if len(by_interface) < len(by_tag) else by_tag & by_interface
+        return {name: self.services[name].instance() for name in names}
+
+    def query(self, interface=None, tags=None, properties=None, filter=None, on_added=None, on_removed=None):
+        """Creates a live query over the available services (see ServiceQuery).
+
+        The query is populated with the currently available matching services
+        and is kept up to date as the services come and go.
+
+        on_added and on_removed are optional callbacks called with the service
+        name and instance when a service is added to or removed from the query.
+        """
+        query = ServiceQuery(interface, tags, properties, filter, on_added, on_removed)
+        for key in query.index_keys():
+            self.queries.setdefault(key, WeakSet()).add(query)
+        if interface is not None:
+            candidates = self.by_interface.get(interface, ())
+        elif query.tags:
+            candidates = self.by_tag.get(next(iter(query.tags)), ())
+        else:
+            candidates = [name for name, srv_dep in self.services.items() if srv_dep.available]
+        for name in list(candidates):
+            query.service_available(self.services[name])
+        return query
+
+    def __affected_queries__(self, srv_dep):
+        keys = [None]
+        keys.extend(('interface', interface) for interface in srv_dep.interfaces)
+        keys.extend(('tag', tag) for tag in srv_dep.tags)
+        queries = []
+        for key in keys:
+            registered = self.queries.get(key)
+            if registered:
+                queries.extend(registered)
+        return queries
+
+    def __index_service__(self, srv_dep):
+        for interface in srv_dep.interfaces:
+            self.by_interface.setdefault(interface, set()).add(srv_dep.name)
+        for tag in srv_dep.tags:
+            self.by_tag.setdefault(tag, set()).add(srv_dep.name)
+        for query in self.__affected_queries__(srv_dep):
+            query.service_available(srv_dep)
+
+    def __unindex_service__(self, srv_dep):
+        for index, keys in ((self.by_interface, srv_dep.interfaces), (self.by_tag, srv_dep.tags)):
+            for key in keys:
+                names = index.get(key)
+                if names is not None:
+                    names.discard(srv_dep.name)
+                    if not names:
+                        del index[key]
+        for query in self.__affected_queries__(srv_dep):
+            query.service_removed(srv_dep.name)
+
+    def for_owner(self, owner):
+        """Returns a view of this context that registers the services on behalf
+        of the given owner.
+        """
+        return OwnedServiceContext(self, owner)
+
+
+class OwnedServiceContext:
+    """View of a ServiceContext bound to a single owner.
+
+    The services registered and the locators created through this view belong
+    to the owner. Everything else is delegated to the underlying context.
+    """
+
+    def __init__(self, context, owner):
+        self.context = context
+        self.owner = owner
+
+    def service(self, name, dependencies, factory, interfaces=None, tags=None, properties=None):
+        return self.context.service(name, dependencies, factory, owner=self.owner, interfaces=interfaces,
+                                    tags=tags, properties=properties)
+
+    def locate_service(self, name, on_available, on_removed):
+        return self.context.locate_service(name, on_available, on_removed, owner=self.owner)
+
     def locate_services(self, services, on_all_available, on_removed, on_all_removed):
-        pass
-    
-    def remove_service(self, name):
-        pass
+        return self.context.locate_services(services, on_all_available, on_removed, on_all_removed,
+                                            owner=self.owner)
+
+    def __getattr__(self, name):
+        return getattr(self.context, name)
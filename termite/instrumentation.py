@@ -0,0 +1,170 @@
+#    This file is part of Termite Plugins Platform
+#    Copyright (C) 2014 Pavle Jonoski
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Call instrumentation for the services on the platform.
+
+The instrumentation records the number of calls, the number of errors and the
+call latency for every service and every method of a service. The latencies
+are kept in fixed-bucket histograms which are allocated once, when a method is
+first resolved, so recording a call only increments counters.
+"""
+
+from bisect import bisect_left
+from time import perf_counter_ns
+
+__author__ = 'pavle'
+
+
+DEFAULT_BUCKETS = (1000, 5000, 10000, 50000, 100000, 500000,
+                   1000000, 5000000, 10000000, 50000000, 100000000, 500000000,
+                   1000000000)
+"""Default upper bounds (in nanoseconds) of the latency histogram buckets.
+
+The last bucket of the histogram is unbounded and holds everything slower than
+the last bound.
+"""
+
+
+class Histogram:
+    """Histogram with fixed bucket bounds.
+
+    The bucket counters are preallocated when the histogram is created.
+    """
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0
+
+    def record(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.total += value
+
+    def merge(self, other):
+        for i, count in enumerate(other.counts):
+            self.counts[i] += count
+        self.total += other.total
+
+    def snapshot(self):
+        return {
+            'bounds_ns': list(self.bounds),
+            'counts': list(self.counts),
+            'total_ns': self.total
+        }
+
+
+class CallStats:
+    """Call statistics: number of calls, number of errors and a latency
+    histogram.
+    """
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.calls = 0
+        self.errors = 0
+        self.latency = Histogram(bounds)
+
+    def record(self, elapsed):
+        self.calls += 1
+        self.latency.record(elapsed)
+
+    def merge(self, other):
+        self.calls += other.calls
+        self.errors += other.errors
+        self.latency.merge(other.latency)
+
+    def snapshot(self):
+        return {
+            'calls': self.calls,
+            'errors': self.errors,
+            'latency': self.latency.snapshot()
+        }
+
+
+class ServiceInstrumentation:
+    """Keeps the call statistics for the services in a ServiceContext.
+
+    The statistics are kept per service and per method. The instrumentation
+    wraps the methods of the service instances (see wrap). The wrapper is created
+    once per resolved method - not per call - and records the call into
+    statistics that were allocated at the time the wrapper was created.
+
+    The counters are updated without locking, so under heavy concurrent use some
+    increments may be lost. This is an accepted trade-off for keeping the
+    overhead of the instrumentation low.
+    """
+
+    def __init__(self, bounds=DEFAULT_BUCKETS):
+        self.bounds = tuple(bounds)
+        self.stats = {}
+
+    def method_stats(self, service_name, method_name):
+        """Returns the CallStats for the method of a service, creating them if
+        needed.
+        """
+        service_stats = self.stats.get(service_name)
+        if service_stats is None:
+            service_stats = self.stats[service_name] = {}
+        stats = service_stats.get(method_name)
+        if stats is None:
+            stats = service_stats[method_name] = CallStats(self.bounds)
+        return stats
+
+    def wrap(self, service_name, method_name, method):
+        """Wraps a method of a service instance so that each call to it is
+        recorded.
+        """
+        stats = self.method_stats(service_name, method_name)
+        record = stats.record
+
+        def instrumented(*args, **kwargs):
+            start = perf_counter_ns()
+            try:
+                return method(*args, **kwargs)
+            except BaseException:
+                stats.errors += 1
+                raise
+            finally:
+                record(perf_counter_ns() - start)
+        instrumented.__wrapped__ = method
+        return instrumented
+
+    def snapshot(self):
+        """Returns a snapshot of the collected statistics.
+
+        The snapshot is a dictionary: service name => service statistics. The
+        statistics of each service contain the totals for the service (calls,
+        errors, latency) and the statistics of each method in 'methods'.
+        """
+        snapshot = {}
+        for service_name, methods in list(self.stats.items()):
+            totals = CallStats(self.bounds)
+            methods_snapshot = {}
+            for method_name, stats in list(methods.items()):
+                totals.merge(stats)
+                methods_snapshot[method_name] = stats.snapshot()
+            service_snapshot = totals.snapshot()
+            service_snapshot['methods'] = methods_snapshot
+            snapshot[service_name] = service_snapshot
+        return snapshot
+
+    def reset(self):
+        """Resets all counters to zero, keeping the allocated statistics."""
+        for methods in self.stats.values():
+            for stats in methods.values():
+                stats.calls = 0
+                stats.errors = 0
+                stats.latency.counts[:] = [0] * len(stats.latency.counts)
+                stats.latency.total = 0
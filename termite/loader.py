@@ -17,35 +17,72 @@
 
 # base PEP-302 finder
 from abc import abstractclassmethod, abstractmethod
+from copy import copy
 from importlib.abc import SourceLoader
+from importlib.machinery import ModuleSpec
+from importlib.util import LazyLoader, source_hash, spec_from_loader
+import builtins
 import re
-import threading
 import sys
+import threading
 import os.path
+from contextvars import ContextVar, copy_context
+from termite.plugins.support import normalize_version_string
+from termite.profiling import PHASE_COMPILE, PHASE_READ
 from termite.resources import ProtocolHandler
 import logging
 
-__local_context = threading.local()
 __original_import__ = __import__
 
 # constants
 IMPORT_CONTEXT = "termite.IMPORT_CONTEXT"
 
+# The context values are kept in context variables, so they follow the flow of
+# execution: each asyncio task gets a copy of the context of the code that
+# created it. Use bind_to_context or submit_with_context to carry the context
+# over to other threads.
+__context_vars = {IMPORT_CONTEXT: ContextVar(IMPORT_CONTEXT, default=None)}
+__import_context = __context_vars[IMPORT_CONTEXT]
+
+
+def __context_var(key):
+    var = __context_vars.get(key)
+    if var is None:
+        var = __context_vars.setdefault(key, ContextVar(key, default=None))
+    return var
+
 
 def put_to_context(key, value):
-    try:
-        tl_values = __local_context.tl_values
-    except AttributeError:
-        __local_context.tl_values = {}
-        tl_values = __local_context.tl_values
-    tl_values[key] = value
+    __context_var(key).set(value)
 
 
 def get_from_context(key):
-    try:
-        return __local_context.tl_values[key]
-    except (KeyError, AttributeError):
+    var = __context_vars.get(key)
+    if var is None:
         return None
+    return var.get()
+
+
+def bind_to_context(fn):
+    """Binds the callable to a copy of the current context (including the
+    import context).
+
+    The returned callable runs fn in the captured context, regardless of the
+    thread it is called from. Each call runs in its own copy of the captured
+    context, so the callable may be called concurrently.
+    """
+    context = copy_context()
+
+    def run_in_context(*args, **kwargs):
+        return context.copy().run(fn, *args, **kwargs)
+    return run_in_context
+
+
+def submit_with_context(executor, fn, *args, **kwargs):
+    """Submits fn to a concurrent.futures executor so that it runs in a copy of
+    the current context.
+    """
+    return executor.submit(copy_context().run, fn, *args, **kwargs)
 
 
 def extend(dict_a, dict_b):
@@ -53,41 +90,171 @@ def extend(dict_a, dict_b):
         dict_a[k] = v
 
 
-def create_context_sensitive_import(context):
+def create_context_sensitive_import(context, resolve_import=None):
     """ Creates context sensitive import function to be used as replacement for the __import__ builtin.
     :param context: the context to be set when calling __import__
+    :param resolve_import: optional callable called with the name of each absolutely imported module, before the
+    import. It should raise ImportError if the module may not be imported. It returns the versioned namespace from
+    which the module should be imported, or None to import the module by its name.
     :return: the replacement, context-setting import
     """
-    def context_sensitive_import(*args, **kwargs):
+    import_context = __import_context
+
+    def context_sensitive_import(name, globals=None, locals=None, fromlist=(), level=0):
         """ Context sensitive and setting import.
-        Sets a predefined context in thread local, just before calling and passing control to the Python's
-        builtin __import__
+        Sets a predefined context in the import context variable, just before calling and passing control to the
+        Python's builtin __import__. The variable is written only if it holds a different context.
         :return: the imported module
         """
-        put_to_context(IMPORT_CONTEXT, context)
-        return __original_import__(*args, **kwargs)
+        namespace = None
+        if resolve_import is not None and level == 0:
+            namespace = resolve_import(name)
+        if import_context.get() is not context:
+            import_context.set(context)
+        if namespace is not None:
+            module = __original_import__('%s.%s' % (namespace, name), globals, locals, fromlist, 0)
+            if fromlist:
+                return module
+            return sys.modules['%s.%s' % (namespace, name.partition('.')[0])]
+        return __original_import__(name, globals, locals, fromlist, level)
     return context_sensitive_import
 
 
 class BaseFinder:
+    """Base meta path finder that maps module names to loaders by name
+    patterns.
+
+    The finder may be used from many threads at once. The lookup path
+    (find_spec, find_module) takes no locks, except to record a name in the
+    negative cache on a miss; adding and removing loaders is serialized by the
+    finder lock. A miss is cached only if no loader was added or removed since
+    the lookup started (see generation), so a concurrent add_loader never
+    leaves its names cached as negative.
+    The import machinery itself holds a lock per module name while the module
+    is found and loaded, so different modules are loaded concurrently.
+
+    The names that do not belong to any loader are remembered in a negative
+    cache. When the cache is full, the older half of the names is dropped. The
+    hit and miss counters are not synchronized and are approximate under
+    concurrent use.
+    """
 
-    def __init__(self):
+    NEGATIVE_CACHE_SIZE = 4096
+
+    def __init__(self, negative_cache_size=NEGATIVE_CACHE_SIZE):
         self.loader_entries = []
+        self.patterns = PatternTrie()
+        self.negative_cache = {}
+        self.negative_cache_size = negative_cache_size
+        self.negative_hits = 0
+        self.negative_misses = 0
+        self.generation = 0
+        self.lock = threading.RLock()
         self.log = logging.getLogger('loader.BaseFinder')
 
-    def find_module(self, fullname, path=None):
+    def find_spec(self, fullname, path=None, target=None):
+        """Finds the module spec for the module (PEP-451).
+
+        The loaders that know how to build (and cache) the specs for their
+        modules provide a get_spec(fullname) method. For any other loader a
+        spec is created from the loader itself.
+        """
+        loader = self.find_module(fullname, path)
+        if loader is None:
+            return None
+        get_spec = getattr(loader, 'get_spec', None)
+        if get_spec is not None:
+            return get_spec(fullname)
+        return spec_from_loader(fullname, loader)
+
+    def invalidate_caches(self):
+        """Called by importlib.invalidate_caches. Drops the module specs cached
+        by the loaders of this finder.
+        """
         for entry in self.loader_entries:
-            if entry.matches(fullname):
-                return entry.loader
+            invalidate = getattr(entry.loader, 'invalidate_caches', None)
+            if invalidate is not None:
+                invalidate()
+
+    def find_module(self, fullname, path=None):
+        if fullname in self.negative_cache:
+            self.negative_hits += 1
+            return None
+        generation = self.generation
+        entry = self.patterns.lookup(fullname)
+        if entry:
+            return entry.loader
+        self.negative_misses += 1
+        self.__cache_negative__(fullname, generation)
         return None
 
+    def __cache_negative__(self, fullname, generation):
+        if self.negative_cache_size <= 0:
+            return
+        with self.lock:
+            if self.generation != generation:
+                # the loaders changed since the lookup, the miss may be stale
+                return
+            negative_cache = self.negative_cache
+            negative_cache[fullname] = None
+            if len(negative_cache) > self.negative_cache_size:
+                # replaced, not modified, so the concurrent lookups never see
+                # the cache being trimmed
+                keep = self.negative_cache_size // 2
+                self.negative_cache = dict.fromkeys(list(negative_cache)[-keep:] if keep else ())
+
+    def cache_info(self):
+        """Returns the statistics of the cache of names known not to belong to
+        any of the loaders of this finder.
+        """
+        lookups = self.negative_hits + self.negative_misses
+        return {
+            'hits': self.negative_hits,
+            'misses': self.negative_misses,
+            'size': len(self.negative_cache),
+            'maxsize': self.negative_cache_size,
+            'hit_rate': self.negative_hits / lookups if lookups else 0.0
+        }
+
     def add_loader(self, loader_entry):
+        with self.lock:
+            self.loader_entries.append(loader_entry)
+            self.patterns.add_entry(loader_entry)
+            self.generation += 1
+            self.__invalidate_negative__(loader_entry)
         self.log.debug('Added loader: %s', loader_entry)
-        self.loader_entries.append(loader_entry)
+
+    def __invalidate_negative__(self, loader_entry):
+        """Drops the names matched by the new loader entry from the negative
+        cache. The other cached names still do not belong to any loader.
+        """
+        if not self.negative_cache:
+            return
+        entry_patterns = PatternTrie()
+        entry_patterns.add_entry(loader_entry)
+        for name in list(self.negative_cache):
+            if entry_patterns.lookup(name):
+                self.negative_cache.pop(name, None)
+
+    def remove_loader(self, loader_entry):
+        # removing patterns cannot make a name belong to a loader, so the
+        # negative cache stays valid
+        with self.lock:
+            try:
+                self.loader_entries.remove(loader_entry)
+            except ValueError:
+                return
+            self.patterns.remove_entry(loader_entry)
+            self.generation += 1
+        self.log.debug('Removed loader: %s', loader_entry)
 
     def add_restricted_paths(self, path_patterns):
         self.add_loader(LoaderEntry(RestrictedEntryLoader(), path_patterns))
 
+    @staticmethod
+    def normalize_paths(path_patterns):
+        return [p.strip() for p in path_patterns or [] if p and p.strip()]
+
 
 def to_regex(path_entry):
     path_entry = path_entry.replace('.', '\\.').replace('*', '.*')
@@ -105,7 +272,8 @@ def to_patterns(path_patterns):
 class LoaderEntry:
 
     def __init__(self, loader, path_patterns):
-        self.path_patterns = to_patterns(path_patterns or [])
+        self.paths = list(path_patterns or [])
+        self.path_patterns = to_patterns(self.paths)
         self.loader = loader
 
     def matches(self, path):
@@ -116,21 +284,306 @@ class LoaderEntry:
     
     def __str__(self):
         return 'LoaderEntry[paths=(%s), loader=%s]' % \
-            (str(self.path_patterns), str(self.loader))
+            (str(self.paths), str(self.loader))
     
     def __repr__(self):
         return self.__str__()
 
+
+class PatternTrie:
+    """Prefix trie of the module name patterns of the loader entries.
+
+    The patterns are split into their dotted-name segments and stored in a trie,
+    so looking up the entry for a module name costs as many steps as there are
+    segments in the name, regardless of the number of registered patterns.
+
+    A pattern matches the module with the same name and all of its submodules:
+    "core.events" matches "core.events" and "core.events.handlers", but not
+    "core.eventsx". A pattern ending with a "*" segment ("core.*") matches only
+    the submodules. Patterns having a wildcard elsewhere ("core.*.api", "co*")
+    cannot be represented in the trie; these are matched with their regular
+    expressions, after the trie lookup.
+
+    When more than one entry matches a name, the entry that was added first
+    wins.
+    """
+
+    class Node:
+        __slots__ = ('children', 'entries', 'wildcard')
+
+        def __init__(self):
+            self.children = {}
+            self.entries = []
+            self.wildcard = []
+
+        def empty(self):
+            return not (self.children or self.entries or self.wildcard)
+
+    def __init__(self):
+        self.root = PatternTrie.Node()
+        self.fallback = []
+        self.sequence = 0
+        self.order = {}
+
+    def add_entry(self, loader_entry):
+        self.sequence += 1
+        self.order[id(loader_entry)] = self.sequence
+        seq_entry = (self.sequence, loader_entry)
+        for path in loader_entry.paths:
+            segments = PatternTrie.__segments__(path)
+            if segments is None:
+                self.fallback.append((self.sequence, to_regex(path), loader_entry))
+                continue
+            if not segments:
+                continue
+            node = self.root
+            wildcard = segments[-1] == '*'
+            if wildcard:
+                segments = segments[:-1]
+            for segment in segments:
+                child = node.children.get(segment)
+                if child is None:
+                    child = node.children[segment] = PatternTrie.Node()
+                node = child
+            (node.wildcard if wildcard else node.entries).append(seq_entry)
+
+    def remove_entry(self, loader_entry):
+        if self.order.pop(id(loader_entry), None) is None:
+            return
+        for path in loader_entry.paths:
+            segments = PatternTrie.__segments__(path)
+            if segments is None:
+                self.fallback = [f for f in self.fallback if f[2] is not loader_entry]
+                continue
+            if segments:
+                self.__remove__(self.root, segments, loader_entry)
+
+    def __remove__(self, node, segments, loader_entry):
+        if len(segments) == 1 and segments[0] == '*':
+            node.wildcard = [e for e in node.wildcard if e[1] is not loader_entry]
+            return
+        child = node.children.get(segments[0])
+        if child is None:
+            return
+        if len(segments) == 1:
+            child.entries = [e for e in child.entries if e[1] is not loader_entry]
+        else:
+            self.__remove__(child, segments[1:], loader_entry)
+        if child.empty():
+            del node.children[segments[0]]
+
+    def lookup(self, fullname):
+        """Returns the first added loader entry matching the module name, or
+        None if no entry matches.
+        """
+        best = None
+        node = self.root
+        segments = fullname.split('.')
+        last = len(segments) - 1
+        for i, segment in enumerate(segments):
+            if node.wildcard and (best is None or node.wildcard[0][0] < best[0]):
+                best = node.wildcard[0]
+            node = node.children.get(segment)
+            if node is None:
+                break
+            if node.entries and (best is None or node.entries[0][0] < best[0]):
+                best = node.entries[0]
+            if i == last:
+                break
+        for seq, regex, loader_entry in self.fallback:
+            if best is not None and seq > best[0]:
+                break
+            if regex.match(fullname):
+                best = (seq, loader_entry)
+                break
+        return best[1] if best else None
+
+    def lookup_all(self, fullname):
+        """Returns all loader entries matching the module name, in the order in
+        which they were added.
+        """
+        found = {}
+        node = self.root
+        segments = fullname.split('.')
+        last = len(segments) - 1
+        for i, segment in enumerate(segments):
+            for seq_entry in node.wildcard:
+                found[seq_entry[0]] = seq_entry[1]
+            node = node.children.get(segment)
+            if node is None:
+                break
+            for seq_entry in node.entries:
+                found[seq_entry[0]] = seq_entry[1]
+            if i == last:
+                break
+        for seq, regex, loader_entry in self.fallback:
+            if regex.match(fullname):
+                found[seq] = loader_entry
+        return [found[seq] for seq in sorted(found)]
+
+    @staticmethod
+    def __segments__(path):
+        """Splits the pattern into segments. Returns None if the pattern cannot
+        be stored in the trie.
+        """
+        path = path.strip()
+        if not path:
+            return []
+        segments = path.split('.')
+        for segment in segments[:-1]:
+            if '*' in segment:
+                return None
+        if '*' in segments[-1] and segments[-1] != '*':
+            return None
+        return segments
+
 class RestrictedEntryLoader:
+    """Loader for the restricted modules. Refuses to load any module."""
+
+    def create_module(self, spec):
+        raise ImportError('Module %s is restricted' % spec.name, name=spec.name)
+
+    def exec_module(self, module):
+        raise ImportError('Module %s is restricted' % module.__name__, name=module.__name__)
+
+    def load_module(self, fullname):
+        raise ImportError('Module %s is restricted' % fullname, name=fullname)
+
+
+STDLIB_MODULES = frozenset(getattr(sys, 'stdlib_module_names', ())) | frozenset(sys.builtin_module_names)
 
-    def load_module(self):
-        raise ImportError
+
+class ImportPolicy:
+    """Decides which modules the plugins are allowed to import.
+
+    The policy guards the modules of the plugins. A plugin may import a module
+    exported by a plugin if:
+        * the module is exported by the plugin itself,
+        * the module is matched by the names in its Requires entries,
+        * the module is exported by a plugin listed in its Requires-Plugins
+        entries,
+        * the module is in allowed_modules (the modules that are available to
+        all plugins).
+    The modules not exported by any plugin - the platform itself (termite), the
+    python standard library and the installed distributions - are always
+    allowed. The restricted modules are never available to the plugins, not even
+    when granted by any of the above.
+
+    When enforce is False, only the restricted modules are denied.
+
+    When more than one plugin exports the module (side-by-side versions), the
+    decision also holds the versioned namespace from which the importing plugin
+    gets the module (see PlatformPluginsFinder.select_namespace).
+
+    The decisions are cached per importing plugin and module name, so the rules
+    are evaluated once and every following import of the same module by the
+    same plugin costs one dictionary lookup. The cached decisions are dropped
+    when a plugin is added to or removed from the finder (see invalidate).
+
+    Only the import statements (and the calls to __import__) in the plugin
+    modules are checked. Relative imports are always allowed, as they can only
+    reach the modules of the plugin itself.
+    """
+
+    def __init__(self, finder, restricted_modules=None, allowed_modules=None, enforce=True):
+        self.finder = finder
+        self.enforce = enforce
+        self.restricted = PatternTrie()
+        self.restricted.add_entry(LoaderEntry(None, restricted_modules))
+        self.allowed = PatternTrie()
+        self.allowed.add_entry(LoaderEntry(None, allowed_modules))
+        self.decisions = {}
+        self.grants = {}
+
+    def create_check(self, plugin_container):
+        """Returns a callable that checks whether the plugin is allowed to
+        import a module. The callable raises ImportError if the import is not
+        allowed, otherwise returns the versioned namespace of the module (or
+        None). See create_context_sensitive_import.
+        """
+        plugin_id = plugin_container.plugin_id
+        decisions = self.decisions.setdefault(plugin_id, {})
+
+        def check_import(fullname):
+            decision = decisions.get(fullname)
+            if decision is None:
+                decision = decisions[fullname] = self.decide(plugin_container, fullname)
+            if decision is True:
+                return None
+            if decision is False:
+                raise ImportError('Plugin %s is not allowed to import %s' % (plugin_id, fullname), name=fullname)
+            return decision
+        return check_import
+
+    def decide(self, plugin_container, fullname):
+        """Returns False if the import is not allowed, otherwise the namespace
+        from which the module is imported or True if the module is imported by
+        its name.
+        """
+        if not self.is_allowed(plugin_container, fullname):
+            return False
+        return self.finder.select_namespace(plugin_container, fullname) or True
+
+    def is_allowed(self, plugin_container, fullname):
+        """Evaluates the rules for the plugin importing the module. The result
+        is not cached.
+        """
+        if self.restricted.lookup(fullname):
+            return False
+        if not self.enforce:
+            return True
+        if fullname.partition('.')[0] in STDLIB_MODULES or self.allowed.lookup(fullname):
+            return True
+        providers = self.finder.get_providers(fullname)
+        if not providers:
+            return True
+        required_plugins = None
+        for provider in providers:
+            provider_id = provider.plugin_container.plugin_id
+            if provider_id == plugin_container.plugin_id:
+                return True
+            if required_plugins is None:
+                required_plugins = [r.name for r in plugin_container.manifest.requires_plugins]
+            if provider_id in required_plugins:
+                return True
+        return self.get_grants(plugin_container).lookup(fullname) is not None
+
+    def get_grants(self, plugin_container):
+        """Returns the trie of the Requires entries of the plugin. The loader of
+        each trie entry is the RequiresEntry itself.
+        """
+        grants = self.grants.get(plugin_container.plugin_id)
+        if grants is None:
+            grants = self.grants[plugin_container.plugin_id] = PatternTrie()
+            for requires in plugin_container.manifest.requires:
+                grants.add_entry(LoaderEntry(requires, [requires.name]))
+        return grants
+
+    def invalidate(self, plugin_id=None):
+        """Drops the cached decisions. The checks created for the plugins keep
+        working with the emptied tables.
+        """
+        for decisions in self.decisions.values():
+            decisions.clear()
+        if plugin_id is not None:
+            self.grants.pop(plugin_id, None)
+            self.decisions.pop(plugin_id, None)
+
+
+def is_deferred_load(module):
+    """Whether the module is being loaded by a LazyLoader, on the first access to
+    one of its attributes.
+    """
+    spec = module.__dict__.get('__spec__')
+    loader_state = spec.loader_state if spec is not None else None
+    return isinstance(loader_state, dict) and '__dict__' in loader_state
 
 
 class BaseLoader(SourceLoader):
 
     def __init__(self):
         SourceLoader.__init__(self)
+        self.init_lock = threading.Lock()
 
     def get_current_context(self):
         return get_from_context(IMPORT_CONTEXT)
@@ -139,39 +592,214 @@ class BaseLoader(SourceLoader):
     def create_context_for_this(self):
         pass
 
+    def is_lazy(self):
+        """Whether the execution of the modules loaded by this loader is
+        deferred until they are first used.
+        """
+        return False
+
     def exec_module(self, module):
-        module.__context__ = self.get_current_context()
+        if self.is_lazy() and not is_deferred_load(module):
+            # the module code is executed (by calling exec_module again) on the
+            # first access to an attribute of the module
+            module.__context__ = self.get_current_context()
+            LazyLoader(self).exec_module(module)
+            return
+        if not is_deferred_load(module):
+            module.__context__ = self.get_current_context()
         extend(module.__dict__, self.get_overriden_globals())
         return SourceLoader.exec_module(self, module)
 
     def get_environ(self):
         return {}
 
+    def get_import_function(self):
+        """Returns the context sensitive import function for the modules loaded
+        by this loader. The function is created once and shared by all modules
+        of the loader.
+        """
+        import_function = self.__dict__.get('import_function')
+        if import_function is None:
+            with self.init_lock:
+                import_function = self.__dict__.get('import_function')
+                if import_function is None:
+                    import_function = create_context_sensitive_import(self.create_context_for_this(),
+                                                                      self.create_import_check())
+                    self.import_function = import_function
+        return import_function
+
+    def create_import_check(self):
+        """Returns a callable that checks the imports made by the modules of this
+        loader (see create_context_sensitive_import), or None if the imports are
+        not checked.
+        """
+        return None
+
+    def get_builtins(self):
+        """Returns the builtins for the modules loaded by this loader.
+
+        The import statements look up __import__ in the builtins of the module,
+        not in its globals, so the modules get a copy of the builtins with the
+        context sensitive import function. The copy is made once and shared by
+        all modules of the loader.
+        """
+        module_builtins = self.__dict__.get('module_builtins')
+        if module_builtins is None:
+            import_function = self.get_import_function()
+            with self.init_lock:
+                module_builtins = self.__dict__.get('module_builtins')
+                if module_builtins is None:
+                    module_builtins = dict(builtins.__dict__)
+                    module_builtins['__import__'] = import_function
+                    self.module_builtins = module_builtins
+        return module_builtins
+
     def get_overriden_globals(self):
-        glb = {'__import__': create_context_sensitive_import(self.create_context_for_this())}
+        glb = {'__import__': self.get_import_function(), '__builtins__': self.get_builtins()}
         env = self.get_environ()
         glb.update(env)
         return glb
 
 
+class SharedCodeTable:
+    """Compiled module code shared between the side-by-side versions of the same
+    modules.
+
+    The modules at the same path with the same source get the same code object,
+    and through it share the code objects of all functions and classes defined
+    in the module. The code is compiled with the file name of the first plugin
+    that loaded the module, which shows in the tracebacks of the other versions.
+
+    Only the modules exported by more than one plugin are shared (see
+    is_shared), and the code is dropped once the module has a single provider
+    again (see release). A module loaded while it had a single provider is not
+    in the table, so a version added later compiles its own code.
+
+    The code is keyed by the resource path and the hash of the source (see
+    PluginLoader.code_key), so only the shared modules have their sources read
+    and hashed when the compiled code is in the bytecode cache.
+    """
+
+    def __init__(self, is_shared):
+        self.is_shared = is_shared
+        self.codes = {}
+
+    def get_code(self, name, key, owner, compile_source):
+        """Returns the shared code object for the module source, compiling it
+        with compile_source if there is none yet. The owner (plugin id) is
+        recorded, so the code is dropped when no plugin uses it (see release).
+        """
+        entry = self.codes.get(key)
+        if entry is None:
+            entry = self.codes.setdefault(key, (compile_source(), set(), name))
+        entry[1].add(owner)
+        return entry[0]
+
+    def release(self, owner):
+        """Drops the owner from the codes, and the codes with no owners or of
+        the modules that are no longer shared.
+        """
+        for key, (code, owners, name) in list(self.codes.items()):
+            owners.discard(owner)
+            if not owners or not self.is_shared(name):
+                self.codes.pop(key, None)
+
+
 class PlatformPluginsFinder(BaseFinder):
+    """Finder of the modules exported by the plugins on the platform.
+
+    More than one plugin may export the same module (package), for example two
+    versions of the same library. The first added plugin provides the module
+    under its own name. The plugins added later provide their modules in their
+    own versioned namespace: a top level package named after the plugin id and
+    version (see namespace_for), so "json5" from plugin "lib.json5" 2.0 is
+    loaded as "__plugin_lib_json5_2_0__.json5". The import function of each
+    plugin transparently imports the modules from the namespace of the provider
+    selected by the version ranges of the plugin Requires entries (see
+    select_namespace).
+    """
 
-    def __init__(self, restricted_modules):
+    def __init__(self, restricted_modules, bytecode_cache=None, allowed_modules=None, enforce_import_acl=True,
+                 profiler=None):
         super(PlatformPluginsFinder, self).__init__()
         self.plugins = {}
+        self.namespaces = {}
+        self.code_table = SharedCodeTable(self.has_versions)
+        self.bytecode_cache = bytecode_cache
+        self.profiler = profiler
         self.log = logging.getLogger('loader.PlatformPluginsFinder')
-        restricted_modules = restricted_modules or []
-        for restricted_path in restricted_modules:
-            self.add_restricted_paths(restricted_path)
+        restricted_modules = self.normalize_paths(restricted_modules)
+        if restricted_modules:
+            self.add_restricted_paths(restricted_modules)
+        self.import_policy = ImportPolicy(self, restricted_modules, self.normalize_paths(allowed_modules),
+                                          enforce=enforce_import_acl)
         self.log.info('PlatformPluginsFinder set up')
 
     def add_plugin(self, plugin_container):
-        if self.plugins.get(plugin_container.plugin_id):
-            raise Exception('Plugin %s already present' % plugin_container.plugin_id)
-        loader_entries = self.create_loader_entries(plugin_container)
-        self.plugins[plugin_container.plugin_id] = (loader_entries, plugin_container)
-        for loader_entry in loader_entries:
-            self.add_loader(loader_entry)
+        with self.lock:
+            if self.plugins.get(plugin_container.plugin_id):
+                raise Exception('Plugin %s already present' % plugin_container.plugin_id)
+            loader_entries = self.create_loader_entries(plugin_container)
+            self.plugins[plugin_container.plugin_id] = (loader_entries, plugin_container)
+            for loader_entry in loader_entries:
+                self.add_loader(loader_entry)
+                self.namespaces[loader_entry.loader.namespace] = loader_entry.loader
+            self.import_policy.invalidate()
+
+    @staticmethod
+    def namespace_for(plugin_container):
+        return '__plugin_%s_%s__' % (re.sub(r'\W', '_', plugin_container.plugin_id),
+                                     re.sub(r'\W', '_', str(plugin_container.version)))
+
+    def find_spec(self, fullname, path=None, target=None):
+        namespace, dot, name = fullname.partition('.')
+        loader = self.namespaces.get(namespace)
+        if loader is None:
+            return BaseFinder.find_spec(self, fullname, path, target)
+        if not name:
+            return ModuleSpec(fullname, None, is_package=True)
+        return loader.get_spec(fullname)
+
+    def get_providers(self, fullname):
+        """Returns the loaders of all plugins exporting the module, the first
+        added first.
+        """
+        return [e.loader for e in self.patterns.lookup_all(fullname) if isinstance(e.loader, PluginLoader)]
+
+    def has_versions(self, fullname):
+        """Whether the module is exported by more than one plugin."""
+        return len(self.get_providers(fullname)) > 1
+
+    def select_namespace(self, plugin_container, fullname):
+        """Selects the provider of the module for the importing plugin.
+
+        A plugin always gets its own modules. Otherwise the first provider
+        which export version satisfies the version range of the Requires entry
+        of the importing plugin for that module is selected. If there is no
+        such provider, the module is provided by the first added plugin.
+
+        Returns the namespace of the selected provider, or None if the module
+        should be imported by its own name.
+        """
+        providers = self.get_providers(fullname)
+        if len(providers) < 2:
+            return None
+        selected = None
+        for provider in providers:
+            if provider.plugin_container.plugin_id == plugin_container.plugin_id:
+                selected = provider
+                break
+        if selected is None:
+            requires = self.import_policy.get_grants(plugin_container).lookup(fullname)
+            if requires is not None:
+                for provider in providers:
+                    version = provider.get_export_version(fullname)
+                    if version is not None and requires.loader.version_in_range(normalize_version_string(version)):
+                        selected = provider
+                        break
+        if selected is None or selected is providers[0]:
+            return None
+        return selected.namespace
 
     def create_loader_entries(self, plugin_container):
         entries = []
@@ -182,44 +810,261 @@ class PlatformPluginsFinder(BaseFinder):
         return [LoaderEntry(loader=loader, path_patterns=entries)]
 
     def create_loader(self, plugin_container):
-        return PluginLoader(plugin_container=plugin_container)
+        return PluginLoader(plugin_container=plugin_container, bytecode_cache=self.bytecode_cache,
+                            import_policy=self.import_policy, profiler=self.profiler,
+                            namespace=self.namespace_for(plugin_container), code_table=self.code_table)
 
     def remove_plugin(self, plugin_id):
-        loader_entries, plugin_container = self.plugins.get(plugin_id)
-        if plugin_container:
-            del self.plugins[plugin_id]
-
+        with self.lock:
+            loader_entries, plugin_container = self.plugins.pop(plugin_id, (None, None))
+            if not plugin_container:
+                return
             for le in loader_entries:
-                try:
-                    self.loader_entries.remove(le)
-                except ValueError:
-                    pass
+                self.remove_loader(le)
+                if self.namespaces.get(le.loader.namespace) is le.loader:
+                    del self.namespaces[le.loader.namespace]
+                    sys.modules.pop(le.loader.namespace, None)
+            self.import_policy.invalidate(plugin_id)
+            self.code_table.release(plugin_id)
+            self.unload_promoted_modules()
+        self.unload_modules(loader_entries)
+
+    def unload_promoted_modules(self):
+        """Removes from sys.modules the modules loaded in the namespace of a
+        provider that now provides them under their own name, as the first
+        remaining provider. Otherwise the same module would be loaded twice,
+        under both names.
+        """
+        for name in list(sys.modules):
+            namespace, dot, module_name = name.partition('.')
+            loader = self.namespaces.get(namespace)
+            if loader is None or not module_name:
+                continue
+            providers = self.get_providers(module_name)
+            if providers and providers[0] is loader:
+                sys.modules.pop(name, None)
+
+    def unload_modules(self, loader_entries):
+        """Removes the modules loaded by the loaders of the entries from
+        sys.modules, so they are loaded again from the plugin if it is added
+        back (reloaded).
+        """
+        for le in loader_entries:
+            specs = getattr(le.loader, 'specs', {})
+            for name, spec in list(specs.items()):
+                if spec is not None:
+                    sys.modules.pop(name, None)
 
 
 class PluginLoader(BaseLoader):
 
-    def __init__(self, plugin_container):
+    def __init__(self, plugin_container, bytecode_cache=None, import_policy=None, profiler=None, namespace=None,
+                 code_table=None):
+        BaseLoader.__init__(self)
         self.plugin_container = plugin_container
+        self.bytecode_cache = bytecode_cache
+        self.import_policy = import_policy
+        self.profiler = profiler
+        self.namespace = namespace
+        self.namespace_prefix = namespace + '.' if namespace else None
+        self.code_table = code_table
+        self.specs = {}
+        self.resource_paths = {}
 
     def create_context_for_this(self):
         return self.plugin_container.plugin_id
 
-    def get_filename(self, fullname):
-        fullname = self.plugin_container.plugin.import_to_filename(fullname)
-        if not fullname:
-            raise ImportError('File %s not found' % fullname)
+    def create_import_check(self):
+        if self.import_policy is None:
+            return None
+        return self.import_policy.create_check(self.plugin_container)
+
+    def get_spec(self, fullname):
+        """Returns the module spec for a module of this plugin, or None if the
+        plugin does not contain the module.
+
+        The specs are resolved once per module name and cached, so importing the
+        module again does not resolve the module file again. Each call returns
+        a copy of the cached spec, because the import machinery modifies the
+        spec of the module being loaded.
+        """
+        try:
+            spec = self.specs[fullname]
+        except KeyError:
+            spec = self.specs[fullname] = self.create_spec(fullname)
+        return copy(spec) if spec is not None else None
+
+    def module_name(self, fullname):
+        """Returns the name of the module without the versioned namespace of
+        this plugin.
+        """
+        if self.namespace_prefix and fullname.startswith(self.namespace_prefix):
+            return fullname[len(self.namespace_prefix):]
         return fullname
 
+    def get_export_version(self, fullname):
+        """Returns the version of the most specific export of this plugin
+        matching the module, or None.
+        """
+        version = None
+        matched = -1
+        for export in self.plugin_container.manifest.exports:
+            name = export.name[:-2] if export.name.endswith('.*') else export.name
+            if (fullname == name or fullname.startswith(name + '.')) and len(name) > matched:
+                version, matched = export.version, len(name)
+        return version
+
+    def create_spec(self, fullname):
+        plugin = self.plugin_container.plugin
+        filename = plugin.import_to_filename(self.module_name(fullname))
+        if not filename:
+            return None
+        origin = plugin.get_path(filename)
+        is_package = os.path.basename(filename).lower() == '__init__.py'
+        spec = ModuleSpec(fullname, self, origin=origin, is_package=is_package)
+        spec.has_location = True
+        if is_package:
+            spec.submodule_search_locations = [os.path.dirname(origin)]
+        spec.cached = self.get_cached(filename, origin)
+        self.resource_paths[origin] = filename
+        return spec
+
+    def get_cached(self, filename, origin):
+        """Returns the path of the compiled module in the bytecode cache, or None
+        if the compiled modules are not cached.
+        """
+        if self.bytecode_cache is None:
+            return None
+        return self.bytecode_cache.cache_path(self.plugin_container.plugin_id, self.plugin_container.version,
+                                              filename)
+
+    def get_code(self, fullname):
+        """Returns the code object for the module.
+
+        If a bytecode cache is set for this loader, the compiled code is loaded
+        from the cache when it is still valid for the module source. Otherwise
+        the source is compiled and the compiled code is stored in the cache.
+
+        The code of the modules exported by more than one plugin is shared
+        through the code table (see SharedCodeTable).
+        """
+        source_path = self.get_filename(fullname)
+        table = self.code_table
+        name = self.module_name(fullname)
+        if table is None or not table.is_shared(name):
+            return self.load_code(fullname, source_path)
+        source = []
+        key = self.code_key(source_path, source)
+        return table.get_code(name, key, self.plugin_container.plugin_id,
+                              lambda: self.load_code(fullname, source_path, source))
+
+    def code_key(self, source_path, source):
+        """Returns the key of the module source in the code table: the resource
+        path and the hash of the source. The source is read into the source
+        list, so it is not read again when the code is compiled or validated
+        against the bytecode cache.
+        """
+        if not source:
+            source.append(self.get_data(source_path))
+        data = source[0]
+        return self.get_resource_path(source_path), source_hash(data.encode('utf-8') if isinstance(data, str) else data)
+
+    def load_code(self, fullname, source_path, source=None):
+        """Loads the code of the module from the bytecode cache, or compiles
+        it. source is a list with the module source, if it was already read.
+        """
+        source = source if source is not None else []
+        cache = self.bytecode_cache
+        if cache is None:
+            return self.source_to_code(source[0] if source else self.get_data(source_path), source_path)
+        bytecode_path = self.get_spec(fullname).cached
+
+        def get_source():
+            if not source:
+                source.append(self.get_data(source_path))
+            return source[0]
+
+        try:
+            stats = self.path_stats(source_path)
+        except OSError:
+            stats = None
+        if stats is not None and bytecode_path:
+            if self.profiler is None:
+                code = cache.load(bytecode_path, stats, get_source)
+            else:
+                with self.profiler.phase(PHASE_READ):
+                    code = cache.load(bytecode_path, stats, get_source)
+            if code is not None:
+                return code
+        code = self.source_to_code(get_source(), source_path)
+        if stats is not None and bytecode_path:
+            cache.store(bytecode_path, code, stats, get_source)
+        return code
+
+    def path_stats(self, path):
+        try:
+            return self.plugin_container.plugin.resource_stats(self.get_resource_path(path))
+        except OSError:
+            raise
+        except Exception as e:
+            raise OSError(str(e))
+
+    def set_data(self, path, data):
+        # only the compiled modules in the bytecode cache are ever written
+        if self.bytecode_cache is not None and self.bytecode_cache.owns(path):
+            self.bytecode_cache.write(path, data)
+
+    def invalidate_caches(self):
+        self.specs.clear()
+        self.resource_paths.clear()
+
+    def get_filename(self, fullname):
+        spec = self.get_spec(fullname)
+        if not spec:
+            raise ImportError('File for module %s not found' % fullname, name=fullname)
+        return spec.origin
+
+    def get_resource_path(self, path):
+        """Translates the path of a module file to a resource path in the
+        plugin.
+        """
+        return self.resource_paths.get(path, path)
+
     def get_data(self, path):
+        if self.profiler is None:
+            return self.read_data(path)
+        with self.profiler.phase(PHASE_READ):
+            return self.read_data(path)
+
+    def read_data(self, path):
+        path = self.get_resource_path(path)
         if not self.plugin_container.plugin.resource_exists(path):
-            return None
+            raise OSError('Resource %s not found' % path)
 
         return self.plugin_container.plugin.read_code(path)
 
+    def source_to_code(self, data, path, *args, **kwargs):
+        if self.profiler is None:
+            return BaseLoader.source_to_code(self, data, path, *args, **kwargs)
+        with self.profiler.phase(PHASE_COMPILE):
+            return BaseLoader.source_to_code(self, data, path, *args, **kwargs)
+
+    def exec_module(self, module):
+        if self.profiler is None or (self.is_lazy() and not is_deferred_load(module)):
+            return BaseLoader.exec_module(self, module)
+        with self.profiler.profile_module(module.__name__, self.create_context_for_this()):
+            return BaseLoader.exec_module(self, module)
+
     def get_environ(self):
         return self.plugin_container.get_environ()
+
+    def is_lazy(self):
+        return self.plugin_container.manifest.lazy_loading
     
     def is_package(self, fullname):
+        spec = self.get_spec(fullname)
+        if spec:
+            return spec.submodule_search_locations is not None
         return self.plugin_container.plugin.is_package(fullname)
     
     def __str__(self):
@@ -229,11 +1074,32 @@ class PluginLoader(BaseLoader):
         return self.__str__()
 
 class ClassLoader:
+    """Resolves classes by their fully qualified names.
+
+    The resolved classes are cached by name, together with the plugin (id and
+    version) that owns the module of the class. The classes of a plugin must be
+    dropped from the cache (see invalidate_plugin) when the plugin is
+    uninstalled or reloaded. The classes that do not belong to any plugin are
+    kept for the lifetime of the loader.
+    """
 
     def __init__(self, import_fn):
         self.import_fn = import_fn
+        self.classes = {}
+        self.plugin_classes = {}
 
     def load_class(self, class_name):
+        entry = self.classes.get(class_name)
+        if entry is not None:
+            return entry[1]
+        loaded_module, clazz = self.resolve_class(class_name)
+        owner = get_owner_plugin(loaded_module)
+        self.classes[class_name] = (owner, clazz)
+        if owner is not None:
+            self.plugin_classes.setdefault(owner[0], set()).add(class_name)
+        return clazz
+
+    def resolve_class(self, class_name):
         #print('class_name=%s' % class_name)
         if not class_name:
             raise ValueError('Class name must be given')
@@ -244,7 +1110,27 @@ class ClassLoader:
         loaded_module = self.import_fn(package, globals(), locals(), [clazz])
         if not loaded_module:
             raise Exception('Module not found: %s' % package)
-        return getattr(loaded_module, clazz)
+        return loaded_module, getattr(loaded_module, clazz)
+
+    def invalidate_plugin(self, plugin_id):
+        """Drops the cached classes owned by the plugin."""
+        for class_name in self.plugin_classes.pop(plugin_id, ()):
+            self.classes.pop(class_name, None)
+
+    def invalidate(self):
+        self.classes.clear()
+        self.plugin_classes.clear()
+
+
+def get_owner_plugin(module):
+    """Returns the (plugin id, version) of the plugin that loaded the module, or
+    None if the module was not loaded from a plugin.
+    """
+    spec = getattr(module, '__spec__', None)
+    loader = spec.loader if spec is not None else None
+    if isinstance(loader, PluginLoader):
+        return loader.plugin_container.plugin_id, loader.plugin_container.version
+    return None
 
 
 class ClassProtocolHandler(ProtocolHandler):
@@ -256,6 +1142,9 @@ class ClassProtocolHandler(ProtocolHandler):
     def load(self, path, *args, **kwargs):
         return self.class_loader.load_class(path)
 
+    def invalidate_plugin(self, plugin_id):
+        self.class_loader.invalidate_plugin(plugin_id)
+
 log = logging.getLogger('loader')
 
 def register_finder(finder):
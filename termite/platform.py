@@ -20,14 +20,27 @@ interface.
 """
 
 import logging
+import os.path
 from termite import metadata
-from termite.dependencies import PluginDependenciesManager
+from termite.bytecode import BytecodeCache, VALIDATE_TIMESTAMP, precompile_plugins
+from termite.dependencies import PluginDependenciesManager, ServiceContext
 from termite.loader import ClassProtocolHandler, PlatformPluginsFinder, register_finder
-from termite.plugins.support import PluginLoaderHandler, plugin_references_from_location
+from termite.plugins.support import PluginLoaderHandler, discover_plugins
+from termite.profiling import ImportProfiler
 from termite.resources import BaseResourceLoader
 from termite.tools import Proxy
 
 
+HOOKS_ALL = 'all'
+"""All hooks of a plugin."""
+
+HOOKS_SHARED = 'shared'
+"""The hooks that are not marked as per-process (see Plugin.per_process)."""
+
+HOOKS_PER_PROCESS = 'per-process'
+"""The hooks marked as per-process (see Plugin.per_process)."""
+
+
 class Plugin:
     """Base class for all Plugins.
 
@@ -69,6 +82,17 @@ class Plugin:
     collection cycle.
     """
 
+    per_process = False
+    """Whether the hook must be activated in every process.
+
+    When the platform runs in prefork mode (see termite.platformctl), the
+    master process activates the hooks that are not per-process once, before
+    forking the workers, and each worker activates only the per-process hooks.
+    Hooks that start threads or open connections and sockets should be marked
+    as per-process. The hook classes that do not extend Plugin may set this
+    class attribute too.
+    """
+
     def activate(self):
         """Called to activate the plugin.
 
@@ -140,9 +164,11 @@ class PluginContainer:
         self.manifest = None
         self.dependencies = []
         self.plugin_hooks = []
+        self.per_process_hooks = set()
         self.plugin_state = None
         self.plugin = None
         self.version = None
+        self.services = None
         self.logger = logging.getLogger('termite.platform.PluginContainer')
 
     def load(self):
@@ -208,6 +234,17 @@ class PluginContainer:
             if not isinstance(hook_inst, Plugin):
                 hook_inst = Proxy(target=hook_inst)
             self.plugin_hooks.append(hook_inst)
+            if getattr(hook_class, 'per_process', False):
+                self.per_process_hooks.add(id(hook_inst))
+
+    def get_hooks(self, scope=HOOKS_ALL):
+        """Returns the plugin hooks in the scope: HOOKS_ALL, HOOKS_SHARED or
+        HOOKS_PER_PROCESS.
+        """
+        if scope == HOOKS_ALL:
+            return self.plugin_hooks
+        per_process = scope == HOOKS_PER_PROCESS
+        return [h for h in self.plugin_hooks if (id(h) in self.per_process_hooks) == per_process]
 
     def resolve_dependencies(self):
         pass
@@ -215,7 +252,7 @@ class PluginContainer:
     def dispose_dependencies(self):
         pass
 
-    def activate(self):
+    def activate(self, scope=HOOKS_ALL):
         """Activates the plugin.
 
         A plugin can be activated only it was alerady successfully installed.
@@ -224,12 +261,19 @@ class PluginContainer:
 
         When activated, if the plugin exposes any hooks, on each hook instance
         the method "activate" will be invoked.
+
+        scope selects the hooks to activate (see get_hooks). Activating only the
+        shared hooks does not change the plugin state: that is done by the
+        prefork master, and the plugin becomes active when the per-process hooks
+        are activated in the worker.
         """
         if self.plugin_state is not Plugin.STATE_INSTALLED and self.plugin_state is not Plugin.STATE_DEACTIVATED:
             raise PluginLifecycleException("Cannot activate plugin. Invalid state: %s" % str(self.plugin_state))
         try:
-            for hook in self.plugin_hooks:
+            for hook in self.get_hooks(scope):
                 hook.activate()
+            if scope == HOOKS_SHARED:
+                return
             self.plugin_state = Plugin.STATE_ACTIVE
             self.notify_state_change(Plugin.STATE_ACTIVE)
         except Exception as e:
@@ -237,7 +281,7 @@ class PluginContainer:
             self.plugin_state = Plugin.STATE_DEACTIVATED
             self.notify_state_change(Plugin.STATE_DEACTIVATED)
 
-    def deactivate(self):
+    def deactivate(self, scope=HOOKS_ALL):
         """Deactivates a plugin.
 
         Only an active plugin can be deactivated. If the plugin is not in ACTIVE
@@ -245,15 +289,25 @@ class PluginContainer:
 
         If the plugin exposes any hooks, on each hook instance the method
         "deactivate" will be invoked.
+
+        scope selects the hooks to deactivate (see get_hooks). The shared hooks
+        are deactivated by the prefork master, where the plugin is only
+        installed, and the plugin state does not change.
         """
-        if self.plugin_state is not Plugin.STATE_ACTIVE:
+        if scope == HOOKS_SHARED:
+            if self.plugin_state is not Plugin.STATE_INSTALLED:
+                raise PluginLifecycleException("Cannot deactivate shared hooks. Invalid state: %s" %
+                                               str(self.plugin_state))
+        elif self.plugin_state is not Plugin.STATE_ACTIVE:
             raise PluginLifecycleException("Cannot deactivate plugin. Invalid state: %s" % str(self.plugin_state))
 
-        for hook in self.plugin_hooks:
+        for hook in self.get_hooks(scope):
             try:
                 hook.deactivate()
             except Exception as e:
                 self.logger.error("Deactivation error in hook %s. Error: %s", hook, e)
+        if scope == HOOKS_SHARED:
+            return
         self.plugin_state = Plugin.STATE_DEACTIVATED
         self.notify_state_change(Plugin.STATE_DEACTIVATED)
 
@@ -280,6 +334,8 @@ class PluginContainer:
             raise PluginLifecycleException("Cannot dispose plugin. Invalid state: %s" % str(self.plugin_state))
         self.plugin_state = Plugin.STATE_DISPOSED
         self.plugin_hooks = None
+        if self.plugin:
+            self.plugin.close()
         self.dispose_dependencies()
         self.plugin = None
 
@@ -306,8 +362,15 @@ class PluginContainer:
         platforum by checking for the global '__platform__' that will be set to
         the value "termite".
 
+        The services context shared by the plugins on the platform is available
+        as the global '__services__' (see termite.dependencies.ServiceContext).
+        The services registered through it are owned by this plugin and are
+        removed when the plugin is uninstalled.
+
         """
-        return {'__platform__': 'termite'}
+        if self.services is None:
+            self.services = self.plugin_manager.service_context.for_owner(self.plugin_id)
+        return {'__platform__': 'termite', '__services__': self.services}
 
     def state(self):
         """Returns the current state of the plugin.
@@ -349,10 +412,48 @@ class Platform:
     some of the most important configuration properties:
         * Section "platform":
             * plugins-dir - a list of directiories that contain plugins. The
-            directories names should be separated by comma (,).
+            directories names should be separated by comma (,). A plugin is
+            either a directory, a zip archive (.zip) with the plugin manifest
+            in its root, a python wheel (.whl, see
+            termite.plugins.wheels.WheelPlugin) or the tree of a plugin version
+            in a plugin store (.tree, see termite.plugins.store). The
+            directories are scanned in parallel.
+            * plugins-scan-depth - how deep the plugins directories are searched
+            for plugins: 1 (the default) finds only the plugins directly in the
+            directories, 2 also finds the plugins in their subdirectories (as
+            in vendor/plugin) and so on.
+            * manifest-index - if set to true, the parsed manifests of the
+            plugins in each plugins directory are kept in an index file in that
+            directory (see termite.plugins.support.ManifestIndex), so the
+            unchanged plugins are loaded without reading their manifests.
             * restricted-modules - a list of restricted python modules. These
             modules will not be available to any plugin on the platform. This
             is a comma (,) separated list of modules names.
+            * import-acl - if set to true (the default), the plugins may import
+            the modules of other plugins only when granted by their Requires
+            and Requires-Plugins entries or listed in the allowed modules. The
+            platform, the standard library and the installed distributions are
+            always available. See termite.loader.ImportPolicy.
+            * allowed-modules - comma (,) separated list of modules available
+            to all plugins (for example, third party libraries).
+            * bytecode-cache-dir - directory where the compiled plugin modules
+            are cached between runs. If not set, the plugin modules are
+            compiled every time they are loaded.
+            * bytecode-validation - how the cached compiled modules are checked
+            against the sources: "timestamp" (by modification time and size of
+            the source, the default) or "hash" (by hash of the source).
+            * precompile - if set to true, all plugin sources are compiled into
+            the bytecode cache on startup, in parallel, before the plugins are
+            installed. Requires bytecode-cache-dir.
+            * precompile-workers - the number of processes compiling the
+            sources. Defaults to the number of CPUs.
+            * profile-imports - if set to true, the time spent reading,
+            compiling and executing the plugin modules is recorded per plugin
+            and dumped to the log at the end of the startup. See
+            Platform.import_profile.
+            * instrument-services - if set to true, the calls made to the
+            services are recorded (call counts, errors, latencies).
+            See termite.dependencies.ServiceContext.service_stats.
 
 
     Typical usage
@@ -387,9 +488,13 @@ class Platform:
         self.log.info("Termite Platform %s initializing", metadata.version)
         self.config = config
         self.resource_loader = self.create_resource_loader()
+        self.import_profiler = self.create_import_profiler()
         self.plugins_finder = self.create_plugin_finder()
         self.plugins_manager = PluginManager(self.resource_loader, self.plugins_finder)
+        if self.config.getboolean('platform', 'instrument-services', fallback=False):
+            self.plugins_manager.service_context.enable_instrumentation()
         self.state = Platform.STATE_INITIALIZING
+        self.preloaded = False
 
         # the init was successful
         self.success_init()
@@ -416,9 +521,73 @@ class Platform:
         # activate all plugins
         self.log.debug('Platform starting')
         self.load_all_plugins()
+        if self.config.getboolean('platform', 'precompile', fallback=False):
+            self.precompile_plugins()
         self.install_all_plugins()
         self.activate_all_plugins()
         self.log.info('Platform started')
+        if self.import_profiler is not None:
+            self.log.info('Plugin import times:\n%s', self.import_profiler.format_report())
+
+    def preload(self):
+        """Prepares the platform in the master process of the prefork mode.
+
+        Loads and installs all plugins, imports all of their exported modules
+        and activates the shared (not per-process) plugin hooks. The worker
+        processes forked after the preload share the loaded code and only
+        activate the per-process hooks (see start_worker).
+
+        The master shuts down the platform with shutdown, once all workers are
+        done.
+        """
+        self.log.debug('Platform preloading')
+        self.load_all_plugins()
+        if self.config.getboolean('platform', 'precompile', fallback=False):
+            self.precompile_plugins()
+        self.install_all_plugins()
+        self.preimport_plugins()
+        self.activate_all_plugins(HOOKS_SHARED)
+        self.preloaded = True
+        self.log.info('Platform preloaded')
+        if self.import_profiler is not None:
+            self.log.info('Plugin import times:\n%s', self.import_profiler.format_report())
+
+    def preimport_plugins(self):
+        """Imports all modules exported by the installed plugins.
+
+        The modules are imported in the context of their plugin. The modules of
+        the plugins with lazy loading are not executed. Errors are logged and
+        the module is skipped.
+        """
+        for plugin_container in self.plugins_manager.get_all_plugins():
+            if plugin_container.plugin_state is not Plugin.STATE_INSTALLED:
+                continue
+            for name in plugin_container.plugin.module_names():
+                loader = self.plugins_finder.find_module(name)
+                if getattr(loader, 'plugin_container', None) is not plugin_container:
+                    continue
+                try:
+                    loader.get_import_function()(name)
+                except Exception:
+                    self.log.exception('Failed to import %s from [%s - version %s]', name,
+                                       plugin_container.plugin_id, plugin_container.version)
+
+    def start_worker(self):
+        """Starts a worker process of the prefork mode, forked after preload.
+
+        Activates the per-process hooks of the plugins.
+        """
+        self.activate_all_plugins(HOOKS_PER_PROCESS)
+        self.log.info('Platform worker started')
+
+    def shutdown_worker(self):
+        """Shuts down a worker process of the prefork mode.
+
+        Deactivates the per-process hooks. The rest of the platform is shut
+        down by the master process.
+        """
+        self.deactivate_all_plugins(HOOKS_PER_PROCESS)
+        self.log.info('Platform worker shutdown complete.')
 
     def shutdown(self):
         """Shuts down the platform and all plugins managed by it.
@@ -437,9 +606,12 @@ class Platform:
         """
         self.log.info('Platform shutting down...')
         self.deactivate_all_plugins()
+        if self.preloaded:
+            self.deactivate_all_plugins(HOOKS_SHARED)
         self.uninstall_all_plugins()
         self.destroy_all_plugins()
         self.plugins_manager.gc()
+        self.log.debug('Plugins finder cache: %s', self.plugins_finder.cache_info())
         self.log.info('Platform shutdown complete.')
 
     # helper methods
@@ -451,16 +623,43 @@ class Platform:
         each location. Each plugin reference is then registered with the
         PluginManager which performs the actual loading of the plugin by its
         reference.
+
+        The locations are scanned in parallel and the plugins are loaded as
+        they are found, while the scan goes on (see
+        termite.plugins.support.discover_plugins).
         """
         locations = self.config.get('platform', 'plugins-dir', fallback='').split(',') or []
         self.log.info('Loading plugins from these locations: %s' % locations)
-        all_refs = []
-        for location in locations:
-            all_refs = all_refs + plugin_references_from_location(location)
-        self.log.info('%d plugins' % len(all_refs))
-        for ref in all_refs:
+        plugin_handler = self.resource_loader.protocol_handlers.get('plugin')
+        use_index = self.config.getboolean('platform', 'manifest-index', fallback=False)
+        if use_index:
+            for location in locations:
+                if os.path.isdir(location):
+                    plugin_handler.add_manifest_index(location)
+        max_depth = self.config.getint('platform', 'plugins-scan-depth', fallback=1)
+        count = 0
+        for ref in discover_plugins(locations, max_depth, plugin_handler.manifest_indexes):
             self.plugins_manager.add_plugin(ref)
-        self.log.info('Plugins loaded')
+            count += 1
+        if use_index:
+            plugin_handler.save_manifest_indexes()
+        self.log.info('%d plugins loaded' % count)
+
+    def precompile_plugins(self):
+        """Compiles the sources of all loaded plugins into the bytecode cache.
+
+        Does nothing if there is no bytecode cache configured. See
+        termite.bytecode.precompile_plugins.
+        """
+        cache = getattr(self.plugins_finder, 'bytecode_cache', None)
+        if cache is None:
+            self.log.warning('Cannot precompile the plugins: no bytecode cache configured')
+            return None
+        workers = self.config.getint('platform', 'precompile-workers', fallback=None) or None
+        plugins = [p for p in self.plugins_manager.get_all_plugins() if p.plugin is not None]
+        result = precompile_plugins(cache, plugins, max_workers=workers)
+        self.log.info('Precompiled plugins: %s', result)
+        return result
 
     def install_all_plugins(self):
         """Installs all loaded plugins onto the platform.
@@ -471,30 +670,33 @@ class Platform:
         self.plugins_manager.install_all_plugins()
         self.log.info('All plugins installed')
 
-    def activate_all_plugins(self):
-        self.log.debug('Activating all plugins...')
-        for plugin_container in self.plugins_manager.get_all_plugins():
-            self.log.info('Activating [%s - version %s]' % (plugin_container.plugin_id, plugin_container.version))
-            try:
-                self.plugins_manager.activate_plugin(plugin_container.plugin_id)
-            except Exception:
-                self.log.exception('Failed to activate plugin: [%s - version %s]' % (plugin_container.plugin_id,
-                                                                                     plugin_container.version))
-                self.plugins_manager.deactivate_plugin(plugin_container.plugin_id)
-        self.log.info('Plugins activated')
-
-    def deactivate_all_plugins(self):
-        self.log.debug('Deactivating all plugins...')
-        for plugin_container in self.plugins_manager.get_all_plugins():
-            if plugin_container.plugin_state is Plugin.STATE_ACTIVE:
-                self.log.debug('Deactivating [%s - version %s]' % (plugin_container.plugin_id,
-                                                                   plugin_container.version))
+    def activate_all_plugins(self, scope=HOOKS_ALL):
+        self.log.debug('Activating all plugins (%s hooks)...', scope)
+        with self.plugins_manager.service_context.transaction():
+            for plugin_container in self.plugins_manager.get_all_plugins():
+                self.log.info('Activating [%s - version %s]' % (plugin_container.plugin_id, plugin_container.version))
                 try:
-                    self.plugins_manager.deactivate_plugin(plugin_container.plugin_id)
-                    self.log.info('Deactivated [%s - version %s]' % (plugin_container.plugin_id,
-                                                                     plugin_container.version))
+                    self.plugins_manager.activate_plugin(plugin_container.plugin_id, scope)
                 except Exception:
-                    self.log.exception('Failed to deactivate plugin %s' % plugin_container)
+                    self.log.exception('Failed to activate plugin: [%s - version %s]' % (plugin_container.plugin_id,
+                                                                                         plugin_container.version))
+                    self.plugins_manager.deactivate_plugin(plugin_container.plugin_id, scope)
+        self.log.info('Plugins activated')
+
+    def deactivate_all_plugins(self, scope=HOOKS_ALL):
+        self.log.debug('Deactivating all plugins (%s hooks)...', scope)
+        expected_state = Plugin.STATE_INSTALLED if scope == HOOKS_SHARED else Plugin.STATE_ACTIVE
+        with self.plugins_manager.service_context.transaction():
+            for plugin_container in self.plugins_manager.get_all_plugins():
+                if plugin_container.plugin_state is expected_state:
+                    self.log.debug('Deactivating [%s - version %s]' % (plugin_container.plugin_id,
+                                                                       plugin_container.version))
+                    try:
+                        self.plugins_manager.deactivate_plugin(plugin_container.plugin_id, scope)
+                        self.log.info('Deactivated [%s - version %s]' % (plugin_container.plugin_id,
+                                                                         plugin_container.version))
+                    except Exception:
+                        self.log.exception('Failed to deactivate plugin %s' % plugin_container)
         self.log.info('All Plugins deactivated')
 
     def uninstall_all_plugins(self):
@@ -519,7 +721,7 @@ class Platform:
                 self.log.debug('Disposing [%s - version %s]' % (plugin_container.plugin_id,
                                                                 plugin_container.version))
                 try:
-                    self.plugins_manager.deactivate_plugin(plugin_container.plugin_id)
+                    self.plugins_manager.dispose_plugin(plugin_container.plugin_id)
                     self.log.info('Disposed [%s - version %s]' % (plugin_container.plugin_id,
                                                                   plugin_container.version))
                 except Exception:
@@ -548,9 +750,43 @@ class Platform:
         object. The return type is expected to be compatible with object of type
         termite.loader.BaseFinder.
         """
-        pf = PlatformPluginsFinder(self.get_restricted_modules_list())
+        pf = PlatformPluginsFinder(self.get_restricted_modules_list(), bytecode_cache=self.create_bytecode_cache(),
+                                   allowed_modules=self.get_allowed_modules_list(),
+                                   enforce_import_acl=self.config.getboolean('platform', 'import-acl', fallback=True),
+                                   profiler=self.import_profiler)
         return pf
 
+    def create_import_profiler(self):
+        """Creates the profiler of the plugin imports if the import profiling is
+        enabled (section `platform`, property `profile-imports`).
+
+        Returns None if the imports should not be profiled.
+        """
+        if self.config.getboolean('platform', 'profile-imports', fallback=False):
+            return ImportProfiler()
+        return None
+
+    def import_profile(self):
+        """Returns the import timings of the plugin modules (see
+        termite.profiling.ImportProfiler.report), or None if the import
+        profiling is not enabled.
+        """
+        if self.import_profiler is None:
+            return None
+        return self.import_profiler.report()
+
+    def create_bytecode_cache(self):
+        """Creates the cache of the compiled plugin modules, if one is
+        configured (section `platform`, property `bytecode-cache-dir`).
+
+        Returns None if the compiled modules should not be cached.
+        """
+        cache_dir = self.config.get('platform', 'bytecode-cache-dir', fallback=None)
+        if not cache_dir:
+            return None
+        validation = self.config.get('platform', 'bytecode-validation', fallback=VALIDATE_TIMESTAMP)
+        return BytecodeCache(cache_dir, validation)
+
     def get_restricted_modules_list(self):
         """Returns a list of modules to which the access from the plugins will
         be restricted.
@@ -560,6 +796,14 @@ class Platform:
         """
         return self.config.get('platform', 'restricted-modules', fallback='').split(',') or []
 
+    def get_allowed_modules_list(self):
+        """Returns a list of modules that are available to all plugins.
+
+        Currently read from configuration - section `platform`, property
+        `allowed-modules`.
+        """
+        return self.config.get('platform', 'allowed-modules', fallback='').split(',') or []
+
     def success_init(self):
         """Called when the platform was successfully initialzed.
 
@@ -585,6 +829,7 @@ class PluginManager:
         self.log = logging.getLogger('termite.platform.PluginManager')
         self.resource_loader = resource_loader
         self.dependencies_manager = PluginDependenciesManager()
+        self.service_context = ServiceContext()
         self.plugin_finder = plugin_finder
         self.plugins_by_ref = {}
         self.plugins_by_id = {}
@@ -636,10 +881,19 @@ class PluginManager:
 
         During the reload process, first the plugin dependencies will be cleared
         and the all the dependencies will be build and reloaded again.
+
+        The modules of the old plugin are removed from the finder and the cached
+        classes of the plugin are dropped, so the new plugin is imported anew
+        once it is installed.
         """
         old_plugin = self.plugins_by_id[plugin_id]
         del self.plugins_by_id[plugin_id]
         del self.plugins_by_ref[old_plugin.plugin_ref]
+        self.plugins_by_id[plugin_id] = plugin_container
+        self.plugins_by_ref[plugin_container.plugin_ref] = plugin_container
+        if old_plugin.plugin_state is not Plugin.STATE_UNINSTALLED:
+            self.plugin_finder.remove_plugin(plugin_id)
+        self.__invalidate_classes__(plugin_id)
         if self.dependencies_built:
             self.__cleanup_dependencies__(old_plugin)
         self.__build_dependecies__(plugin_container)
@@ -661,11 +915,12 @@ class PluginManager:
         plugin = self.get_plugin(plugin_id)
         if not self.dependencies_manager.all_dependencies_satisfied(plugin_id):
             raise UnsatisfiedDependencyException('Not all dependencies satisfied for plugin: %s' % plugin_id)
-        self.plugin_finder.add_plugin(plugin)
-        plugin.install()
-        self.__mark_available__(plugin)
+        with self.service_context.transaction():
+            self.plugin_finder.add_plugin(plugin)
+            plugin.install()
+            self.__mark_available__(plugin)
 
-    def activate_plugin(self, plugin_id):
+    def activate_plugin(self, plugin_id, scope=HOOKS_ALL):
         """Activates the specified plugin.
         
         plugin_id is the ID of the plugin to be activated. Note that the plugin
@@ -673,11 +928,14 @@ class PluginManager:
         
         During the activation, the plugin hooks will be instantiated and the
         ``activate`` method will be called.
+
+        scope selects the plugin hooks to be activated (see
+        PluginContainer.get_hooks).
         """
         plugin = self.get_plugin(plugin_id)
-        plugin.activate()
+        plugin.activate(scope)
 
-    def deactivate_plugin(self, plugin_id):
+    def deactivate_plugin(self, plugin_id, scope=HOOKS_ALL):
         """Deactivates the specified plugin.
         
         plugin_id is the ID of the plugin to be deactivated. Note that only 
@@ -685,10 +943,17 @@ class PluginManager:
         
         During the deactivation, the ``deactivate`` method will be called on any
         exposed plugin hooks.
+
+        scope selects the plugin hooks to be deactivated (see
+        PluginContainer.get_hooks). The shared hooks are deactivated on
+        INSTALLED plugins (in the prefork master).
         """
         plugin = self.get_plugin(plugin_id)
-        if plugin.plugin_state is Plugin.STATE_ACTIVE:
-            plugin.deactivate()
+        if scope == HOOKS_SHARED:
+            if plugin.plugin_state is Plugin.STATE_INSTALLED:
+                plugin.deactivate(scope)
+        elif plugin.plugin_state is Plugin.STATE_ACTIVE:
+            plugin.deactivate(scope)
 
     def uninstall_plugin(self, plugin_id):
         """Uninstalls the specified plugin.
@@ -696,10 +961,28 @@ class PluginManager:
         plugin_id is the ID of the plugin to be uninstalled. 
         
         Once uninstalled, the plugin will become unavailable as a dependency on
-        the platform.
+        the platform. The plugin modules are removed from the finder and the
+        cached classes of the plugin are dropped.
         """
         plugin = self.get_plugin(plugin_id)
-        plugin.uninstall()
+        with self.service_context.transaction():
+            plugin.uninstall()
+            self.service_context.remove_services(plugin_id)
+        self.plugin_finder.remove_plugin(plugin_id)
+        self.__invalidate_classes__(plugin_id)
+
+    def dispose_plugin(self, plugin_id):
+        """Disposes the specified plugin.
+
+        plugin_id is the ID of the plugin to be disposed. Only UNINSTALLED
+        plugins can be disposed.
+
+        Any services still registered by the plugin are removed, so the memory
+        they hold can be reclaimed.
+        """
+        plugin = self.get_plugin(plugin_id)
+        self.service_context.remove_services(plugin_id)
+        plugin.dispose()
 
     def gc(self):
         """Performs a garbadge collection of the unused platform resources.
@@ -718,7 +1001,15 @@ class PluginManager:
         The installation is done in the reverse dependency order, with the 
         plugins that have no dependencies to other plugins being installed 
         first.
+
+        The whole installation is done in a single transaction on the services
+        context, so the service locators are notified once all plugins have
+        been installed.
         """
+        with self.service_context.transaction():
+            self.__install_all_plugins__()
+
+    def __install_all_plugins__(self):
         self.log.debug('Installing all plugins...')
         install_order_deps = self.dependencies_manager.reverese_dependency_order()
         prov_set = set()
@@ -775,6 +1066,15 @@ class PluginManager:
                 del self.all_requires[imp]
         self.dependencies_manager.delete_dependency(plugin_container.plugin_id)
 
+    def __invalidate_classes__(self, plugin_id):
+        """Drops the classes of the plugin cached by the class protocol
+        handler.
+        """
+        handler = self.resource_loader.protocol_handlers.get('class')
+        invalidate_plugin = getattr(handler, 'invalidate_plugin', None)
+        if invalidate_plugin is not None:
+            invalidate_plugin(plugin_id)
+
     def __locate_plugin_for_import__(self, imp):
         for plugin_id, plugin_container in self.plugins_by_id.items():
             if imp.name == plugin_id and imp.version_in_range(plugin_container.manifest.version):
@@ -1,7 +1,10 @@
 import argparse
 
 from configparser import ConfigParser
+import gc
 import logging
+import os
+import sys
 from termite import metadata
 from termite.platform import Platform
 
@@ -44,11 +47,51 @@ def create_arg_parser(prog_name):
         help='Plugins directory'
     )
 
+    arg_parser.add_argument(
+        '-w', '--workers',
+        type=int,
+        default=0,
+        help='Run in prefork mode with this many worker processes. The master process loads and installs the '
+             'plugins and imports their modules once, then forks the workers.'
+    )
+
+    arg_parser.add_argument(
+        '--precompile',
+        action='store_true',
+        help='Compile all plugin sources into the bytecode cache on startup.'
+    )
+
+    arg_parser.add_argument(
+        '--precompile-workers',
+        type=int,
+        help='Number of processes compiling the plugin sources.'
+    )
+
+    arg_parser.add_argument(
+        '--plugins-scan-depth',
+        type=int,
+        help='How deep the plugins directories are searched for plugins (default 1).'
+    )
+
+    arg_parser.add_argument(
+        '--manifest-index',
+        action='store_true',
+        help='Keep the parsed plugin manifests in an index file in each plugins directory.'
+    )
+
     return arg_parser
 
 def create_platform_instance(args):
     config = read_config(args.config_file)
     config.set('platform','plugins-dir', args.plugins_directory)
+    if args.precompile:
+        config.set('platform', 'precompile', 'true')
+    if args.precompile_workers:
+        config.set('platform', 'precompile-workers', str(args.precompile_workers))
+    if args.plugins_scan_depth:
+        config.set('platform', 'plugins-scan-depth', str(args.plugins_scan_depth))
+    if args.manifest_index:
+        config.set('platform', 'manifest-index', 'true')
     return Platform(config)
 
 
@@ -64,8 +107,61 @@ def ctl_main():
         logging.basicConfig(level=logging.DEBUG, format='[%(levelname)7s] %(asctime)s - %(name)s: %(message)s')
     logging.info(metadata.logo_ascii)
     platform = create_platform_instance(args)
+    if args.workers > 0:
+        run_prefork(platform, args.workers)
+        return
     platform.start()
     platform.shutdown()
 
+
+def run_prefork(platform, workers):
+    """Runs the platform in prefork mode.
+
+    The master process preloads the platform (see Platform.preload) and forks
+    the workers, which share the loaded plugin code with the master through
+    copy-on-write. Each worker activates only the per-process plugin hooks. The
+    master waits for all workers to exit and then shuts the platform down.
+    """
+    platform.preload()
+    # keep the preloaded objects out of the garbage collector, so the
+    # collections in the workers do not touch (and copy) the shared pages
+    if hasattr(gc, 'freeze'):
+        gc.freeze()
+    pids = []
+    for n in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            # never return into the fork loop of the master, not even on
+            # KeyboardInterrupt or SystemExit
+            code = 1
+            try:
+                code = run_worker(platform, n)
+            finally:
+                os._exit(code)
+        pids.append(pid)
+        logging.info('Started worker %d (pid %d)', n, pid)
+    failed = 0
+    for pid in pids:
+        pid, status = os.waitpid(pid, 0)
+        if os.waitstatus_to_exitcode(status) != 0:
+            failed += 1
+            logging.error('Worker with pid %d failed with status %d', pid, status)
+    platform.shutdown()
+    if failed:
+        sys.exit(1)
+
+
+def run_worker(platform, n):
+    """Runs a forked worker. Returns the exit code of the worker process."""
+    try:
+        platform.start_worker()
+        platform.shutdown_worker()
+        return 0
+    except Exception:
+        logging.exception('Worker %d failed', n)
+        return 1
+    finally:
+        logging.shutdown()
+
 if __name__ == '__main__':
     ctl_main()
@@ -0,0 +1,260 @@
+#    This file is part of Termite Plugins Platform
+#    Copyright (C) 2014 Pavle Jonoski
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Content-addressed store of plugin versions.
+
+The store keeps the files of many versions of many plugins, each distinct file
+content stored once:
+
+    <store>/objects/<2 hex digits>/<rest of the sha256 hex digest>
+    <store>/trees/<plugin id>/<version>.tree
+
+A tree is the JSON description of one plugin version: the store location and,
+for each resource path in the plugin, the hash of its content, its size and the
+modification time of the original file. Files identical between versions map to
+the same object, so they take the disk space once and share the page cache.
+
+A tree file is a plugin reference on its own: put (or link) the tree of the
+version to run into a plugins directory and the platform loads the plugin from
+the store (see StoredPlugin). Rolling back means pointing at another tree.
+"""
+
+import hashlib
+import json
+import os
+import os.path
+import threading
+
+from termite.plugins.support import ExplodedPlugin, PluginManifestParser, PluginResource, ResourceIndexEntry, \
+    map_file
+
+__author__ = 'pavle'
+
+
+TREE_EXTENSION = '.tree'
+HASH_ALGORITHM = 'sha256'
+CHUNK_SIZE = 1024 * 1024
+
+
+class PluginStore:
+    """Content-addressed store of plugin versions."""
+
+    def __init__(self, root, manifest_parser=None):
+        self.root = os.path.abspath(root)
+        self.objects_dir = os.path.join(self.root, 'objects')
+        self.trees_dir = os.path.join(self.root, 'trees')
+        self.manifest_parser = manifest_parser or PluginManifestParser()
+
+    def object_path(self, digest):
+        return os.path.join(self.objects_dir, digest[:2], digest[2:])
+
+    def tree_path(self, plugin_id, version):
+        return os.path.join(self.trees_dir, plugin_id, version + TREE_EXTENSION)
+
+    def add_plugin(self, path):
+        """Adds the exploded plugin in the directory to the store.
+
+        The files are hashed while they are copied into the store, one chunk at
+        a time. A file that has the same size and modification time as in an
+        earlier tree added from the same directory is not read again: the hash
+        from that tree is reused.
+
+        Returns the path of the tree of the plugin version.
+        """
+        plugin = ExplodedPlugin(path, self.manifest_parser)
+        manifest = plugin.get_manifest()
+        known = self.known_files(plugin.path)
+        files = {}
+        for rc_path in plugin.walk_resources():
+            full_path = plugin.get_path(rc_path)
+            st = os.stat(full_path)
+            entry = known.get(rc_path)
+            if not (entry and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns and
+                    os.path.exists(self.object_path(entry['hash']))):
+                entry = {'hash': self.add_object(full_path), 'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+            files[rc_path] = entry
+        tree = {
+            'store': self.root,
+            'source': plugin.path,
+            'id': manifest.id,
+            'version': manifest.version,
+            'files': files
+        }
+        tree_path = self.tree_path(manifest.id, manifest.version)
+        write_atomic(tree_path, json.dumps(tree, indent=1, sort_keys=True).encode('utf-8'))
+        return tree_path
+
+    def add_object(self, path):
+        """Copies the file into the store, hashing it on the way. Returns the
+        hash of the file content.
+        """
+        os.makedirs(self.objects_dir, exist_ok=True)
+        tmp_path = os.path.join(self.objects_dir, '.tmp-%d-%d' % (os.getpid(), threading.get_ident()))
+        digest = hashlib.new(HASH_ALGORITHM)
+        try:
+            with open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+                while True:
+                    chunk = src.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    dst.write(chunk)
+            digest = digest.hexdigest()
+            object_path = self.object_path(digest)
+            if os.path.exists(object_path):
+                os.remove(tmp_path)
+            else:
+                os.makedirs(os.path.dirname(object_path), exist_ok=True)
+                os.chmod(tmp_path, 0o444)
+                os.replace(tmp_path, object_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return digest
+
+    def known_files(self, source):
+        """Returns the files of the trees added from the source directory, the
+        newest tree winning.
+        """
+        known = {}
+        for tree in sorted(self.trees(), key=lambda t: os.stat(t).st_mtime_ns):
+            content = read_tree(tree)
+            if content.get('source') == source:
+                known.update(content['files'])
+        return known
+
+    def trees(self):
+        """Returns the paths of all trees in the store."""
+        trees = []
+        if not os.path.isdir(self.trees_dir):
+            return trees
+        for plugin_id in os.listdir(self.trees_dir):
+            plugin_dir = os.path.join(self.trees_dir, plugin_id)
+            trees.extend(os.path.join(plugin_dir, name) for name in os.listdir(plugin_dir)
+                         if name.endswith(TREE_EXTENSION))
+        return trees
+
+    def versions(self, plugin_id):
+        """Returns the versions of the plugin in the store."""
+        plugin_dir = os.path.join(self.trees_dir, plugin_id)
+        if not os.path.isdir(plugin_dir):
+            return []
+        return sorted(name[:-len(TREE_EXTENSION)] for name in os.listdir(plugin_dir) if name.endswith(TREE_EXTENSION))
+
+    def get_plugin(self, plugin_id, version):
+        """Returns the StoredPlugin resource of a plugin version."""
+        return StoredPlugin(self.tree_path(plugin_id, version), self.manifest_parser)
+
+    def remove_version(self, plugin_id, version):
+        """Removes the tree of a plugin version. The objects are removed by gc."""
+        os.remove(self.tree_path(plugin_id, version))
+
+    def gc(self):
+        """Removes the objects not referenced by any tree. Returns the number of
+        removed objects.
+        """
+        referenced = set()
+        for tree in self.trees():
+            referenced.update(f['hash'] for f in read_tree(tree)['files'].values())
+        removed = 0
+        if not os.path.isdir(self.objects_dir):
+            return removed
+        for prefix in os.listdir(self.objects_dir):
+            prefix_dir = os.path.join(self.objects_dir, prefix)
+            if not os.path.isdir(prefix_dir):
+                continue
+            for name in os.listdir(prefix_dir):
+                if prefix + name not in referenced:
+                    os.remove(os.path.join(prefix_dir, name))
+                    removed += 1
+        return removed
+
+
+def read_tree(path):
+    with open(path, 'rb') as tree_file:
+        return json.loads(tree_file.read().decode('utf-8'))
+
+
+def write_atomic(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = '%s.tmp-%d-%d' % (path, os.getpid(), threading.get_ident())
+    with open(tmp_path, 'wb') as tmp:
+        tmp.write(content)
+    os.replace(tmp_path, path)
+
+
+class StoredPlugin(PluginResource):
+    """A plugin version in a PluginStore, loaded from its tree file.
+
+    The resources are read from the store objects. A tree never changes once
+    written, so the resources index is built once.
+    """
+
+    def __init__(self, path, manifest_parser):
+        PluginResource.__init__(self, path, manifest_parser, 'store')
+        self.tree = read_tree(self.path)
+        self.store = PluginStore(self.tree['store'], manifest_parser)
+        self.files = dict((os.path.normpath(p), f) for p, f in self.tree['files'].items())
+
+    def object_path(self, path):
+        entry = self.files.get(os.path.normpath(path))
+        if entry is None:
+            raise OSError('Resource %s not found' % path)
+        return self.store.object_path(entry['hash'])
+
+    def build_index(self):
+        index = {'': ResourceIndexEntry('.', False)}
+        for rc_path in self.files:
+            index.setdefault(rc_path.casefold(), ResourceIndexEntry(rc_path, True))
+            parent = os.path.dirname(rc_path)
+            while parent and parent.casefold() not in index:
+                index[parent.casefold()] = ResourceIndexEntry(parent, False)
+                parent = os.path.dirname(parent)
+        return index, None
+
+    def do_load_resource(self, real_name):
+        return open(self.object_path(real_name))
+
+    def do_map_resource(self, real_name):
+        return map_file(self.object_path(real_name))
+
+    def list(self, full_path):
+        prefix = os.path.normpath(full_path)
+        prefix = '' if prefix == '.' else prefix + os.path.sep
+        names = set()
+        for rc_path in self.files:
+            if rc_path.startswith(prefix):
+                names.add(rc_path[len(prefix):].split(os.path.sep)[0])
+        return sorted(names)
+
+    def check_resource_exist(self, path):
+        if path == '.':
+            return True
+        path = os.path.normpath(path)
+        if path in self.files:
+            return True
+        entry = self.get_index_entry(path)
+        return entry is not None and entry.path == path
+
+    def check_resource_is_file(self, path):
+        return os.path.normpath(path) in self.files
+
+    def check_resource_stats(self, path):
+        entry = self.files.get(os.path.normpath(path))
+        if entry is None:
+            raise OSError('Resource %s not found' % path)
+        return {'mtime': entry['mtime_ns'] / 1e9, 'size': entry['size']}
@@ -15,15 +15,22 @@
 #    along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import abc
+import io
+import json
+import queue
+import mmap
 from os.path import isdir
 import os.path
-from os import listdir
+import threading
+import time
+import zipfile
 from termite.resources import BaseResourceLoader, ProtocolHandler
 
 __author__ = 'pavle'
 
 import logging
 import re
+import struct
 
 """
 Plugin structure:
@@ -39,6 +46,7 @@ Plugin-Classes: <fully-qualified-classname>,...
 Requires: <RequiresEntrySpec>,...
 Exports: <ExportsEntrySpec>,...
 Requires-Plugins: <RequiresEntrySpec>,...
+Lazy-Loading: true|false - optional, defaults to false
 
 Example:
 
@@ -140,6 +148,7 @@ class PluginManifest:
         self.requires = []
         self.requires_plugins = []
         self.exports = []
+        self.lazy_loading = False
 
     def __str__(self, *args, **kwargs):
         return "<PluginManifest> id=%s, version=%s" % (self.id, self.version)
@@ -153,6 +162,7 @@ class PluginManifestBuilder:
         self._requires = []
         self._requires_plugins = []
         self._exports = []
+        self._lazy_loading = False
 
     def id(self, id):
         self._id = id
@@ -182,6 +192,10 @@ class PluginManifestBuilder:
         self._exports = exports_entries
         return self
 
+    def lazy_loading(self, lazy_loading):
+        self._lazy_loading = lazy_loading
+        return self
+
     def build(self):
         manifest = PluginManifest()
         manifest.id = self._id
@@ -190,16 +204,77 @@ class PluginManifestBuilder:
         manifest.requires = self._requires
         manifest.requires_plugins = self._requires_plugins
         manifest.exports = self._exports
+        manifest.lazy_loading = self._lazy_loading
 
         return manifest
 
 
+class MappedResource:
+    """A read-only memoryview of the content of a resource.
+
+    Use it as a context manager (the view is the value of the with statement)
+    or call close() when done. Closing releases the view and unmaps the
+    resource. The view must not be used after that. If slices of the view are
+    still alive, they stay valid and the resource is unmapped when the last one
+    is released.
+    """
+
+    def __init__(self, view, mapping=None):
+        self.view = view
+        self.mapping = mapping
+
+    def close(self):
+        self.view.release()
+        if self.mapping is not None:
+            try:
+                self.mapping.close()
+            except BufferError:
+                # slices of the view are alive; unmapped with the last one
+                pass
+            self.mapping = None
+
+    def __enter__(self):
+        return self.view
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def map_file(path):
+    """Maps a file read-only into memory. Returns a MappedResource."""
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return MappedResource(memoryview(b''))
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return MappedResource(memoryview(mapping), mapping)
+
+
+class ResourceIndexEntry:
+    """An entry of the case-folded index of the plugin resources."""
+
+    __slots__ = ('path', 'is_file')
+
+    def __init__(self, path, is_file):
+        self.path = path
+        self.is_file = is_file
+
+
+def fold_path(path):
+    """Returns the key of a resource path in the case-folded resources index."""
+    path = os.path.normpath(path)
+    if path == '.':
+        return ''
+    return path.casefold()
+
+
 class PluginResource:
     def __init__(self, path, manifest_parser, archive_type='dir'):
         self.type = archive_type
         self.manifest = None
         self.path = os.path.abspath(path)
         self.manifest_parser = manifest_parser
+        self.index = None
+        self.index_signature = None
 
     def get_manifest(self):
         if not self.manifest:
@@ -208,44 +283,155 @@ class PluginResource:
 
     def load_manifest(self):
         if self.resource_exists('PLUGIN.MF', True):
-            manifest_stream = self.read_resource('PLUGIN.MF', True)
-            return self.manifest_parser.parse(manifest_stream)
+            with self.read_resource('PLUGIN.MF', True) as manifest_stream:
+                return self.manifest_parser.parse(manifest_stream)
         raise Exception('Plugin does not contain manifest file')
 
     def read_resource(self, resource_path, ignore_case=False):
-        if self.resource_exists(resource_path, ignore_case) and self.resource_is_file(resource_path, ignore_case):
-            if ignore_case:
-                resource_path = self.get_real_rc_name(resource_path)
-            return self.do_load_resource(resource_path)
+        return self.open_resource(resource_path, ignore_case, self.do_load_resource)
+
+    def open_resource(self, resource_path, ignore_case, do_open):
+        """Opens a resource found in the index with do_open.
+
+        The index is not checked on a hit, so it may still have a resource
+        removed since the index was built. If opening the resource fails and
+        the index is stale, the index is rebuilt and the resource looked up
+        again, so a removed resource is reported as not found.
+        """
+        for retry in (False, True):
+            if not (self.resource_exists(resource_path, ignore_case) and
+                    self.resource_is_file(resource_path, ignore_case)):
+                break
+            real_name = self.get_real_rc_name(resource_path) if ignore_case else resource_path
+            try:
+                return do_open(real_name)
+            except OSError:
+                if retry or not self.is_index_stale(fold_path(real_name)):
+                    raise
+                self.rebuild_index()
         raise Exception('Resource %s not found' % resource_path)
 
     def read_resource_fully(self, resource_path, ignore_case=False):
-        rc_stream = self.read_resource(resource_path, ignore_case)
-        return rc_stream.read()
+        with self.read_resource(resource_path, ignore_case) as rc_stream:
+            return rc_stream.read()
+
+    def map_resource(self, resource_path, ignore_case=False):
+        """Maps the content of a resource into memory, without copying it.
+
+        Returns a MappedResource: a context manager that gives a read-only
+        memoryview of the resource content and unmaps the resource on exit.
+        """
+        return self.open_resource(resource_path, ignore_case, self.do_map_resource)
+
+    def read_resource_bytes(self, resource_path, ignore_case=False):
+        """Returns the content of a resource as bytes."""
+        with self.map_resource(resource_path, ignore_case) as view:
+            return view.tobytes()
+
+    def do_map_resource(self, real_name):
+        """Maps a resource. This implementation reads the whole resource; the
+        subclasses map it instead, where they can.
+        """
+        with self.do_load_resource(real_name) as rc_stream:
+            content = rc_stream.read()
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        return MappedResource(memoryview(content))
 
     def resource_exists(self, path, ignore_case=False):
         if not ignore_case:
+            entry = self.get_index_entry(path)
+            if entry and entry.path == os.path.normpath(path):
+                return True
             return self.check_resource_exist(path)
         return self.get_real_rc_name(path) is not None
 
     def resource_is_file(self, path, ignore_case=False):
+        entry = self.get_index_entry(path)
         if not ignore_case:
+            if entry and entry.path == os.path.normpath(path):
+                return entry.is_file
             return self.check_resource_is_file(path)
-        rc_name = self.get_real_rc_name(path)
-        if rc_name:
-            return self.check_resource_is_file(rc_name)
+        if entry:
+            return entry.is_file
         raise Exception('Resource %s not found' % path)
 
     def get_real_rc_name(self, path):
-        dirname = os.path.dirname(path) or '.'
-        rc_name = os.path.basename(path)
-        if dirname and self.check_resource_exist(dirname):
-            list = self.list(dirname)
-            rc_name = rc_name.upper()
-            for l in list:
-                if l.upper() == rc_name:
-                    return os.path.join(dirname, l)
-        return None
+        entry = self.get_index_entry(path)
+        return entry.path if entry else None
+
+    def get_index_entry(self, path):
+        """Looks up a resource in the case-folded resources index.
+
+        The index is built on the first lookup. A miss checks the index
+        signature for the missed path and rebuilds the index if the resources
+        have changed since it was built.
+        """
+        key = fold_path(path)
+        index = self.index
+        if index is None:
+            index = self.rebuild_index()
+        entry = index.get(key)
+        if entry is None and self.is_index_stale(key):
+            entry = self.rebuild_index().get(key)
+        return entry
+
+    def rebuild_index(self):
+        index, signature = self.build_index()
+        self.index, self.index_signature = index, signature
+        return index
+
+    def invalidate_index(self):
+        self.index = None
+        self.index_signature = None
+
+    def is_index_stale(self, key=None):
+        """Checks whether the index is stale: for the case-folded resource path
+        key (see fold_path), or as a whole if no key is given.
+        """
+        signature = self.index_signature
+        if signature is None:
+            return False
+        if key is None:
+            return signature != self.compute_index_signature(signature)
+        return self.is_index_stale_for(signature, key)
+
+    def is_index_stale_for(self, signature, key):
+        """Checks the part of the index signature that covers the case-folded
+        resource path key. This implementation checks the whole signature.
+        """
+        return signature != self.compute_index_signature(signature)
+
+    def build_index(self):
+        """Builds the case-folded index of all resources in the plugin.
+
+        Returns a tuple (index, signature) - the index maps the case-folded
+        resource path to a ResourceIndexEntry, and the signature is used to
+        check whether the index is stale (see compute_index_signature). This
+        implementation walks the plugin with list and check_resource_is_file and
+        has no signature, so the index never goes stale.
+        """
+        index = {'': ResourceIndexEntry('.', False)}
+        pending = ['']
+        while pending:
+            path = pending.pop()
+            for name in self.list(path or '.'):
+                rc_path = os.path.join(path, name) if path else name
+                is_file = self.check_resource_is_file(rc_path)
+                index.setdefault(rc_path.casefold(), ResourceIndexEntry(rc_path, is_file))
+                if not is_file:
+                    pending.append(rc_path)
+        return index, None
+
+    def compute_index_signature(self, signature):
+        """Computes the current value of an index signature returned by
+        build_index.
+        """
+        return signature
+
+    def close(self):
+        """Releases the resources held open by the plugin, if any."""
+        pass
 
     @abc.abstractclassmethod
     def do_load_resource(self, real_name):
@@ -263,6 +449,45 @@ class PluginResource:
     def check_resource_is_file(self, path):
         pass
 
+    def resource_stats(self, path):
+        """Returns the modification time and the size of the resource as a
+        dictionary with keys 'mtime' and 'size'.
+
+        Raises OSError if the resource does not exist.
+        """
+        return self.check_resource_stats(path)
+
+    @abc.abstractclassmethod
+    def check_resource_stats(self, path):
+        pass
+
+    def walk_resources(self, path=''):
+        """Yields the paths of all files in the plugin under the given
+        directory (the plugin root by default).
+        """
+        index = self.index
+        if index is None or self.is_index_stale():
+            index = self.rebuild_index()
+        prefix = fold_path(path)
+        if prefix:
+            prefix += os.path.sep
+        for key, entry in list(index.items()):
+            if entry.is_file and key.startswith(prefix):
+                yield entry.path
+
+    def module_names(self):
+        """Yields the names of all python modules in the plugin."""
+        for rc_path in self.walk_resources():
+            name, ext = os.path.splitext(rc_path)
+            if ext != '.py':
+                continue
+            name = name.replace(os.path.sep, '.')
+            if name == '__init__':
+                continue
+            if name.endswith('.__init__'):
+                name = name[:-len('.__init__')]
+            yield name
+
     def get_path(self, path):
         return os.path.abspath(os.path.sep.join((self.path, path)))
 
@@ -280,7 +505,7 @@ class PluginResource:
 
     def read_code(self, path):
         rc_name = path
-        if self.is_package(path):
+        if not path.endswith('.py') and self.is_package(path):
             rc_name = os.path.join(path, '__init__.py')
         return self.read_resource_fully(rc_name, True)
 
@@ -300,6 +525,9 @@ class ExplodedPlugin(PluginResource):
     def do_load_resource(self, real_name):
         return open(self.get_path(real_name))
 
+    def do_map_resource(self, real_name):
+        return map_file(self.get_path(real_name))
+
     def list(self, full_path):
         return os.listdir(self.get_path(full_path))
 
@@ -313,11 +541,202 @@ class ExplodedPlugin(PluginResource):
             return False
         return os.path.isfile(self.get_path(path))
 
+    def check_resource_stats(self, path):
+        st = os.stat(self.get_path(path))
+        return {'mtime': st.st_mtime, 'size': st.st_size}
+
+    def build_index(self):
+        """Walks the plugin directory once with os.scandir.
+
+        The signature maps the case-folded path of every directory in the
+        plugin to the directory path and modification time, which changes when
+        a file is added to, removed from or renamed in that directory.
+        """
+        index = {'': ResourceIndexEntry('.', False)}
+        signature = {'': ('', os.stat(self.path).st_mtime_ns)}
+        pending = ['']
+        while pending:
+            path = pending.pop()
+            with os.scandir(os.path.join(self.path, path)) as entries:
+                for dir_entry in entries:
+                    rc_path = os.path.join(path, dir_entry.name) if path else dir_entry.name
+                    is_dir = dir_entry.is_dir()
+                    index.setdefault(rc_path.casefold(), ResourceIndexEntry(rc_path, not is_dir))
+                    if is_dir:
+                        signature[rc_path.casefold()] = (rc_path, dir_entry.stat().st_mtime_ns)
+                        pending.append(rc_path)
+        return index, signature
+
+    def compute_index_signature(self, signature):
+        current = {}
+        for key, (path, mtime) in signature.items():
+            try:
+                current[key] = (path, os.stat(os.path.join(self.path, path)).st_mtime_ns)
+            except OSError:
+                pass
+        return current
+
+    def is_index_stale_for(self, signature, key):
+        """Checks only the nearest indexed directory containing the path, with
+        a single stat: adding the resource, or any new directory on its path,
+        changes the modification time of that directory.
+        """
+        parent = os.path.dirname(key)
+        while parent not in signature:
+            parent = os.path.dirname(parent)
+        path, mtime = signature[parent]
+        try:
+            return os.stat(os.path.join(self.path, path)).st_mtime_ns != mtime
+        except OSError:
+            return True
+
+
+LOCAL_FILE_HEADER = '<4s5H3I2H'
+LOCAL_FILE_HEADER_SIZE = struct.calcsize(LOCAL_FILE_HEADER)
+
+
+class ZipPlugin(PluginResource):
+    """A plugin packed in a single zip archive.
+
+    The central directory of the archive is read once into the resources index
+    and all resources are read through a single open handle of the archive. The
+    index signature is the modification time and size of the archive file, so a
+    replaced archive is reopened and indexed again.
+    """
+
+    def __init__(self, path, manifest_parser):
+        PluginResource.__init__(self, path, manifest_parser, 'zip')
+        self.archive = None
+        self.archive_pid = None
+        self.archive_map = None
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def get_archive(self):
+        """Returns the open archive.
+
+        A process forked after the archive was opened reopens it, so that the
+        processes do not share the file offset of the handle.
+        """
+        archive = self.archive
+        if archive is None or self.archive_pid != os.getpid():
+            with self.lock:
+                if self.archive is None or self.archive_pid != os.getpid():
+                    self.archive = zipfile.ZipFile(self.path)
+                    self.archive_pid = os.getpid()
+                archive = self.archive
+        return archive
+
+    def get_archive_map(self):
+        """Returns the archive file mapped into memory."""
+        archive_map = self.archive_map
+        if archive_map is None:
+            with self.lock:
+                if self.archive_map is None:
+                    with open(self.path, 'rb') as f:
+                        self.archive_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                archive_map = self.archive_map
+        return archive_map
+
+    def build_index(self):
+        with self.lock:
+            if self.archive is not None and self.archive_pid == os.getpid():
+                self.archive.close()
+            self.archive = None
+            self.close_archive_map()
+        signature = self.compute_index_signature(None)
+        archive = self.get_archive()
+        index = {'': ResourceIndexEntry('.', False)}
+        entries = {}
+        for info in archive.infolist():
+            rc_path = os.path.normpath(info.filename.rstrip('/').replace('/', os.path.sep))
+            is_file = not info.is_dir()
+            if is_file:
+                entries[rc_path] = info
+            index.setdefault(rc_path.casefold(), ResourceIndexEntry(rc_path, is_file))
+            parent = os.path.dirname(rc_path)
+            while parent and parent.casefold() not in index:
+                index[parent.casefold()] = ResourceIndexEntry(parent, False)
+                parent = os.path.dirname(parent)
+        self.entries = entries
+        return index, signature
+
+    def compute_index_signature(self, signature):
+        st = os.stat(self.path)
+        return st.st_mtime_ns, st.st_size
+
+    def get_entry(self, path):
+        if self.index is None:
+            self.rebuild_index()
+        return self.entries.get(os.path.normpath(path))
+
+    def do_load_resource(self, real_name):
+        entry = self.get_entry(real_name)
+        return io.TextIOWrapper(self.get_archive().open(entry))
+
+    def do_map_resource(self, real_name):
+        """Maps an archive entry. An entry stored without compression is a
+        view straight into the mapped archive; a compressed entry is
+        decompressed into memory.
+        """
+        entry = self.get_entry(real_name)
+        if entry.compress_type != zipfile.ZIP_STORED or entry.flag_bits & 0x1:
+            return MappedResource(memoryview(self.get_archive().read(entry)))
+        archive_map = self.get_archive_map()
+        header = struct.unpack(LOCAL_FILE_HEADER, archive_map[entry.header_offset:entry.header_offset + LOCAL_FILE_HEADER_SIZE])
+        start = entry.header_offset + LOCAL_FILE_HEADER_SIZE + header[-2] + header[-1]
+        return MappedResource(memoryview(archive_map)[start:start + entry.file_size])
+
+    def list(self, full_path):
+        entry = self.get_index_entry(full_path)
+        if entry is None or entry.is_file:
+            raise OSError('Not a directory: %s' % full_path)
+        index = self.index
+        prefix = fold_path(full_path)
+        if prefix:
+            prefix += os.path.sep
+        return [os.path.basename(e.path) for key, e in index.items()
+                if key and key.startswith(prefix) and os.path.sep not in key[len(prefix):]]
+
+    def check_resource_exist(self, path):
+        if path == '.':
+            return True
+        path = os.path.normpath(path)
+        entry = self.get_index_entry(path)
+        return (entry is not None and entry.path == path) or path in self.entries
+
+    def check_resource_is_file(self, path):
+        return self.get_entry(path) is not None
+
+    def check_resource_stats(self, path):
+        entry = self.get_entry(path)
+        if entry is None:
+            raise OSError('Resource %s not found' % path)
+        return {'mtime': time.mktime(entry.date_time + (0, 0, -1)), 'size': entry.file_size}
+
+    def close(self):
+        with self.lock:
+            if self.archive is not None and self.archive_pid == os.getpid():
+                self.archive.close()
+            self.archive = None
+            self.close_archive_map()
+
+    def close_archive_map(self):
+        # called with the lock held
+        if self.archive_map is not None:
+            try:
+                self.archive_map.close()
+            except BufferError:
+                # resources still mapped; unmapped when the last one is closed
+                pass
+            self.archive_map = None
+
 
 class PluginLoaderHandler(ProtocolHandler):
     def __init__(self, resource_loader):
         ProtocolHandler.__init__(self, 'plugin', resource_loader)
         self.manifest_parser = PluginManifestParser()
+        self.manifest_indexes = {}
 
     def load(self, path, *args, **kwargs):
         if isdir(path):
@@ -327,11 +746,60 @@ class PluginLoaderHandler(ProtocolHandler):
 
     def load_exploded_plugin(self, path):
         plugin_rc = ExplodedPlugin(path, self.manifest_parser)
+        self.load_manifest(plugin_rc)
         self.basic_plugin_check(plugin_rc)
         return plugin_rc
 
     def load_archive_plugin(self, path):
-        raise Exception('Archived plugins not supported (yet)!')
+        from termite.plugins.store import TREE_EXTENSION, StoredPlugin
+        from termite.plugins.wheels import WHEEL_EXTENSION, WheelPlugin
+        if path.lower().endswith(WHEEL_EXTENSION):
+            plugin_rc = WheelPlugin(path, self.manifest_parser)
+        elif path.endswith(TREE_EXTENSION):
+            plugin_rc = StoredPlugin(path, self.manifest_parser)
+        elif zipfile.is_zipfile(path):
+            plugin_rc = ZipPlugin(path, self.manifest_parser)
+        else:
+            raise Exception('Unsupported plugin archive: %s' % path)
+        self.load_manifest(plugin_rc)
+        self.basic_plugin_check(plugin_rc)
+        return plugin_rc
+
+    def add_manifest_index(self, location):
+        """Keeps the manifests of the plugins in the location in a ManifestIndex.
+        Returns the index.
+        """
+        location = os.path.abspath(location)
+        index = self.manifest_indexes.get(location)
+        if index is None:
+            index = self.manifest_indexes[location] = ManifestIndex(location)
+            index.load()
+        return index
+
+    def find_manifest_index(self, path):
+        """Returns the manifest index of the location containing the plugin, or
+        None.
+        """
+        for location, index in self.manifest_indexes.items():
+            if path.startswith(location + os.path.sep):
+                return index
+        return None
+
+    def save_manifest_indexes(self):
+        for index in self.manifest_indexes.values():
+            index.save()
+
+    def load_manifest(self, plugin_rc):
+        """Loads the plugin manifest, from the manifest index of the plugin
+        location if the plugin is in the index and has not changed.
+        """
+        index = self.find_manifest_index(plugin_rc.path)
+        if index is None:
+            return plugin_rc.get_manifest()
+        plugin_rc.manifest = index.get(plugin_rc.path)
+        if plugin_rc.manifest is None:
+            index.put(plugin_rc.path, plugin_rc.get_manifest())
+        return plugin_rc.manifest
 
     def basic_plugin_check(self, plugin_rc):
         manifest = plugin_rc.get_manifest()
@@ -369,6 +837,10 @@ class PluginManifestParser:
         "REQUIRES-PLUGINS": {
             "content_handler": "read_requires_plugins",
             "property": "requires_plugins"
+        },
+        "LAZY-LOADING": {
+            "content_handler": "read_lazy_loading",
+            "property": "lazy_loading"
         }
     }
 
@@ -442,6 +914,9 @@ class PluginManifestParser:
     def read_requires_plugins(self, content):
         return self.get_general_requires_entries(content)
 
+    def read_lazy_loading(self, content):
+        return content.strip().lower() in ('true', 'yes', '1')
+
     def read_unknown_block(self, block, content):
         logger.warn("Unknown block [%s] in manifest. Content: %s" % (block, content))
 
@@ -484,21 +959,242 @@ class PluginManifestParser:
         return ExportsEntry(entry_name=export, export_version=version, is_package=False)
 
 
+ARCHIVE_EXTENSIONS = ('.zip', '.whl', '.tree')
+
+
 def is_plugin(path):
     if not os.path.exists(path):
         return False
     if os.path.isdir(path):
         manifest_path = os.path.join(path, 'PLUGIN.MF')
         return os.path.exists(manifest_path) and os.path.isfile(manifest_path)
+    elif os.path.splitext(path)[1].lower() in ARCHIVE_EXTENSIONS:
+        return is_archive_plugin(path)
     else:
         return False
 
 
-def plugin_references_from_location(path):
-    refs = []
-    if os.path.isdir(path):
-        for child in listdir(path):
-            ref = os.path.join(path, child)
-            if is_plugin(ref):
-                refs.append(ref)
-    return refs
+def is_archive_plugin(path):
+    """Checks whether the file is a zip archive with a plugin manifest in its
+    root, a wheel or a plugin store tree.
+    """
+    from termite.plugins.store import TREE_EXTENSION
+    from termite.plugins.wheels import WHEEL_EXTENSION, is_wheel
+    if path.lower().endswith(WHEEL_EXTENSION):
+        return is_wheel(path)
+    if path.endswith(TREE_EXTENSION):
+        return True
+    try:
+        with zipfile.ZipFile(path) as archive:
+            return any(name.upper() == 'PLUGIN.MF' for name in archive.namelist())
+    except (OSError, zipfile.BadZipFile):
+        return False
+
+
+def plugin_references_from_location(path, manifest_index=None):
+    """Returns the references of the plugins directly in the location. See
+    scan_location.
+    """
+    return list(scan_location(path, 1, manifest_index))
+
+
+def scan_location(location, max_depth=1, manifest_index=None, stop=None):
+    """Yields the references of the plugins in the location, as they are found.
+
+    The location is scanned with os.scandir. A directory that is not a plugin is
+    searched for plugins in turn, down to max_depth levels below the location
+    (1 means only the children of the location). Entries with names starting
+    with a dot are skipped. The children found unchanged in the manifest_index
+    (a ManifestIndex of the location) are taken as plugins without further
+    checks. The scan ends early when the stop event is set.
+    """
+    if not os.path.isdir(location):
+        return
+    pending = [(location, 1)]
+    while pending:
+        path, depth = pending.pop()
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if stop is not None and stop.is_set():
+                    return
+                if entry.name.startswith('.'):
+                    continue
+                if manifest_index is not None and manifest_index.is_fresh(os.path.abspath(entry.path)):
+                    yield entry.path
+                elif entry.is_dir():
+                    if os.path.isfile(os.path.join(entry.path, 'PLUGIN.MF')):
+                        yield entry.path
+                    elif depth < max_depth:
+                        pending.append((entry.path, depth + 1))
+                elif os.path.splitext(entry.name)[1].lower() in ARCHIVE_EXTENSIONS and is_archive_plugin(entry.path):
+                    yield entry.path
+
+
+def discover_plugins(locations, max_depth=1, manifest_indexes=None):
+    """Yields the references of the plugins in all locations, as they are found.
+
+    Each location is scanned in its own thread (see scan_location), so the
+    references of different locations come interleaved. manifest_indexes maps
+    the absolute path of a location to its ManifestIndex. An error scanning any
+    location is raised to the caller; the remaining scans are stopped when the
+    caller stops iterating.
+    """
+    manifest_indexes = manifest_indexes or {}
+    locations = [location for location in locations if location]
+    if len(locations) == 1:
+        yield from scan_location(locations[0], max_depth, manifest_indexes.get(os.path.abspath(locations[0])))
+        return
+    found = queue.Queue()
+    stop = threading.Event()
+
+    def scan(location):
+        try:
+            for ref in scan_location(location, max_depth, manifest_indexes.get(os.path.abspath(location)), stop):
+                found.put(ref)
+        except Exception as e:
+            found.put(e)
+        finally:
+            found.put(None)
+
+    for location in locations:
+        threading.Thread(target=scan, args=(location,), name='plugins-scan-%s' % location, daemon=True).start()
+    try:
+        remaining = len(locations)
+        while remaining:
+            ref = found.get()
+            if ref is None:
+                remaining -= 1
+            elif isinstance(ref, Exception):
+                raise ref
+            else:
+                yield ref
+    finally:
+        stop.set()
+
+
+MANIFEST_INDEX_FILE = '.plugins-index.json'
+MANIFEST_INDEX_VERSION = 1
+
+
+def manifest_to_dict(manifest):
+    def requires_to_dict(entry):
+        return {'name': entry.name, 'version_range': entry.version_range, 'is_package': entry.is_package,
+                'is_plugin': entry.is_plugin}
+
+    return {
+        'id': manifest.id,
+        'version': manifest.version,
+        'plugin_classes': manifest.plugin_classes,
+        'requires': [requires_to_dict(r) for r in manifest.requires],
+        'requires_plugins': [requires_to_dict(r) for r in manifest.requires_plugins],
+        'exports': [{'name': e.name, 'version': e.version, 'is_package': e.is_package} for e in manifest.exports],
+        'lazy_loading': manifest.lazy_loading
+    }
+
+
+def manifest_from_dict(content):
+    def requires_from_dict(entry):
+        return RequiresEntry(entry_name=entry['name'], version_range=[tuple(v) for v in entry['version_range']],
+                             is_package=entry['is_package'], is_plugin=entry['is_plugin'])
+
+    return PluginManifestBuilder().id(content['id']) \
+        .version(content['version']) \
+        .plugin_classes(content['plugin_classes']) \
+        .requires([requires_from_dict(r) for r in content['requires']]) \
+        .requires_plugins([requires_from_dict(r) for r in content['requires_plugins']]) \
+        .exports([ExportsEntry(entry_name=e['name'], export_version=e['version'], is_package=e['is_package'])
+                  for e in content['exports']]) \
+        .lazy_loading(content['lazy_loading']) \
+        .build()
+
+
+def manifest_stats(plugin_path):
+    """Returns the (mtime in nanoseconds, size) of the file holding the plugin
+    manifest: the PLUGIN.MF of an exploded plugin or the plugin archive itself.
+    """
+    try:
+        st = os.stat(os.path.join(plugin_path, 'PLUGIN.MF'))
+    except NotADirectoryError:
+        st = os.stat(plugin_path)
+    return st.st_mtime_ns, st.st_size
+
+
+class ManifestIndex:
+    """Persisted index of the plugin manifests in a plugins location.
+
+    The index is kept in a file in the location itself and maps the plugin
+    path to its parsed manifest, with the modification time and size of the
+    manifest file (see manifest_stats) when it was parsed. A plugin whose
+    manifest file has not changed is served from the index without reading
+    the manifest.
+
+    save() rewrites the index file atomically if any plugin was added or
+    changed, dropping the plugins that were not looked up since the index was
+    loaded. An index that cannot be written is logged and ignored.
+    """
+
+    def __init__(self, location):
+        self.location = os.path.abspath(location)
+        self.path = os.path.join(self.location, MANIFEST_INDEX_FILE)
+        self.entries = {}
+        self.seen = set()
+        self.dirty = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        try:
+            with open(self.path, 'rb') as index_file:
+                content = json.loads(index_file.read().decode('utf-8'))
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning('Ignoring the invalid manifest index %s: %s', self.path, e)
+            return
+        if content.get('version') == MANIFEST_INDEX_VERSION:
+            self.entries = content['plugins']
+
+    def is_fresh(self, plugin_path):
+        """Checks whether the plugin is in the index and has not changed since."""
+        entry = self.entries.get(plugin_path)
+        if entry is None:
+            return False
+        try:
+            return [entry['mtime_ns'], entry['size']] == list(manifest_stats(plugin_path))
+        except OSError:
+            return False
+
+    def get(self, plugin_path):
+        """Returns the indexed manifest of the plugin, or None if the plugin is
+        not in the index or has changed.
+        """
+        with self.lock:
+            self.seen.add(plugin_path)
+        if not self.is_fresh(plugin_path):
+            return None
+        return manifest_from_dict(self.entries[plugin_path]['manifest'])
+
+    def put(self, plugin_path, manifest):
+        mtime_ns, size = manifest_stats(plugin_path)
+        with self.lock:
+            self.seen.add(plugin_path)
+            self.entries[plugin_path] = {'mtime_ns': mtime_ns, 'size': size, 'manifest': manifest_to_dict(manifest)}
+            self.dirty = True
+
+    def save(self):
+        with self.lock:
+            removed = [path for path in self.entries if path not in self.seen]
+            for path in removed:
+                del self.entries[path]
+            if not (self.dirty or removed):
+                return
+            content = json.dumps({'version': MANIFEST_INDEX_VERSION, 'plugins': self.entries}, sort_keys=True)
+            tmp_path = '%s.tmp-%d' % (self.path, os.getpid())
+            try:
+                with open(tmp_path, 'wb') as tmp:
+                    tmp.write(content.encode('utf-8'))
+                os.replace(tmp_path, self.path)
+                self.dirty = False
+            except OSError as e:
+                logger.warning('Cannot write the manifest index %s: %s', self.path, e)
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
@@ -25,3 +25,355 @@
 """
 
 
+import base64
+from configparser import ConfigParser
+from email.parser import HeaderParser
+import hashlib
+import io
+import os.path
+import platform
+import re
+import sys
+import zipfile
+
+from termite.plugins.support import ExportsEntry, PluginManifestBuilder, RequiresEntry, ZipPlugin
+
+__author__ = 'pavle'
+
+
+WHEEL_EXTENSION = '.whl'
+SUPPORTED_WHEEL_VERSION = 1
+ENTRY_POINTS_GROUP = 'termite.plugins'
+EXTENSION_MODULES = ('.so', '.pyd')
+
+RGX_REQUIREMENT = re.compile('^(?P<name>[A-Za-z0-9][A-Za-z0-9._-]*)\\s*(\\[[^\\]]*\\])?\\s*\\(?(?P<specifiers>[^;)]*)\\)?')
+RGX_SPECIFIER = re.compile('^(?P<op>==|>=|<=|>|<)\\s*(?P<version>[\\w.]+)$')
+RGX_MARKER_TOKEN = re.compile('\\s*(?:(?P<string>\'[^\']*\'|"[^"]*")|(?P<op>===|==|!=|~=|<=|>=|<|>|not\\s+in\\b|in\\b)|'
+                              '(?P<paren>[()])|(?P<name>[A-Za-z_][A-Za-z0-9_.]*))')
+RGX_RELEASE = re.compile('^\\d+(\\.\\d+)*')
+
+
+class WheelError(Exception):
+    pass
+
+
+def find_dist_info(names):
+    """Returns the name of the .dist-info directory from the names of the
+    entries in the wheel archive, or None.
+    """
+    for name in names:
+        parts = name.split('/')
+        if len(parts) == 2 and parts[0].endswith('.dist-info') and parts[1] == 'WHEEL':
+            return parts[0]
+    return None
+
+
+def is_wheel(path):
+    """Checks whether the file is a wheel archive: a zip archive with the WHEEL
+    metadata file in its .dist-info directory.
+    """
+    try:
+        with zipfile.ZipFile(path) as archive:
+            return find_dist_info(archive.namelist()) is not None
+    except (OSError, zipfile.BadZipFile):
+        return False
+
+
+def parse_record(content):
+    """Parses the RECORD file of a wheel.
+
+    Returns a dictionary: resource path => (hash algorithm, digest, size). The
+    hash and the size are None for the entries that do not have them (the
+    RECORD file itself).
+    """
+    record = {}
+    for line in content.splitlines():
+        if not line.strip():
+            continue
+        path, file_hash, size = line.rsplit(',', 2)
+        if path.startswith('"') and path.endswith('"'):
+            path = path[1:-1].replace('""', '"')
+        algorithm, digest = file_hash.split('=', 1) if file_hash else (None, None)
+        record[os.path.normpath(path.replace('/', os.path.sep))] = (algorithm, digest, int(size) if size else None)
+    return record
+
+
+def parse_requirement(requirement):
+    """Maps a Requires-Dist requirement onto a plugin RequiresEntry.
+
+    The >=, >, <=, < and == version specifiers are mapped onto the version
+    range of the entry, any other specifiers are ignored. Returns None for the
+    requirements of extras and the requirements which environment marker does
+    not hold for the running interpreter (see evaluate_marker).
+    """
+    requirement, _, marker = requirement.partition(';')
+    if marker.strip() and not evaluate_marker(marker):
+        return None
+    m = RGX_REQUIREMENT.match(requirement.strip())
+    if not m:
+        raise WheelError('Invalid requirement: %s' % requirement)
+    min_version, max_version = (None, False), (None, False)
+    for specifier in m.group('specifiers').split(','):
+        s = RGX_SPECIFIER.match(specifier.strip())
+        if not s:
+            continue
+        op, version = s.group('op'), s.group('version')
+        if op in ('>=', '>', '=='):
+            min_version = (version, op != '>')
+        if op in ('<=', '<', '=='):
+            max_version = (version, op != '<')
+    return RequiresEntry(entry_name=m.group('name'), version_range=[min_version, max_version],
+                         is_package=False, is_plugin=True)
+
+
+def marker_environment():
+    """Returns the values of the environment marker variables (PEP 508) for
+    the running interpreter. No extras are requested.
+    """
+    implementation_version = '%d.%d.%d' % sys.implementation.version[:3]
+    if sys.implementation.version.releaselevel != 'final':
+        implementation_version += sys.implementation.version.releaselevel[0] + str(sys.implementation.version.serial)
+    return {
+        'os_name': os.name,
+        'sys_platform': sys.platform,
+        'platform_machine': platform.machine(),
+        'platform_python_implementation': platform.python_implementation(),
+        'platform_release': platform.release(),
+        'platform_system': platform.system(),
+        'platform_version': platform.version(),
+        'python_version': '.'.join(platform.python_version_tuple()[:2]),
+        'python_full_version': platform.python_version(),
+        'implementation_name': sys.implementation.name,
+        'implementation_version': implementation_version,
+        'extra': ''
+    }
+
+
+def evaluate_marker(marker, environment=None):
+    """Evaluates the environment marker of a requirement (PEP 508) against the
+    environment (by default the running interpreter, see marker_environment).
+
+    The values that look like versions are compared as versions, all other
+    values as strings. Raises WheelError if the marker is not valid.
+    """
+    tokens = []
+    pos = 0
+    marker = marker.strip()
+    while pos < len(marker):
+        m = RGX_MARKER_TOKEN.match(marker, pos)
+        if not m or m.end() == pos:
+            raise WheelError('Invalid marker: %s' % marker)
+        kind = m.lastgroup
+        value = m.group(kind)
+        if kind == 'op':
+            value = ' '.join(value.split())
+        elif kind == 'name' and value in ('and', 'or'):
+            kind = value
+        tokens.append((kind, value))
+        pos = m.end()
+        while pos < len(marker) and marker[pos].isspace():
+            pos += 1
+    environment = environment if environment is not None else marker_environment()
+    result, pos = _marker_or(tokens, 0, environment, marker)
+    if pos != len(tokens):
+        raise WheelError('Invalid marker: %s' % marker)
+    return result
+
+
+def _marker_or(tokens, pos, environment, marker):
+    result, pos = _marker_and(tokens, pos, environment, marker)
+    while pos < len(tokens) and tokens[pos][0] == 'or':
+        right, pos = _marker_and(tokens, pos + 1, environment, marker)
+        result = result or right
+    return result, pos
+
+
+def _marker_and(tokens, pos, environment, marker):
+    result, pos = _marker_atom(tokens, pos, environment, marker)
+    while pos < len(tokens) and tokens[pos][0] == 'and':
+        right, pos = _marker_atom(tokens, pos + 1, environment, marker)
+        result = result and right
+    return result, pos
+
+
+def _marker_atom(tokens, pos, environment, marker):
+    if pos < len(tokens) and tokens[pos] == ('paren', '('):
+        result, pos = _marker_or(tokens, pos + 1, environment, marker)
+        if pos >= len(tokens) or tokens[pos] != ('paren', ')'):
+            raise WheelError('Invalid marker: %s' % marker)
+        return result, pos + 1
+    if pos + 3 > len(tokens):
+        raise WheelError('Invalid marker: %s' % marker)
+    left, op, right = tokens[pos:pos + 3]
+    if op[0] != 'op':
+        raise WheelError('Invalid marker: %s' % marker)
+    return _compare_marker_values(_marker_value(left, environment, marker), op[1],
+                                  _marker_value(right, environment, marker)), pos + 3
+
+
+def _marker_value(token, environment, marker):
+    kind, value = token
+    if kind == 'string':
+        return value[1:-1]
+    if kind == 'name' and value in environment:
+        return environment[value]
+    raise WheelError('Invalid marker: %s' % marker)
+
+
+def _compare_marker_values(left, op, right):
+    if op == 'in':
+        return left in right
+    if op == 'not in':
+        return left not in right
+    if op == '===':
+        return left == right
+    left_version, right_version = _release(left), _release(right)
+    if left_version is None or right_version is None:
+        if op in ('==', '!='):
+            return (left == right) == (op == '==')
+        return False
+    size = max(len(left_version), len(right_version))
+    prefix = right_version[:-1]
+    left_version += (0,) * (size - len(left_version))
+    right_version += (0,) * (size - len(right_version))
+    if op == '~=':
+        return left_version >= right_version and left_version[:len(prefix)] == prefix
+    return {'==': left_version == right_version, '!=': left_version != right_version,
+            '<': left_version < right_version, '<=': left_version <= right_version,
+            '>': left_version > right_version, '>=': left_version >= right_version}[op]
+
+
+def _release(value):
+    m = RGX_RELEASE.match(value)
+    if not m or (m.end() != len(value) and value[m.end()] not in 'abcr.+-_'):
+        return None
+    return tuple(int(part) for part in m.group(0).split('.'))
+
+
+class WheelPlugin(ZipPlugin):
+    """A plugin distributed as a python wheel (PEP 427).
+
+    The modules are imported straight from the archive, without installing or
+    unpacking the wheel. If the wheel has a PLUGIN.MF in its root, that is the
+    plugin manifest. Otherwise the manifest is built from the wheel metadata:
+        * Plugin-Id and Version are the Name and Version from METADATA.
+        * Exports are the top level packages and modules (from top_level.txt
+        or the RECORD file), exported with the distribution version.
+        * Requires-Plugins are the Requires-Dist requirements that apply to the
+        running interpreter (by their environment markers).
+        * Plugin-Classes are the entry points in the "termite.plugins" group
+        of entry_points.txt.
+        * Lazy-Loading is on.
+
+    The sources are checked against their hashes in the RECORD file when read.
+    Wheels with extension modules are not supported.
+    """
+
+    def __init__(self, path, manifest_parser):
+        ZipPlugin.__init__(self, path, manifest_parser)
+        self.type = 'whl'
+        self.dist_info = None
+        self.record = {}
+        self.wheel_info = None
+        self.verified = set()
+
+    def build_index(self):
+        index, signature = ZipPlugin.build_index(self)
+        archive = self.get_archive()
+        dist_info = find_dist_info(archive.namelist())
+        if dist_info is None:
+            raise WheelError('%s is not a wheel: no .dist-info/WHEEL' % self.path)
+        wheel_info = HeaderParser().parsestr(archive.read(dist_info + '/WHEEL').decode('utf-8'))
+        wheel_version = wheel_info.get('Wheel-Version', '')
+        if wheel_version.split('.')[0] != str(SUPPORTED_WHEEL_VERSION):
+            raise WheelError('Unsupported Wheel-Version %s in %s' % (wheel_version, self.path))
+        record = parse_record(archive.read(dist_info + '/RECORD').decode('utf-8'))
+        for rc_path in record:
+            if os.path.splitext(rc_path)[1] in EXTENSION_MODULES:
+                raise WheelError('Wheel %s contains extension module %s' % (self.path, rc_path))
+        self.dist_info, self.wheel_info, self.record = dist_info, wheel_info, record
+        self.verified = set()
+        return index, signature
+
+    def read_metadata_file(self, name):
+        """Reads a file from the .dist-info directory as text, or returns None
+        if the file does not exist.
+        """
+        if self.index is None:
+            self.rebuild_index()
+        rc_path = os.path.join(self.dist_info, name)
+        if self.get_entry(rc_path) is None:
+            return None
+        return self.do_load_resource(rc_path).read()
+
+    def load_manifest(self):
+        if self.resource_exists('PLUGIN.MF', True):
+            return ZipPlugin.load_manifest(self)
+        metadata = HeaderParser().parsestr(self.read_metadata_file('METADATA') or '')
+        if not metadata.get('Name') or not metadata.get('Version'):
+            raise WheelError('Wheel %s has no Name or Version in METADATA' % self.path)
+        version = metadata['Version']
+        exports = [ExportsEntry(entry_name=name, export_version=version, is_package=False)
+                   for name in self.top_level_names()]
+        requires_plugins = [r for r in (parse_requirement(rq) for rq in metadata.get_all('Requires-Dist') or []) if r]
+        return PluginManifestBuilder().id(metadata['Name']) \
+            .version(version) \
+            .exports(exports) \
+            .requires_plugins(requires_plugins) \
+            .plugin_classes(self.entry_point_classes()) \
+            .lazy_loading(True) \
+            .build()
+
+    def top_level_names(self):
+        """Returns the names of the top level packages and modules in the
+        wheel.
+        """
+        top_level = self.read_metadata_file('top_level.txt')
+        if top_level is not None:
+            return [name.strip() for name in top_level.splitlines() if name.strip()]
+        names = set()
+        for rc_path in self.record:
+            parts = rc_path.split(os.path.sep)
+            if parts[0].endswith('.dist-info') or parts[0].endswith('.data'):
+                continue
+            if len(parts) > 1:
+                names.add(parts[0])
+            elif parts[0].endswith('.py'):
+                names.add(parts[0][:-len('.py')])
+        return sorted(names)
+
+    def entry_point_classes(self):
+        content = self.read_metadata_file('entry_points.txt')
+        if not content:
+            return []
+        entry_points = ConfigParser(delimiters=('=',))
+        entry_points.optionxform = str
+        entry_points.read_string(content)
+        if not entry_points.has_section(ENTRY_POINTS_GROUP):
+            return []
+        return [value.strip().replace(':', '.') for value in entry_points[ENTRY_POINTS_GROUP].values()]
+
+    def verify(self, real_name, content):
+        """Checks the content of a resource against its hash in RECORD."""
+        rc_path = os.path.normpath(real_name)
+        algorithm, digest, size = self.record.get(rc_path, (None, None, None))
+        if digest is None or rc_path in self.verified:
+            return
+        actual = base64.urlsafe_b64encode(hashlib.new(algorithm, content).digest()).rstrip(b'=').decode('ascii')
+        if actual != digest:
+            raise WheelError('Hash mismatch for %s in %s' % (real_name, self.path))
+        self.verified.add(rc_path)
+
+    def do_load_resource(self, real_name):
+        content = self.get_archive().read(self.get_entry(real_name))
+        self.verify(real_name, content)
+        return io.StringIO(content.decode('utf-8'))
+
+    def do_map_resource(self, real_name):
+        mapped = ZipPlugin.do_map_resource(self, real_name)
+        try:
+            self.verify(real_name, mapped.view)
+        except Exception:
+            mapped.close()
+            raise
+        return mapped
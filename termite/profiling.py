@@ -0,0 +1,206 @@
+#    This file is part of Termite Plugins Platform
+#    Copyright (C) 2014 Pavle Jonoski
+#
+#    This program is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    This program is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU General Public License for more details.
+#
+#    You should have received a copy of the GNU General Public License
+#    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Import time profiling of the plugin modules.
+
+The profiler records the time spent reading, compiling and executing each
+plugin module, similar to "python -X importtime", but with the time attributed
+to the plugin that owns the module. The modules are kept in a tree by the order
+in which they were imported: a module imported while another module is being
+executed is a child of that module.
+
+Every timing is in nanoseconds.
+"""
+
+from contextlib import contextmanager
+from time import perf_counter_ns
+import threading
+
+__author__ = 'pavle'
+
+
+PHASE_READ = 'read'
+PHASE_COMPILE = 'compile'
+
+
+class ModuleProfile:
+    """The import timings of one module.
+
+    total is the time from the start to the end of the module execution,
+    including reading and compiling the module and importing its children.
+    """
+
+    __slots__ = ('name', 'plugin_id', 'read', 'compile', 'total', 'children', 'parent')
+
+    def __init__(self, name, plugin_id, parent=None):
+        self.name = name
+        self.plugin_id = plugin_id
+        self.read = 0
+        self.compile = 0
+        self.total = 0
+        self.children = []
+        self.parent = parent
+
+    def exec_time(self):
+        """The time spent executing the module code itself, without the
+        imported modules.
+        """
+        return self.total - self.read - self.compile - sum(c.total for c in self.children)
+
+    def self_time(self):
+        return self.read + self.compile + self.exec_time()
+
+    def to_dict(self, same_plugin=False):
+        children = self.children
+        if same_plugin:
+            children = [c for c in children if c.plugin_id == self.plugin_id]
+        return {
+            'module': self.name,
+            'plugin': self.plugin_id,
+            'read_ns': self.read,
+            'compile_ns': self.compile,
+            'exec_ns': self.exec_time(),
+            'self_ns': self.self_time(),
+            'cumulative_ns': self.total,
+            'children': [c.to_dict(same_plugin) for c in children]
+        }
+
+
+class ImportProfiler:
+    """Collects the import timings of the plugin modules.
+
+    The loaders report the modules being executed (see profile_module) and the
+    time spent in the read and compile phases of the module currently being
+    executed (see phase). Each thread keeps its own stack of modules being
+    executed, so modules imported concurrently end up in separate trees.
+    """
+
+    def __init__(self):
+        self.roots = []
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def __stack__(self):
+        stack = getattr(self.local, 'stack', None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    @contextmanager
+    def profile_module(self, name, plugin_id):
+        """Records the execution of a module of a plugin."""
+        stack = self.__stack__()
+        parent = stack[-1] if stack else None
+        profile = ModuleProfile(name, plugin_id, parent)
+        if parent is None:
+            with self.lock:
+                self.roots.append(profile)
+        else:
+            parent.children.append(profile)
+        stack.append(profile)
+        start = perf_counter_ns()
+        try:
+            yield profile
+        finally:
+            profile.total = perf_counter_ns() - start
+            stack.pop()
+
+    @contextmanager
+    def phase(self, phase):
+        """Records the time spent in a phase (PHASE_READ or PHASE_COMPILE) of
+        loading the module currently being executed.
+        """
+        stack = self.__stack__()
+        start = perf_counter_ns()
+        try:
+            yield
+        finally:
+            if stack:
+                profile = stack[-1]
+                setattr(profile, phase, getattr(profile, phase) + perf_counter_ns() - start)
+
+    def modules(self):
+        """Returns all recorded module profiles, in import order."""
+        with self.lock:
+            pending = list(reversed(self.roots))
+        modules = []
+        while pending:
+            profile = pending.pop()
+            modules.append(profile)
+            pending.extend(reversed(profile.children))
+        return modules
+
+    def report(self):
+        """Returns the collected timings.
+
+        The report is a dictionary with:
+            * modules - the tree of all profiled modules.
+            * plugins - plugin id => the totals of the plugin modules (number
+            of modules, read, compile, exec and self time) and the tree of the
+            plugin modules in 'modules'. The tree of a plugin starts at the
+            modules imported from outside of the plugin and contains only the
+            modules of that plugin.
+        """
+        with self.lock:
+            roots = list(self.roots)
+        plugins = {}
+        for profile in self.modules():
+            stats = plugins.get(profile.plugin_id)
+            if stats is None:
+                stats = plugins[profile.plugin_id] = {
+                    'module_count': 0,
+                    'read_ns': 0,
+                    'compile_ns': 0,
+                    'exec_ns': 0,
+                    'self_ns': 0,
+                    'modules': []
+                }
+            stats['module_count'] += 1
+            stats['read_ns'] += profile.read
+            stats['compile_ns'] += profile.compile
+            stats['exec_ns'] += profile.exec_time()
+            stats['self_ns'] += profile.self_time()
+            if profile.parent is None or profile.parent.plugin_id != profile.plugin_id:
+                stats['modules'].append(profile.to_dict(same_plugin=True))
+        return {
+            'modules': [r.to_dict() for r in roots],
+            'plugins': plugins
+        }
+
+    def format_report(self):
+        """Formats the report as text: one block per plugin, the slowest plugin
+        first, with the plugin modules tree indented below the plugin totals.
+        """
+        plugins = self.report()['plugins']
+        row = '%12s | %12s | %12s | %12s | %s'
+        lines = [row % ('self [us]', 'read [us]', 'compile [us]', 'cumul [us]', 'plugin / module')]
+
+        def add_module(module, depth):
+            lines.append(row % (module['self_ns'] // 1000, module['read_ns'] // 1000, module['compile_ns'] // 1000,
+                                module['cumulative_ns'] // 1000, '  ' * depth + module['module']))
+            for child in module['children']:
+                add_module(child, depth + 1)
+
+        for plugin_id, stats in sorted(plugins.items(), key=lambda p: -p[1]['self_ns']):
+            lines.append(row % (stats['self_ns'] // 1000, stats['read_ns'] // 1000, stats['compile_ns'] // 1000, '',
+                                '%s (%d modules)' % (plugin_id, stats['module_count'])))
+            for module in stats['modules']:
+                add_module(module, 1)
+        return '\n'.join(lines)
+
+    def reset(self):
+        with self.lock:
+            self.roots = []
@@ -1,7 +1,14 @@
 __author__ = 'pavle'
 
+import base64
+import hashlib
 import logging
+import mmap
+import os
+import shutil
 import sys
+import tempfile
+import zipfile
 from logging import DEBUG
 
 sys.path.append("../..")
@@ -10,9 +17,14 @@ logging.basicConfig(level=DEBUG)
 
 import unittest
 from io import StringIO
+from unittest import mock
 
 
-from termite.plugins.support import PluginManifestParser
+from termite.loader import PlatformPluginsFinder
+from termite.plugins.store import PluginStore
+from termite.plugins.support import ExplodedPlugin, ManifestIndex, PluginLoaderHandler, PluginManifestParser, \
+    ZipPlugin, discover_plugins, plugin_references_from_location
+from termite.plugins.wheels import WheelError, WheelPlugin, evaluate_marker
 
 
 class TestPluginManifestParser(unittest.TestCase):
@@ -66,3 +78,295 @@ class TestPluginManifestParser(unittest.TestCase):
         self.assertEqual(ee.name, 'test.package.module')
         self.assertIsNotNone(ee.version)
         self.assertEqual(ee.version,'1.0.0.SNAPSHOT')
+
+
+class StubPluginContainer:
+
+    def __init__(self, path, plugin=None):
+        self.plugin = plugin or ExplodedPlugin(path, PluginManifestParser())
+        self.manifest = self.plugin.get_manifest()
+        self.plugin_id = self.manifest.id
+        self.version = self.manifest.version
+
+    def get_environ(self):
+        return {'__platform__': 'termite'}
+
+
+def create_plugin(root, plugin_id, exports, files, headers=''):
+    path = os.path.join(root, plugin_id)
+    os.makedirs(path)
+    with open(os.path.join(path, 'PLUGIN.MF'), 'w') as mf:
+        mf.write('Plugin-Id: %s\nVersion: 1.0\nExports: %s\n' % (plugin_id, '; '.join('%s [1.0]' % e for e in exports)))
+        mf.write(headers)
+    for name, content in files.items():
+        file_path = os.path.join(path, name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'w') as fh:
+            fh.write(content)
+    return StubPluginContainer(path)
+
+
+def create_wheel(root, files, metadata):
+    """Builds a wheel of the files, with the RECORD of their hashes."""
+    dist_info = 'tpkg-1.2.dist-info'
+    files = dict(files)
+    files[dist_info + '/METADATA'] = 'Metadata-Version: 2.1\nName: tpkg\nVersion: 1.2\n' + metadata
+    files[dist_info + '/WHEEL'] = 'Wheel-Version: 1.0\nGenerator: test\nRoot-Is-Purelib: true\nTag: py3-none-any\n'
+    record = []
+    for name, content in files.items():
+        digest = base64.urlsafe_b64encode(hashlib.sha256(content.encode('utf-8')).digest()).rstrip(b'=')
+        record.append('%s,sha256=%s,%d' % (name, digest.decode('ascii'), len(content)))
+    record.append(dist_info + '/RECORD,,')
+    files[dist_info + '/RECORD'] = '\n'.join(record) + '\n'
+    path = os.path.join(root, 'tpkg-1.2-py3-none-any.whl')
+    with zipfile.ZipFile(path, 'w') as archive:
+        for name, content in files.items():
+            archive.writestr(name, content)
+    return path
+
+
+def zip_plugin(container):
+    """Packs an exploded plugin into a zip archive next to it."""
+    path = container.plugin.path + '.zip'
+    with zipfile.ZipFile(path, 'w') as archive:
+        for rc_path in container.plugin.walk_resources():
+            archive.write(container.plugin.get_path(rc_path), rc_path)
+    shutil.rmtree(container.plugin.path)
+    return path
+
+
+class TestPluginResources(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.finder = PlatformPluginsFinder([])
+        sys.meta_path.insert(0, self.finder)
+
+    def tearDown(self):
+        sys.meta_path.remove(self.finder)
+        for name in list(sys.modules):
+            if name.split('.')[0] == 'tpkg':
+                del sys.modules[name]
+        shutil.rmtree(self.root)
+
+    def test_zip_plugin(self):
+        path = zip_plugin(create_plugin(self.root, 'test.tpkg', ['tpkg'], {
+            'tpkg/__init__.py': 'VALUE = 1\n',
+            'tpkg/sub/__init__.py': '',
+            'tpkg/sub/mod.py': 'from tpkg import VALUE\nDOUBLE = VALUE * 2\n'
+        }))
+        self.assertEqual([path], plugin_references_from_location(self.root))
+        plugin = PluginLoaderHandler(None).load(path)
+        self.assertIsInstance(plugin, ZipPlugin)
+        self.finder.add_plugin(StubPluginContainer(path, plugin))
+
+        import tpkg.sub.mod
+        self.assertEqual(tpkg.sub.mod.DOUBLE, 2)
+        self.assertEqual(tpkg.sub.mod.__file__, os.path.join(path, 'tpkg', 'sub', 'mod.py'))
+        self.assertEqual(sorted(plugin.module_names()), ['tpkg', 'tpkg.sub', 'tpkg.sub.mod'])
+        self.assertEqual(sorted(plugin.list('tpkg')), ['__init__.py', 'sub'])
+
+        # rebuilding the index unmaps the archive, unless a resource is still mapped
+        with plugin.map_resource('tpkg/__init__.py') as view:
+            archive_map = plugin.archive_map
+            plugin.rebuild_index()
+            self.assertFalse(archive_map.closed)
+            self.assertEqual(b'VALUE = 1\n', view.tobytes())
+        self.assertEqual(b'VALUE = 1\n', plugin.read_resource_bytes('tpkg/__init__.py'))
+        archive_map = plugin.archive_map
+        plugin.rebuild_index()
+        self.assertTrue(archive_map.closed)
+        self.assertIsNone(plugin.archive_map)
+        plugin.close()
+        self.assertIsNone(plugin.archive)
+
+    def test_wheel_plugin(self):
+        path = create_wheel(self.root, {
+            'tpkg/__init__.py': 'VALUE = 1\n',
+            'tpkg/hooks.py': 'class Hook:\n    pass\n',
+            'tpkg-1.2.dist-info/entry_points.txt': '[termite.plugins]\nhook = tpkg.hooks:Hook\n'
+        }, 'Requires-Dist: tother (>=1.0,<2.0)\nRequires-Dist: tlib; extra == "test"\n'
+           'Requires-Dist: twin (>=300); sys_platform == "no-such-platform"\n'
+           'Requires-Dist: tnew; python_version >= "3.0" and os_name != "no-such-os"\n')
+        self.assertEqual([path], plugin_references_from_location(self.root))
+        plugin = PluginLoaderHandler(None).load(path)
+        self.assertIsInstance(plugin, WheelPlugin)
+        manifest = plugin.get_manifest()
+        self.assertEqual(('tpkg', '1.2', ['tpkg.hooks.Hook']), (manifest.id, manifest.version, manifest.plugin_classes))
+        self.assertEqual([('tpkg', '1.2')], [(e.name, e.version) for e in manifest.exports])
+        self.assertEqual(['tother', 'tnew'], [r.name for r in manifest.requires_plugins])
+        self.assertTrue(manifest.requires_plugins[0].version_in_range('1.5.0'))
+        self.assertFalse(manifest.requires_plugins[0].version_in_range('2.0.0'))
+        self.assertTrue(manifest.lazy_loading)
+        self.finder.add_plugin(StubPluginContainer(path, plugin))
+
+        import tpkg.hooks
+        self.assertEqual(tpkg.hooks.Hook.__name__, 'Hook')
+        self.assertEqual(tpkg.VALUE, 1)
+
+    def test_wheel_requirement_markers(self):
+        windows = {'sys_platform': 'win32', 'os_name': 'nt', 'python_version': '3.7',
+                   'python_full_version': '3.7.4', 'extra': ''}
+        self.assertTrue(evaluate_marker('sys_platform == "win32"', windows))
+        self.assertFalse(evaluate_marker("sys_platform != 'win32'", windows))
+        self.assertTrue(evaluate_marker('python_version < "3.8" and (os_name == "nt" or extra == "test")', windows))
+        self.assertFalse(evaluate_marker('python_version >= "3.10"', windows))
+        self.assertTrue(evaluate_marker('python_full_version ~= "3.7.0"', windows))
+        self.assertTrue(evaluate_marker('"win" in sys_platform', windows))
+        self.assertFalse(evaluate_marker('extra == "test"', windows))
+        with self.assertRaises(WheelError):
+            evaluate_marker('sys_platform == ', windows)
+        with self.assertRaises(WheelError):
+            evaluate_marker('unknown_variable == "x"', windows)
+
+    def test_wheel_hash_mismatch(self):
+        path = create_wheel(self.root, {'tpkg/__init__.py': 'VALUE = 1\n'}, '')
+        with zipfile.ZipFile(path) as archive:
+            files = dict((name, archive.read(name)) for name in archive.namelist())
+        files['tpkg/__init__.py'] = b'VALUE = 2\n'
+        with zipfile.ZipFile(path, 'w') as archive:
+            for name, content in files.items():
+                archive.writestr(name, content)
+        plugin = WheelPlugin(path, PluginManifestParser())
+        self.assertRaises(WheelError, plugin.read_code, 'tpkg')
+
+    def test_map_resource(self):
+        container = create_plugin(self.root, 'test.data', [], {'data/table.bin': 'x' * 100, 'data/empty.bin': ''})
+        with container.plugin.map_resource('DATA/table.bin', True) as view:
+            self.assertEqual(b'x' * 100, view[:100])
+        self.assertRaises(ValueError, len, view)
+        self.assertEqual(b'', container.plugin.read_resource_bytes('data/empty.bin'))
+
+        mapped = container.plugin.map_resource('data/table.bin')
+        with mapped as view:
+            head = view[:4]
+        self.assertIsNone(mapped.mapping)
+        self.assertEqual(b'xxxx', head)
+        head.release()
+
+        path = container.plugin.path + '.zip'
+        with zipfile.ZipFile(path, 'w') as archive:
+            archive.write(os.path.join(container.plugin.path, 'PLUGIN.MF'), 'PLUGIN.MF')
+            archive.writestr('data/table.bin', b'stored' * 10, zipfile.ZIP_STORED)
+            archive.writestr('data/packed.bin', b'packed' * 10, zipfile.ZIP_DEFLATED)
+        plugin = ZipPlugin(path, PluginManifestParser())
+        mapped = plugin.map_resource('data/table.bin')
+        self.assertIsInstance(mapped.view.obj, mmap.mmap)
+        self.assertEqual(b'stored' * 10, mapped.view)
+        mapped.close()
+        self.assertEqual(b'packed' * 10, plugin.read_resource_bytes('data/packed.bin'))
+        plugin.close()
+
+    def test_plugin_store(self):
+        store = PluginStore(os.path.join(self.root, 'store'))
+        container = create_plugin(self.root, 'test.tpkg', ['tpkg'], {
+            'tpkg/__init__.py': 'VALUE = 1\n',
+            'tpkg/mod.py': 'from tpkg import VALUE\nDOUBLE = VALUE * 2\n'
+        })
+        store.add_plugin(container.plugin.path)
+        with open(os.path.join(container.plugin.path, 'PLUGIN.MF'), 'a') as mf:
+            mf.write('Version: 2.0\n')
+        with open(os.path.join(container.plugin.path, 'tpkg', '__init__.py'), 'w') as fh:
+            fh.write('VALUE = 2\n')
+        tree_path = store.add_plugin(container.plugin.path)
+        self.assertEqual(['1.0', '2.0'], store.versions('test.tpkg'))
+        objects = [name for _, _, names in os.walk(store.objects_dir) for name in names]
+        self.assertEqual(5, len(objects))
+
+        plugin = PluginLoaderHandler(None).load(tree_path)
+        self.assertEqual('2.0', plugin.get_manifest().version)
+        self.finder.add_plugin(StubPluginContainer(tree_path, plugin))
+        import tpkg.mod
+        self.assertEqual(tpkg.mod.DOUBLE, 4)
+
+        store.remove_version('test.tpkg', '1.0')
+        self.assertEqual(2, store.gc())
+
+    def test_case_folded_index(self):
+        plugin = create_plugin(self.root, 'test.index', ['tpkg'], {
+            'tpkg/__init__.py': '',
+            'tpkg/Mod.py': ''
+        }).plugin
+        self.assertEqual(plugin.get_real_rc_name('plugin.mf'), 'PLUGIN.MF')
+        self.assertEqual(plugin.get_real_rc_name('TPKG/mod.py'), os.path.join('tpkg', 'Mod.py'))
+        self.assertTrue(plugin.is_package('tpkg'))
+        self.assertTrue(plugin.is_module('tpkg.mod'))
+        self.assertFalse(plugin.resource_is_file('tpkg', True))
+        self.assertIsNone(plugin.import_to_filename('tpkg.mod'))
+        self.assertEqual(plugin.import_to_filename('tpkg.Mod'), os.path.join('tpkg', 'Mod.py'))
+        self.assertEqual(sorted(plugin.module_names()), ['tpkg', 'tpkg.Mod'])
+
+        os.makedirs(os.path.join(plugin.path, 'tpkg', 'sub'))
+        with open(os.path.join(plugin.path, 'tpkg', 'sub', '__init__.py'), 'w') as fh:
+            fh.write('')
+        self.assertTrue(plugin.is_package('tpkg.sub'))
+        os.remove(os.path.join(plugin.path, 'tpkg', 'Mod.py'))
+        self.assertFalse(plugin.is_module('tpkg.other'))
+        self.assertFalse(plugin.is_module('tpkg.mod'))
+
+    def test_index_miss_stats(self):
+        files = dict(('tpkg/sub%d/__init__.py' % n, '') for n in range(200))
+        files.update({'tpkg/__init__.py': '', 'tpkg/mod.py': 'VALUE = 1\n'})
+        plugin = create_plugin(self.root, 'test.stats', ['tpkg'], files).plugin
+        plugin.is_package('tpkg')
+        with mock.patch('os.stat', wraps=os.stat) as stat:
+            self.assertEqual('VALUE = 1\n', plugin.read_code(os.path.join('tpkg', 'mod.py')))
+            self.assertEqual(0, stat.call_count)
+            self.assertEqual(os.path.join('tpkg', 'mod.py'), plugin.import_to_filename('tpkg.mod'))
+            self.assertEqual(1, stat.call_count)
+            self.assertFalse(plugin.is_package('tpkg.sub0.missing'))
+            self.assertEqual(2, stat.call_count)
+
+    def test_removed_resource(self):
+        plugin = create_plugin(self.root, 'test.removed', ['tpkg'], {
+            'tpkg/__init__.py': '',
+            'tpkg/mod.py': 'VALUE = 1\n',
+            'tpkg/Data.txt': 'data'
+        }).plugin
+        self.assertEqual('VALUE = 1\n', plugin.read_code(os.path.join('tpkg', 'mod.py')))
+        self.assertEqual(b'data', plugin.read_resource_bytes(os.path.join('tpkg', 'data.txt'), True))
+        os.remove(plugin.get_path(os.path.join('tpkg', 'mod.py')))
+        os.remove(plugin.get_path(os.path.join('tpkg', 'Data.txt')))
+        with self.assertRaisesRegex(Exception, 'not found'):
+            plugin.read_code(os.path.join('tpkg', 'mod.py'))
+        with self.assertRaisesRegex(Exception, 'not found'):
+            plugin.map_resource(os.path.join('tpkg', 'data.txt'), True)
+        self.assertFalse(plugin.resource_exists(os.path.join('tpkg', 'mod.py')))
+
+    def test_manifest_index(self):
+        path = create_plugin(self.root, 'test.indexed', ['tpkg'], {'tpkg/__init__.py': ''},
+                             'Requires: tother [1.0, 2.0)\n').plugin.path
+        handler = PluginLoaderHandler(None)
+        index = handler.add_manifest_index(self.root)
+        self.assertEqual([path], plugin_references_from_location(self.root, index))
+        handler.load(path)
+        handler.save_manifest_indexes()
+        self.assertTrue(os.path.isfile(index.path))
+
+        index = ManifestIndex(self.root)
+        index.load()
+        self.assertTrue(index.is_fresh(path))
+        index.entries[path]['manifest']['version'] = '1.1'
+        handler.manifest_indexes[self.root] = index
+        manifest = handler.load(path).get_manifest()
+        self.assertEqual('1.1', manifest.version)
+        self.assertEqual([('1.0.0', True), ('2.0.0', False)], manifest.requires[0].version_range)
+
+        with open(os.path.join(path, 'PLUGIN.MF'), 'a') as mf:
+            mf.write('Lazy-Loading: true\n')
+        self.assertFalse(index.is_fresh(path))
+        self.assertEqual('1.0', handler.load(path).get_manifest().version)
+        self.assertTrue(index.dirty)
+
+    def test_discover_plugins(self):
+        first, second = os.path.join(self.root, 'first'), os.path.join(self.root, 'second')
+        create_plugin(first, 'test.a', [], {})
+        create_plugin(os.path.join(first, 'vendor'), 'test.b', [], {})
+        create_plugin(os.path.join(second, 'vendor', 'deep'), 'test.c', [], {})
+        create_plugin(second, '.hidden', [], {})
+        refs = discover_plugins([first, second, os.path.join(self.root, 'missing')])
+        self.assertEqual(os.path.join(first, 'test.a'), next(refs))
+        self.assertEqual([], list(refs))
+        self.assertEqual(sorted([os.path.join(first, 'test.a'), os.path.join(first, 'vendor', 'test.b')]),
+                         sorted(discover_plugins([first, second], max_depth=2)))
+        self.assertEqual(3, len(list(discover_plugins([first, second], max_depth=3))))
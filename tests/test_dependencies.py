@@ -1,9 +1,11 @@
 from logging import DEBUG
+import weakref
 import logging
 import sys
 sys.path.append("..")
 from unittest.case import TestCase
-from termite.dependencies import Graph, Vertex, PluginDependenciesManager
+from termite.dependencies import Graph, Vertex, PluginDependenciesManager, ServiceContext, \
+    ServiceUnavailableException
 
 __author__ = 'pavle'
 
@@ -140,7 +142,197 @@ class TestPluginDependenciesManager(TestCase):
         
         for d in pdm.dependencies_graph:
             logging.debug(d)
-        
-        
-        
-        
+
+
+class Greeter:
+
+    def __init__(self, greeting='Hello'):
+        self.greeting = greeting
+
+    def greet(self, name):
+        return '%s, %s' % (self.greeting, name)
+
+
+class TestServiceContext(TestCase):
+
+    def test_bind_before_available(self):
+        ctx = ServiceContext()
+        ref = ctx.bind('greeter')
+        self.assertRaises(ServiceUnavailableException, lambda: ref.greet)
+        ctx.service('greeter', [], Greeter)
+        self.assertEqual(ref.greet('world'), 'Hello, world')
+        # resolved once and kept in the reference
+        self.assertIn('greet', ref.__dict__)
+
+    def test_rebind_on_replace(self):
+        ctx = ServiceContext()
+        ctx.service('greeter', [], Greeter)
+        ref = ctx.bind('greeter')
+        self.assertEqual(ref.greet('world'), 'Hello, world')
+        ctx.service('greeter', [], lambda: Greeter('Hi'))
+        self.assertEqual(ref.greet('world'), 'Hi, world')
+
+    def test_invalidate_on_remove(self):
+        ctx = ServiceContext()
+        ctx.service('greeter', [], Greeter)
+        ref = ctx.bind('greeter')
+        ref.greet('world')
+        ctx.remove_service('greeter')
+        self.assertFalse(ref.__available__())
+        self.assertRaises(ServiceUnavailableException, lambda: ref.greet('world'))
+
+    def test_dependencies_injected(self):
+        ctx = ServiceContext()
+        ctx.service('printer', ['greeter'], lambda greeter: greeter.greet)
+        self.assertFalse(ctx.services['printer'].available)
+        ctx.service('greeter', [], Greeter)
+        self.assertTrue(ctx.services['printer'].available)
+        self.assertEqual(ctx.services['printer'].ref('world'), 'Hello, world')
+
+    def test_locate_services_coalesced(self):
+        ctx = ServiceContext()
+        calls = []
+        ctx.locate_services(['a', 'b', 'c'], lambda *instances: calls.append(instances), None, None)
+        with ctx.transaction():
+            ctx.service('a', [], lambda: 'A')
+            ctx.service('b', ['a'], lambda a: a + 'B')
+            ctx.service('c', [], lambda: 'C')
+            self.assertEqual(calls, [])
+        self.assertEqual(calls, [('A', 'AB', 'C')])
+
+    def test_locate_services_removed(self):
+        ctx = ServiceContext()
+        removed = []
+        all_removed = []
+        ctx.service('a', [], lambda: 'A')
+        ctx.service('b', [], lambda: 'B')
+        ctx.locate_services(['a', 'b'], None, lambda name, instance: removed.append(name),
+                            lambda: all_removed.append(True))
+        with ctx.transaction():
+            ctx.remove_service('a')
+            ctx.remove_service('b')
+        self.assertEqual(removed, ['a', 'b'])
+        self.assertEqual(all_removed, [True])
+
+    def test_locate_services_removed_and_added_again(self):
+        ctx = ServiceContext()
+        calls = []
+        removed = []
+        ctx.service('a', [], lambda: 'A')
+        ctx.service('b', [], lambda: 'B')
+        ctx.locate_services(['a', 'b'], lambda *instances: calls.append(instances),
+                            lambda name, instance: removed.append(name), None)
+        ctx.remove_service('a')
+        self.assertEqual(removed, ['a'])
+        ctx.service('a', [], lambda: 'A2')
+        self.assertEqual(calls, [('A', 'B'), ('A2', 'B')])
+        ctx.remove_service('b')
+        ctx.service('b', [], lambda: 'B2')
+        self.assertEqual(calls, [('A', 'B'), ('A2', 'B'), ('A2', 'B2')])
+        self.assertEqual(removed, ['a', 'b'])
+
+    def test_locate_service_available_immediately(self):
+        ctx = ServiceContext()
+        ctx.service('a', [], lambda: 'A')
+        located = []
+        ctx.locate_service('a', located.append, None)
+        self.assertEqual(located, ['A'])
+
+    def test_instrumentation(self):
+        ctx = ServiceContext()
+        ctx.service('greeter', [], Greeter)
+        ref = ctx.bind('greeter')
+        self.assertEqual(ctx.service_stats(), {})
+        ctx.enable_instrumentation()
+        ref.greet('world')
+        ref.greet('termite')
+        self.assertRaises(TypeError, ref.greet)
+        stats = ctx.service_stats()['greeter']
+        self.assertEqual(stats['calls'], 3)
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(sum(stats['methods']['greet']['latency']['counts']), 3)
+        ctx.disable_instrumentation()
+        ref.greet('world')
+        self.assertIs(ref.__dict__['greet'].__self__, ctx.services['greeter'].ref)
+
+    def test_instrumentation_of_handed_out_instances(self):
+        ctx = ServiceContext()
+        ctx.enable_instrumentation()
+        ctx.service('greeter', [], Greeter)
+        ctx.service('printer', ['greeter'], lambda greeter: greeter.greet)
+        ctx.service('name', [], lambda: 'world')
+        ctx.service('welcome', ['printer', 'name'], lambda printer, name: printer(name))
+        located = []
+        ctx.locate_service('greeter', located.append, None)
+        added = []
+        ctx.query(on_added=lambda name, instance: added.append(instance))
+
+        self.assertEqual('Hello, world', ctx.services['welcome'].ref)
+        located[0].greet('locator')
+        ctx.find_services()['greeter'].greet('finder')
+        self.assertIn(located[0], added)
+        self.assertEqual('world', ctx.find_services()['name'])
+        stats = ctx.service_stats()
+        self.assertEqual(3, stats['greeter']['methods']['greet']['calls'])
+        self.assertEqual(1, stats['printer']['methods']['__call__']['calls'])
+
+        ctx.disable_instrumentation()
+        located[0].greet('locator')
+        self.assertIs(ctx.find_services()['greeter'].__dict__['greet'].__self__, ctx.services['greeter'].ref)
+
+    def test_remove_service_cascades(self):
+        ctx = ServiceContext()
+        ctx.service('a', [], lambda: 'A')
+        ctx.service('b', ['a'], lambda a: a + 'B')
+        ctx.service('c', ['b'], lambda b: b + 'C')
+        ref = ctx.bind('c')
+        self.assertEqual(ref.lower(), 'abc')
+        ctx.remove_service('a')
+        self.assertFalse(ctx.services['b'].available)
+        self.assertFalse(ref.__available__())
+        ctx.service('a', [], lambda: 'a')
+        self.assertEqual(ref.lower(), 'abc')
+        self.assertEqual(ctx.services['c'].ref, 'aBC')
+
+    def test_remove_services_of_owner_releases_memory(self):
+        ctx = ServiceContext()
+        ctx.service('a', [], lambda: Greeter(), owner='plugin.a')
+        ctx.service('b', ['a'], lambda a: Greeter(), owner='plugin.a')
+        instance = weakref.ref(ctx.services['a'].ref)
+        ctx.remove_services('plugin.a')
+        self.assertIsNone(instance())
+        self.assertEqual(ctx.services, {})
+        self.assertEqual(ctx.owners, {})
+
+    def test_remove_services_of_owner_drops_locators(self):
+        ctx = ServiceContext()
+        located = []
+        ctx.for_owner('plugin.b').locate_service('x', located.append, None)
+        ctx.service('x', [], lambda: 'X', owner='plugin.a')
+        self.assertEqual(located, ['X'])
+        ctx.remove_services('plugin.b')
+        self.assertEqual(ctx.locators, {})
+        self.assertEqual(ctx.owned_locators, {})
+        ctx.service('x', [], lambda: 'Y', owner='plugin.a')
+        self.assertEqual(located, ['X'])
+
+    def test_find_services_by_interface_and_tag(self):
+        ctx = ServiceContext()
+        ctx.service('mem', [], lambda: 'mem', interfaces=['Storage'], tags=['volatile'])
+        ctx.service('disk', [], lambda: 'disk', interfaces=['Storage'], tags=['durable'])
+        ctx.service('greeter', [], Greeter, tags=['durable'])
+        self.assertEqual(ctx.find_services(interface='Storage'), {'mem': 'mem', 'disk': 'disk'})
+        self.assertEqual(ctx.find_services(tag='durable').keys(), {'disk', 'greeter'})
+        self.assertEqual(ctx.find_services(interface='Storage', tag='durable'), {'disk': 'disk'})
+        ctx.remove_service('disk')
+        self.assertEqual(ctx.find_services(interface='Storage'), {'mem': 'mem'})
+
+    def test_live_query(self):
+        ctx = ServiceContext()
+        ctx.service('mem', [], lambda: 'mem', interfaces=['Storage'], properties={'size': 1})
+        query = ctx.query(interface='Storage', filter=lambda props: props.get('size', 0) > 10)
+        self.assertEqual(len(query), 0)
+        ctx.service('disk', [], lambda: 'disk', interfaces=['Storage'], properties={'size': 100})
+        self.assertEqual(query.services(), {'disk': 'disk'})
+        ctx.remove_service('disk')
+        self.assertEqual(len(query), 0)
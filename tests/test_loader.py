@@ -0,0 +1,378 @@
+from logging import DEBUG
+import importlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+sys.path.append("..")
+from unittest import mock
+from unittest.case import TestCase
+from termite.bytecode import BytecodeCache, precompile_plugins
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextvars import copy_context
+from termite.loader import BaseFinder, ClassLoader, LoaderEntry, PlatformPluginsFinder, IMPORT_CONTEXT, \
+    get_from_context, put_to_context, submit_with_context
+from termite.plugins.support import ExplodedPlugin, PluginManifestParser
+from termite.profiling import ImportProfiler
+
+__author__ = 'pavle'
+
+
+logging.basicConfig(level=DEBUG)
+
+
+class TestBaseFinder(TestCase):
+
+    def test_find_module_by_prefix(self):
+        finder = BaseFinder()
+        finder.add_loader(LoaderEntry('core-loader', ['core', 'core.events']))
+        finder.add_loader(LoaderEntry('remote-loader', ['termite.remote.*']))
+        self.assertEqual(finder.find_module('core'), 'core-loader')
+        self.assertEqual(finder.find_module('core.events.handlers'), 'core-loader')
+        self.assertIsNone(finder.find_module('coreutils'))
+        self.assertIsNone(finder.find_module('termite.remote'))
+        self.assertEqual(finder.find_module('termite.remote.api'), 'remote-loader')
+        self.assertIsNone(finder.find_module('os.path'))
+
+    def test_first_added_entry_wins(self):
+        finder = BaseFinder()
+        restricted = LoaderEntry('restricted', ['core.internal'])
+        finder.add_loader(restricted)
+        finder.add_loader(LoaderEntry('core-loader', ['core']))
+        finder.add_loader(LoaderEntry('regex-loader', ['co*']))
+        self.assertEqual(finder.find_module('core.internal.x'), 'restricted')
+        self.assertEqual(finder.find_module('core.public'), 'core-loader')
+        self.assertEqual(finder.find_module('cobalt'), 'regex-loader')
+        finder.remove_loader(restricted)
+        self.assertEqual(finder.find_module('core.internal.x'), 'core-loader')
+
+    def test_negative_cache(self):
+        finder = BaseFinder()
+        finder.add_loader(LoaderEntry('core-loader', ['core']))
+        self.assertIsNone(finder.find_module('json'))
+        self.assertIsNone(finder.find_module('json'))
+        self.assertIsNone(finder.find_module('moda'))
+        info = finder.cache_info()
+        self.assertEqual(info['hits'], 1)
+        self.assertEqual(info['misses'], 2)
+        finder.add_loader(LoaderEntry('moda-loader', ['moda']))
+        self.assertIn('json', finder.negative_cache)
+        self.assertNotIn('moda', finder.negative_cache)
+        self.assertEqual(finder.find_module('moda'), 'moda-loader')
+
+    def test_negative_cache_concurrent_add(self):
+        finder = BaseFinder()
+        lookup = finder.patterns.lookup
+
+        def lookup_then_add(name):
+            # another thread adds the loader between the lookup and the
+            # caching of the miss
+            entry = lookup(name)
+            if name == 'moda' and not finder.loader_entries:
+                finder.add_loader(LoaderEntry('moda-loader', ['moda']))
+            return entry
+
+        finder.patterns.lookup = lookup_then_add
+        self.assertIsNone(finder.find_module('moda'))
+        self.assertNotIn('moda', finder.negative_cache)
+        self.assertEqual(finder.find_module('moda'), 'moda-loader')
+
+
+class TestImportContext(TestCase):
+
+    def test_context_propagation_to_executor(self):
+        copy_context().run(self.check_context_propagation_to_executor)
+
+    def check_context_propagation_to_executor(self):
+        put_to_context(IMPORT_CONTEXT, 'plugin.a')
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            self.assertIsNone(executor.submit(get_from_context, IMPORT_CONTEXT).result())
+            self.assertEqual(submit_with_context(executor, get_from_context, IMPORT_CONTEXT).result(), 'plugin.a')
+
+
+class StubPluginContainer:
+
+    def __init__(self, path, plugin=None):
+        self.plugin = plugin or ExplodedPlugin(path, PluginManifestParser())
+        self.manifest = self.plugin.get_manifest()
+        self.plugin_id = self.manifest.id
+        self.version = self.manifest.version
+
+    def get_environ(self):
+        return {'__platform__': 'termite'}
+
+
+def create_plugin(root, plugin_id, exports, files, headers=''):
+    path = os.path.join(root, plugin_id)
+    os.makedirs(path)
+    with open(os.path.join(path, 'PLUGIN.MF'), 'w') as mf:
+        mf.write('Plugin-Id: %s\nVersion: 1.0\nExports: %s\n' % (plugin_id, '; '.join(e if '[' in e else '%s [1.0]' % e for e in exports)))
+        mf.write(headers)
+    for name, content in files.items():
+        file_path = os.path.join(path, name)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'w') as fh:
+            fh.write(content)
+    return StubPluginContainer(path)
+
+
+class TestPlatformPluginsFinder(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.finder = PlatformPluginsFinder([])
+        sys.meta_path.insert(0, self.finder)
+
+    def tearDown(self):
+        sys.meta_path.remove(self.finder)
+        for name in list(sys.modules):
+            if name.split('.')[0] in ('tpkg', 'tother', 'tgranted', 'tapp') or name.startswith(('tlib', '__plugin_')):
+                del sys.modules[name]
+        shutil.rmtree(self.root)
+
+    def add_plugin(self, plugin_id, exports, files, headers=''):
+        container = create_plugin(self.root, plugin_id, exports, files, headers)
+        self.finder.add_plugin(container)
+        return container
+
+    def test_find_spec(self):
+        container = self.add_plugin('test.tpkg', ['tpkg'], {
+            'tpkg/__init__.py': 'VALUE = 1\n',
+            'tpkg/mod.py': 'from tpkg import VALUE\nDOUBLE = VALUE * 2\n'
+        })
+        spec = self.finder.find_spec('tpkg')
+        self.assertEqual(spec.origin, os.path.join(container.plugin.path, 'tpkg', '__init__.py'))
+        self.assertEqual(spec.submodule_search_locations, [os.path.join(container.plugin.path, 'tpkg')])
+        self.assertIsNone(self.finder.find_spec('tpkg.missing'))
+
+        import tpkg.mod
+        self.assertEqual(tpkg.mod.DOUBLE, 2)
+        self.assertEqual(tpkg.mod.__file__, os.path.join(container.plugin.path, 'tpkg', 'mod.py'))
+        self.assertEqual(tpkg.mod.__platform__, 'termite')
+
+    def test_bytecode_cache(self):
+        dont_write_bytecode = sys.dont_write_bytecode
+        sys.dont_write_bytecode = False
+        try:
+            self.check_bytecode_cache()
+        finally:
+            sys.dont_write_bytecode = dont_write_bytecode
+
+    def check_bytecode_cache(self):
+        cache = BytecodeCache(os.path.join(self.root, 'cache'))
+        self.finder.bytecode_cache = cache
+        container = self.add_plugin('test.tpkg', ['tpkg'], {'tpkg/__init__.py': 'VALUE = 42\n'})
+        spec = self.finder.find_spec('tpkg')
+        self.assertTrue(cache.owns(spec.cached))
+        importlib.import_module('tpkg')
+        self.assertTrue(os.path.isfile(spec.cached))
+
+        # a fresh loader must load the module from the cache, without compiling
+        del sys.modules['tpkg']
+        self.finder.remove_plugin('test.tpkg')
+        self.finder.add_plugin(container)
+        loader = self.finder.find_module('tpkg')
+
+        def no_compile(*args, **kwargs):
+            raise AssertionError('Module compiled again')
+        loader.source_to_code = no_compile
+        cached = importlib.import_module('tpkg')
+        self.assertEqual(cached.VALUE, 42)
+
+    def test_precompile(self):
+        dont_write_bytecode = sys.dont_write_bytecode
+        sys.dont_write_bytecode = False
+        try:
+            self.check_precompile()
+        finally:
+            sys.dont_write_bytecode = dont_write_bytecode
+
+    def check_precompile(self):
+        cache = BytecodeCache(os.path.join(self.root, 'cache'))
+        self.finder.bytecode_cache = cache
+        container = self.add_plugin('test.tpkg', ['tpkg'], {
+            'tpkg/__init__.py': 'from tpkg import mod\n',
+            'tpkg/mod.py': 'VALUE = 42\n',
+            'tpkg/broken.py': 'def broken(:\n',
+            'README.txt': 'not a module'
+        })
+        self.assertEqual({'compiled': 2, 'fresh': 0, 'failed': 1}, precompile_plugins(cache, [container]))
+        # the fresh sources are not read again
+        with ThreadPoolExecutor() as executor, \
+                mock.patch.object(container.plugin, 'read_code', wraps=container.plugin.read_code) as read_code:
+            self.assertEqual({'compiled': 0, 'fresh': 2, 'failed': 1},
+                             precompile_plugins(cache, [container], executor=executor))
+        self.assertEqual([mock.call(os.path.join('tpkg', 'broken.py'))], read_code.call_args_list)
+
+        def no_compile(*args, **kwargs):
+            raise AssertionError('Module compiled on import')
+        self.finder.find_module('tpkg').source_to_code = no_compile
+        import tpkg
+        self.assertEqual(tpkg.mod.VALUE, 42)
+
+    def test_shared_import_function(self):
+        self.add_plugin('test.tpkg', ['tpkg'], {
+            'tpkg/__init__.py': 'from tpkg import mod\n',
+            'tpkg/mod.py': 'CONTEXT = __context__\n'
+        })
+        import tpkg
+        self.assertIs(tpkg.__import__, tpkg.mod.__import__)
+        self.assertIs(tpkg.__builtins__, tpkg.mod.__builtins__)
+        self.assertEqual(tpkg.mod.CONTEXT, 'test.tpkg')
+
+    def test_lazy_loading(self):
+        self.add_plugin('test.tpkg', ['tpkg'], {
+            'tpkg/__init__.py': '',
+            'tpkg/lazy.py': 'import sys\nsys.modules["tpkg"].executed = True\nCONTEXT = __context__\n'
+        }, 'Lazy-Loading: true\n')
+        import tpkg.lazy
+        self.assertFalse(hasattr(tpkg, 'executed'))
+        self.assertEqual(tpkg.lazy.CONTEXT, 'test.tpkg')
+        self.assertTrue(tpkg.executed)
+
+    def test_import_acl(self):
+        self.add_plugin('test.other', ['tother'], {'tother/__init__.py': ''})
+        self.add_plugin('test.granted', ['tgranted'], {'tgranted/__init__.py': ''})
+        self.add_plugin('test.tpkg', ['tpkg'], {
+            'tpkg/__init__.py': '',
+            'tpkg/stdlib.py': 'import json\nfrom . import own\nimport tpkg.own\n',
+            'tpkg/own.py': '',
+            'tpkg/granted.py': 'import tgranted\n',
+            'tpkg/denied.py': 'import tother\n'
+        }, 'Requires-Plugins: test.granted\n')
+        importlib.import_module('tpkg.stdlib')
+        importlib.import_module('tpkg.granted')
+        with self.assertRaises(ImportError):
+            importlib.import_module('tpkg.denied')
+        policy = self.finder.import_policy
+        self.assertFalse(policy.decisions['test.tpkg']['tother'])
+        self.assertTrue(policy.decisions['test.tpkg']['json'])
+
+    def test_import_acl_allows_non_plugin_modules(self):
+        self.add_plugin('test.tpkg', ['tpkg'], {
+            'tpkg/__init__.py': 'from termite.platform import Plugin\nimport pytest\n'
+        })
+        import tpkg
+        self.assertTrue(issubclass(tpkg.Plugin, object))
+        self.assertIs(sys.modules['pytest'], tpkg.pytest)
+
+    def test_restricted_modules(self):
+        sys.meta_path.remove(self.finder)
+        self.finder = PlatformPluginsFinder([' tother', ''])
+        sys.meta_path.insert(0, self.finder)
+        self.add_plugin('test.tpkg', ['tpkg'], {'tpkg/__init__.py': 'import tother\n'},
+                        'Requires: tother\n')
+        with self.assertRaises(ImportError):
+            importlib.import_module('tpkg')
+        with self.assertRaises(ImportError):
+            importlib.import_module('tother')
+
+    def test_import_profiler(self):
+        sys.meta_path.remove(self.finder)
+        profiler = ImportProfiler()
+        self.finder = PlatformPluginsFinder([], profiler=profiler)
+        sys.meta_path.insert(0, self.finder)
+        self.add_plugin('test.other', ['tother'], {'tother/__init__.py': 'VALUE = 1\n'})
+        self.add_plugin('test.tpkg', ['tpkg'], {
+            'tpkg/__init__.py': 'from tpkg import mod\n',
+            'tpkg/mod.py': 'import tother\n'
+        }, 'Requires-Plugins: test.other\n')
+        importlib.import_module('tpkg')
+        report = profiler.report()
+        self.assertEqual(['tpkg'], [m['module'] for m in report['modules']])
+        mod = report['modules'][0]['children'][0]
+        self.assertEqual('tpkg.mod', mod['module'])
+        self.assertEqual('test.other', mod['children'][0]['plugin'])
+        self.assertEqual(2, report['plugins']['test.tpkg']['module_count'])
+        self.assertEqual(['tpkg.mod'], [m['module'] for m in report['plugins']['test.tpkg']['modules'][0]['children']])
+        self.assertEqual(['tother'], [m['module'] for m in report['plugins']['test.other']['modules']])
+        self.assertGreater(mod['compile_ns'], 0)
+        self.assertIn('test.tpkg (2 modules)', profiler.format_report())
+
+    def test_class_cache(self):
+        imports = []
+
+        def counting_import(*args, **kwargs):
+            imports.append(args[0])
+            return __import__(*args, **kwargs)
+        class_loader = ClassLoader(counting_import)
+        container = self.add_plugin('test.tpkg', ['tpkg'], {'tpkg/__init__.py': 'class Hook:\n    pass\n'})
+        hook_class = class_loader.load_class('tpkg.Hook')
+        self.assertIs(hook_class, class_loader.load_class('tpkg.Hook'))
+        self.assertIs(OrderedDict, class_loader.load_class('collections.OrderedDict'))
+        self.assertEqual(['tpkg', 'collections'], imports)
+        self.assertEqual(('test.tpkg', '1.0'), class_loader.classes['tpkg.Hook'][0])
+
+        # reload the plugin
+        self.finder.remove_plugin('test.tpkg')
+        class_loader.invalidate_plugin('test.tpkg')
+        self.assertNotIn('tpkg', sys.modules)
+        self.finder.add_plugin(container)
+        reloaded_class = class_loader.load_class('tpkg.Hook')
+        self.assertIsNot(hook_class, reloaded_class)
+        self.assertIs(OrderedDict, class_loader.load_class('collections.OrderedDict'))
+        self.assertEqual(['tpkg', 'collections', 'tpkg'], imports)
+
+    def test_side_by_side_versions(self):
+        for version in ('1', '2'):
+            self.add_plugin('lib.v%s' % version, ['tlib [%s.0]' % version], {
+                'tlib/__init__.py': 'from tlib.common import describe\nVERSION = %s\n' % version,
+                'tlib/common.py': 'def describe():\n    return "common"\n'
+            })
+        self.add_plugin('test.tpkg', ['tpkg'], {'tpkg/__init__.py': 'import tlib\n'},
+                        'Requires: tlib [2.0, 3.0)\n')
+        self.add_plugin('test.tapp', ['tapp'], {'tapp/__init__.py': 'from tlib import VERSION, common\n'},
+                        'Requires: tlib\n')
+        import tpkg
+        import tapp
+        self.assertEqual(2, tpkg.tlib.VERSION)
+        self.assertEqual('__plugin_lib_v2_1_0__.tlib', tpkg.tlib.__name__)
+        self.assertEqual(1, tapp.VERSION)
+        self.assertIs(sys.modules['tlib'], sys.modules[tapp.common.__name__.rpartition('.')[0]])
+        v2_common = sys.modules['__plugin_lib_v2_1_0__.tlib.common']
+        self.assertIsNot(tapp.common, v2_common)
+        self.assertIs(tapp.common.describe.__code__, v2_common.describe.__code__)
+
+        self.finder.remove_plugin('lib.v2')
+        self.assertNotIn('__plugin_lib_v2_1_0__', sys.modules)
+        for code, owners in self.finder.code_table.codes.values():
+            self.assertNotIn('lib.v2', owners)
+
+    def test_side_by_side_versions_first_removed(self):
+        sources = {
+            'tlib/__init__.py': 'VERSION = 0\n',
+            'tlib/common.py': 'def describe():\n    return "common"\n'
+        }
+        self.add_plugin('lib.v1', ['tlib [1.0]'], sources)
+        import tlib.common
+        self.assertEqual({}, self.finder.code_table.codes)
+        self.add_plugin('lib.v2', ['tlib [2.0]'], sources)
+        self.add_plugin('test.tpkg', ['tpkg'], {'tpkg/__init__.py': 'from tlib import common\n'},
+                        'Requires: tlib [2.0, 3.0)\n')
+        import tpkg
+        self.assertEqual('__plugin_lib_v2_1_0__.tlib.common', tpkg.common.__name__)
+        self.assertEqual(2, len(self.finder.code_table.codes))
+
+        # v2 now provides tlib under its own name, and only there
+        self.finder.remove_plugin('lib.v1')
+        self.assertEqual({}, self.finder.code_table.codes)
+        self.assertNotIn('__plugin_lib_v2_1_0__.tlib', sys.modules)
+        self.assertNotIn('__plugin_lib_v2_1_0__.tlib.common', sys.modules)
+        common = importlib.import_module('tlib.common')
+        self.assertIsNot(tlib.common, common)
+        self.assertEqual('lib.v2', common.__spec__.loader.plugin_container.plugin_id)
+
+    def test_concurrent_imports(self):
+        names = []
+        for p in range(4):
+            self.add_plugin('test.tlib%d' % p, ['tlib%d' % p], dict(
+                [('tlib%d/__init__.py' % p, '')] +
+                [('tlib%d/mod%d.py' % (p, m), 'import json\nVALUE = %d\n' % m) for m in range(5)]))
+            names.extend('tlib%d.mod%d' % (p, m) for m in range(5))
+        with ThreadPoolExecutor(8) as executor:
+            results = list(executor.map(lambda i: [importlib.import_module(n) for n in names[i:] + names[:i]],
+                                        range(8)))
+        for loaded in results:
+            self.assertEqual(sorted(loaded, key=lambda m: m.__name__), [sys.modules[n] for n in sorted(names)])
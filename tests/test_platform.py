@@ -0,0 +1,129 @@
+from configparser import ConfigParser
+import os
+import shutil
+import sys
+import tempfile
+from unittest.case import TestCase
+
+from termite.loader import unregister_finder
+from termite.platform import Platform
+
+
+HOOKS_MODULE = '''
+EVENTS = []
+
+
+class SharedHook:
+
+    def activate(self):
+        EVENTS.append('shared activated')
+
+    def deactivate(self):
+        EVENTS.append('shared deactivated')
+
+
+class WorkerHook:
+
+    per_process = True
+
+    def activate(self):
+        EVENTS.append('worker activated')
+
+    def deactivate(self):
+        EVENTS.append('worker deactivated')
+'''
+
+
+class TestPreforkPlatform(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        path = os.path.join(self.root, 'tprefork')
+        os.makedirs(os.path.join(path, 'tprefork'))
+        with open(os.path.join(path, 'PLUGIN.MF'), 'w') as mf:
+            mf.write('Plugin-Id: test.prefork\nVersion: 1.0\n'
+                     'Plugin-Classes:tprefork.hooks.SharedHook;tprefork.hooks.WorkerHook\n'
+                     'Exports: tprefork [1.0]\n')
+        with open(os.path.join(path, 'tprefork', '__init__.py'), 'w') as fh:
+            fh.write('')
+        with open(os.path.join(path, 'tprefork', 'hooks.py'), 'w') as fh:
+            fh.write(HOOKS_MODULE)
+        with open(os.path.join(path, 'tprefork', 'extra.py'), 'w') as fh:
+            fh.write('')
+        config = ConfigParser()
+        config.read_dict({'platform': {'plugins-dir': self.root}})
+        self.platform = Platform(config)
+
+    def tearDown(self):
+        unregister_finder(self.platform.plugins_finder)
+        for name in list(sys.modules):
+            if name.split('.')[0] == 'tprefork':
+                del sys.modules[name]
+        shutil.rmtree(self.root)
+
+    def test_preload_and_workers(self):
+        self.platform.preload()
+        events = sys.modules['tprefork.hooks'].EVENTS
+        self.assertIn('tprefork.extra', sys.modules)
+        self.assertEqual(['shared activated'], events)
+
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                os.close(read_fd)
+                self.platform.start_worker()
+                self.platform.shutdown_worker()
+                os.write(write_fd, ','.join(events).encode('utf-8'))
+                code = 0
+            finally:
+                os._exit(code)
+        os.close(write_fd)
+        with os.fdopen(read_fd, 'rb') as worker_output:
+            worker_events = worker_output.read().decode('utf-8').split(',')
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(0, os.waitstatus_to_exitcode(status))
+        self.assertEqual(['shared activated', 'worker activated', 'worker deactivated'], worker_events)
+
+        self.platform.shutdown()
+        self.assertEqual(['shared activated', 'shared deactivated'], events)
+
+
+class TestPluginReload(TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        config = ConfigParser()
+        config.read_dict({'platform': {'plugins-dir': self.root}})
+        self.platform = Platform(config)
+
+    def tearDown(self):
+        unregister_finder(self.platform.plugins_finder)
+        for name in list(sys.modules):
+            if name.split('.')[0] == 'treload':
+                del sys.modules[name]
+        shutil.rmtree(self.root)
+
+    def create_plugin(self, version):
+        path = os.path.join(self.root, 'treload-%s' % version)
+        os.makedirs(os.path.join(path, 'treload'))
+        with open(os.path.join(path, 'PLUGIN.MF'), 'w') as mf:
+            mf.write('Plugin-Id: t.reload\nVersion: %s\nExports: treload [%s]\n' % (version, version))
+        with open(os.path.join(path, 'treload', '__init__.py'), 'w') as fh:
+            fh.write('')
+        with open(os.path.join(path, 'treload', 'mod.py'), 'w') as fh:
+            fh.write('class Hook:\n    VERSION = %r\n' % version)
+        return path
+
+    def test_reload_plugin(self):
+        manager = self.platform.plugins_manager
+        manager.add_plugin(self.create_plugin('1.0'))
+        manager.install_plugin('t.reload')
+        self.assertEqual('1.0', self.platform.resource_loader.load('class:treload.mod.Hook').VERSION)
+
+        manager.add_plugin(self.create_plugin('2.0'))
+        self.assertNotIn('treload.mod', sys.modules)
+        self.assertEqual('2.0', manager.get_plugin('t.reload').version)
+        manager.install_plugin('t.reload')
+        self.assertEqual('2.0', self.platform.resource_loader.load('class:treload.mod.Hook').VERSION)